@@ -0,0 +1,145 @@
+import base64
+import json
+import re
+
+# --- Admin Query (管理介面的分頁與篩選) ---
+# 各儲存後端共用的游標分頁：依 timestamp 由新到舊，游標為上一頁最後一筆的 (timestamp, 鍵值)，
+# 鍵值依後端而定 (MongoDB _id / SQLite id / JSON 分段序號與行號 / 檢索索引文件編號)，皆為不隨新資料位移的絕對位置。
+# 對話的關鍵字 (q) 篩選優先走對話檢索索引，不逐筆掃描。每頁筆數與長文字欄位皆有上限。
+
+MAX_LIMIT = 100
+MAX_TEXT = 2000  # 列表中 prompt / response 的最大字數 (完整內容請查單筆)
+TEXT_FIELDS = ("prompt", "response")
+NAME_FIELD = {"records": "name", "chats": "user_name"}
+
+def encode_cursor(timestamp, key):
+    raw = json.dumps([timestamp, key], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(value):
+    """解析游標；格式不符回傳 None (視為第一頁)。"""
+    if not value: return None
+    try:
+        ts, key = json.loads(base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8'))
+        return ts, key
+    except Exception:
+        return None
+
+def upper_bound(date_to):
+    """只給日期 (YYYY-MM-DD) 時含當日整天。"""
+    return date_to + "T99" if date_to and len(date_to) == 10 else date_to
+
+def parse_query(args, default_limit=50):
+    """由查詢參數 (dict 或 request.args) 取出分頁與篩選條件。"""
+    try:
+        limit = int(args.get("limit") or default_limit)
+    except ValueError:
+        limit = default_limit
+    def text(key):
+        return (args.get(key) or "").strip() or None
+    return {
+        "limit": max(1, min(MAX_LIMIT, limit)),
+        "cursor": decode_cursor(args.get("cursor")),
+        "date_from": text("from"),
+        "date_to": upper_bound(text("to")),
+        "name": text("name"),
+        "model": text("model"),
+        "q": text("q"),
+    }
+
+def clip(entry, max_text=MAX_TEXT):
+    """截短過長的文字欄位，並標記 _truncated。"""
+    out = dict(entry)
+    for field in TEXT_FIELDS:
+        value = out.get(field)
+        if isinstance(value, str) and len(value) > max_text:
+            out[field] = value[:max_text]
+            out["_truncated"] = True
+    return out
+
+def matches(entry, table, query):
+    """JSON 模式的記憶體內篩選 (與 MongoDB / SQLite 的條件一致)。"""
+    ts = str(entry.get("timestamp") or "")
+    if query["date_from"] and ts < query["date_from"]: return False
+    if query["date_to"] and ts > query["date_to"]: return False
+    if query["name"] and query["name"] not in str(entry.get(NAME_FIELD[table]) or ""): return False
+    if query["model"] and table == "chats" and query["model"] not in str(entry.get("model") or ""): return False
+    if query["q"] and not any(query["q"] in str(entry.get(f) or "") for f in TEXT_FIELDS): return False
+    return True
+
+def result(items, limit):
+    """items 為 [(timestamp, 鍵值, 紀錄)]，多取一筆以判斷是否還有下一頁。"""
+    page = items[:limit]
+    next_cursor = encode_cursor(page[-1][0], page[-1][1]) if len(items) > limit and page else None
+    return {"items": [clip(e) for _, _, e in page], "next_cursor": next_cursor}
+
+
+# --- 各後端 ---
+def scan_newest(rows, table, query):
+    """rows 為由新到舊的 (鍵值, 紀錄)；篩選出一頁 (多一筆)，早於起始日期即停止 (之後都更早)。"""
+    items = []
+    for key, e in rows:
+        if not isinstance(e, dict): continue
+        ts = str(e.get("timestamp") or "")
+        if query["date_from"] and ts and ts < query["date_from"]: break
+        if matches(e, table, query):
+            items.append((e.get("timestamp"), key, e))
+            if len(items) > query["limit"]: break
+    return result(items, query["limit"])
+
+def page_log(store, table, query):
+    """JSON 模式：store 為 ChatLogStore，由新到舊逐段讀取；游標鍵值為 [分段序號, 行號]。"""
+    before = None
+    if query["cursor"]:
+        try:
+            seq, line = query["cursor"][1]
+            before = (int(seq), int(line))
+        except (TypeError, ValueError):
+            pass
+    return scan_newest(((list(key), e) for key, e in store.iter_newest(before)), table, query)
+
+def page_search(index, query):
+    """對話的關鍵字篩選改由檢索索引取候選 (ChatSearchIndex.iter_matches)，再以 matches 精確比對；
+    游標鍵值為文件編號。查詢不含中文 bigram 時回傳 None，由呼叫端改用各後端的逐筆篩選。"""
+    key = query["cursor"][1] if query["cursor"] else None
+    rows = index.iter_matches(query["q"], before=key if isinstance(key, int) and not isinstance(key, bool) else None)
+    if rows is None: return None
+    return scan_newest(rows, "chats", query)
+
+def page_sqlite(store, table, query):
+    rows = store.page(table, before=query["cursor"], date_from=query["date_from"], date_to=query["date_to"],
+                      name=query["name"], model=query["model"], text=query["q"], limit=query["limit"] + 1)
+    return result([(e.get("timestamp"), row_id, e) for row_id, e in rows], query["limit"])
+
+def mongo_filter(table, query, object_id=None):
+    cond = []
+    if query["cursor"]:
+        ts, key = query["cursor"]
+        key = object_id(key) if object_id else key
+        cond.append({"$or": [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lt": key}}]})
+    span = {}
+    if query["date_from"]: span["$gte"] = query["date_from"]
+    if query["date_to"]: span["$lte"] = query["date_to"]
+    if span: cond.append({"timestamp": span})
+    if query["name"]: cond.append({NAME_FIELD[table]: {"$regex": re.escape(query["name"])}})
+    if query["model"] and table == "chats": cond.append({"model": {"$regex": re.escape(query["model"])}})
+    if query["q"]:
+        pattern = re.escape(query["q"])
+        cond.append({"$or": [{f: {"$regex": pattern}} for f in TEXT_FIELDS]})
+    return {"$and": cond} if cond else {}
+
+def page_mongo(collection, table, query, object_id=None):
+    cursor = collection.find(mongo_filter(table, query, object_id)).sort(
+        [("timestamp", -1), ("_id", -1)]).limit(query["limit"] + 1)
+    items = []
+    for doc in cursor:
+        key = doc.pop("_id", None)
+        items.append((doc.get("timestamp"), str(key), doc))
+    return result(items, query["limit"])
+
+def ensure_mongo_indexes(collections):
+    """建立分頁與篩選用的索引 (已存在時為 no-op)。collections: {資料表: Collection}。"""
+    for table, coll in collections.items():
+        coll.create_index([("timestamp", -1), ("_id", -1)])
+        coll.create_index(NAME_FIELD[table])
+        if table == "chats": coll.create_index("model")
@@ -0,0 +1,153 @@
+import bisect
+import itertools
+import threading
+import time
+
+# --- Admission Control (AI 運算排隊與准入) ---
+
+PRIORITY_CHAT = 0     # 一般對話：短請求優先
+PRIORITY_REPORT = 1   # 命譜詳評各章與總結
+
+class Ticket:
+    """一次 AI 運算的排隊憑證；核准後 provider 為分配到的主力供應商。"""
+    def __init__(self, providers, priority, seq):
+        self.providers = list(providers)
+        self.priority = priority
+        self.seq = seq
+        self.provider = None
+        self.enqueued_at = time.time()
+        self.granted_at = None
+        self.done = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    依供應商容量准入的優先權佇列 (同優先權內先到先服務)。
+    limits_fn 回傳 {供應商: 同時上限}，每次分派時重新計算 (金鑰增減即時反映)。
+    請求依偏好順序取得第一個尚有空位的供應商；佇列已滿時直接拒絕。
+    """
+    def __init__(self, limits_fn, max_queue=50):
+        self.limits_fn = limits_fn
+        self.max_queue = max_queue
+        self.active = {}
+        self.waiting = []  # 依 (priority, seq) 排序
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0, "cancelled": 0, "wait_total": 0.0}
+        self.listeners = []  # 佇列變動時呼叫 (無參數)，供不以執行緒等候者 (如 asyncio 協程) 接收通知
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _notify(self):
+        self._cond.notify_all()
+        for listener in self.listeners: listener()
+
+    def _dispatch(self):
+        limits = self.limits_fn()
+        for ticket in list(self.waiting):
+            for provider in ticket.providers:
+                if self.active.get(provider, 0) < limits.get(provider, 0):
+                    self.waiting.remove(ticket)
+                    self.active[provider] = self.active.get(provider, 0) + 1
+                    ticket.provider = provider
+                    ticket.granted_at = time.time()
+                    self.stats["admitted"] += 1
+                    self.stats["wait_total"] += ticket.granted_at - ticket.enqueued_at
+                    break
+        self._notify()
+
+    def submit(self, providers, priority=PRIORITY_CHAT):
+        """加入佇列並立即嘗試分派；佇列已滿回傳 None。"""
+        with self._cond:
+            if len(self.waiting) >= self.max_queue:
+                self.stats["rejected"] += 1
+                return None
+            ticket = Ticket(providers, priority, next(self._seq))
+            bisect.insort(self.waiting, ticket)
+            self._dispatch()
+            return ticket
+
+    def try_acquire(self, provider):
+        """不排隊：provider 尚有空位時立即核准並回傳憑證，否則回傳 None (供對沖等可有可無的額外請求)。"""
+        with self._cond:
+            if self.active.get(provider, 0) >= self.limits_fn().get(provider, 0): return None
+            ticket = Ticket([provider], PRIORITY_CHAT, next(self._seq))
+            self.active[provider] = self.active.get(provider, 0) + 1
+            ticket.provider = provider
+            ticket.granted_at = ticket.enqueued_at
+            self.stats["admitted"] += 1
+            return ticket
+
+    def position(self, ticket):
+        """回傳排隊名次 (1 起算)；已核准回傳 0。"""
+        with self._cond:
+            return self.waiting.index(ticket) + 1 if ticket in self.waiting else 0
+
+    def wait(self, ticket, max_wait, interval=3.0, cancel=None):
+        """
+        等候核准，期間每次佇列變動 (至多間隔 interval 秒) yield 一次目前名次。
+        以 yield from 取得結果：核准回傳 True，逾時或 cancel (threading.Event) 已設定則退出佇列並回傳 False。
+        設定 cancel 後呼叫 wake() 可讓等候立即結束。
+        """
+        deadline = time.time() + max_wait
+        while True:
+            with self._cond:
+                if ticket.provider is not None: return True
+                if cancel is not None and cancel.is_set():
+                    if ticket in self.waiting: self.waiting.remove(ticket)
+                    self.stats["cancelled"] += 1
+                    ticket.done = True
+                    return False
+                if time.time() >= deadline:
+                    if ticket in self.waiting: self.waiting.remove(ticket)
+                    self.stats["timed_out"] += 1
+                    ticket.done = True
+                    return False
+                pos = self.waiting.index(ticket) + 1
+            yield pos
+            with self._cond:
+                if ticket.provider is None:
+                    self._cond.wait(max(0.0, min(interval, deadline - time.time())))
+
+    def expire(self, ticket):
+        """
+        等候逾時：尚未核准則退出佇列並計入逾時，回傳 True；已於此前核准則回傳 False (須照常 release)。
+        供無法阻塞等候的呼叫端 (如 asyncio 輪詢 position) 使用。
+        """
+        with self._cond:
+            if ticket.provider is not None: return False
+            if ticket in self.waiting: self.waiting.remove(ticket)
+            self.stats["timed_out"] += 1
+            ticket.done = True
+            return True
+
+    def wake(self):
+        """喚醒所有等候中的請求 (讓已取消者立即退出佇列)。"""
+        with self._cond:
+            self._notify()
+
+    def release(self, ticket):
+        """歸還名額 (或撤回尚在排隊的請求)，並喚醒下一位。可重複呼叫。"""
+        with self._cond:
+            if ticket.done: return
+            ticket.done = True
+            if ticket.provider is not None:
+                self.active[ticket.provider] -= 1
+            elif ticket in self.waiting:
+                self.waiting.remove(ticket)
+            self._dispatch()
+
+    def snapshot(self):
+        with self._cond:
+            admitted = self.stats["admitted"]
+            return {
+                "limits": self.limits_fn(),
+                "active": dict(self.active),
+                "queued": len(self.waiting),
+                "admitted": admitted,
+                "rejected": self.stats["rejected"],
+                "timed_out": self.stats["timed_out"],
+                "cancelled": self.stats["cancelled"],
+                "avg_wait": round(self.stats["wait_total"] / admitted, 3) if admitted else 0.0,
+            }
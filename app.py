@@ -4,9 +4,12 @@ import json
 import requests
 import sys
 import threading
+import queue
 import webbrowser
 import logging
 import time
+import hashlib
+from collections import OrderedDict
 import asyncio
 import edge_tts
 if os.name == 'nt':
@@ -41,7 +44,26 @@ urllib3_cn.allowed_gai_family = allowed_gai_family
 from google import genai
 from master_book import MASTER_BOOK
 from bazi_master import BAZI_MASTER_BOOK
-from rule_engine import create_chart_from_dict, evaluate_rules, PALACE_NAMES
+from rule_engine import create_chart_from_dict, evaluate_rules, PALACE_NAMES, STAR_MAP
+from prompt_builder import PromptBuilder, detect_intents
+from book_index import BookIndex
+from key_scheduler import KeyScheduler, extract_retry_after
+from latency import hedge_delay, hedged_stream, track_response
+from provider_metrics import ProviderMetrics, measured_stream
+from circuit_breaker import CircuitBreaker
+from admission import AdmissionController, PRIORITY_CHAT, PRIORITY_REPORT
+from rule_explanations import RuleExplanations
+from chat_log_store import ChatLogStore
+from sqlite_store import SQLiteStore
+from mongo_writer import MongoWriteBehind, restore_id
+from excel_mirror import ExcelMirror
+from sheets_appender import SheetsAppender
+from chat_search import ChatSearchIndex
+from chat_archive import ChatArchive
+from config_cache import JsonConfigCache
+from stream_capture import StreamCapture, compress_text
+from admin_query import parse_query, page_log, page_search, page_sqlite, page_mongo, ensure_mongo_indexes, clip, MAX_LIMIT
+from sse_stream import GenerationStore, parse_event_id, meta_event, sse_events
 
 # --- Configuration & Constants Loading ---
 def load_config():
@@ -62,8 +84,47 @@ def load_config():
         "ollama": {
             "enable": True,
             "url": "http://127.0.0.1:11434/api/generate",
-            "model": "gemma2:2b"
-        }
+            "model": "gemma2:2b",
+            "connect_timeout": 2,     # 連線逾時 (秒)
+            "timeout": 10,            # 串流中兩段輸出間的最長等待 (秒)
+            "failure_threshold": 2,   # 連續失敗幾次後斷路
+            "probe_interval": 15      # 斷路期間背景探測 /api/tags 的間隔 (秒)
+        },
+        # 秘卷檢索：只注入與提問及命中規則相關的段落，而非整本秘卷
+        "retrieval": {"enable": True, "master_top_k": 8, "bazi_top_k": 4},
+        # 系統提示詞 token 預算 (依模式)：超出時依意圖相關度捨棄或截斷區塊
+        "prompt_budget": {"chat": 4000, "full": 8000, "bazi_full": 6000},
+        # 金鑰池排程：每把金鑰的每分鐘請求數初始推估 (第一次 429 前不限制，之後依 429 下修、成功後回升)、
+        # 突發容量、等待令牌或冷卻的最長秒數
+        "key_scheduler": {"groq_rpm": 30, "gemini_rpm": 15, "burst": 5, "max_wait": 20},
+        # 對沖請求：主要供應商超過 (首段延遲 p95) 仍無輸出時，同時啟動備援供應商，先出字者勝出
+        "hedge": {"enable": False, "percentile": 95, "default_delay": 3.0, "min_delay": 0.5, "max_delay": 8.0, "min_samples": 20},
+        # AI 運算准入：每把金鑰 (及本地模型) 的同時運算上限、佇列長度、最長排隊秒數 (對話 / 報告)、名次回報間隔
+        "admission": {"per_key_concurrency": 2, "ollama_concurrency": 1, "max_queue": 50, "chat_max_wait": 30, "report_max_wait": 120, "feedback_interval": 3},
+        # 回應快取 (僅限非個人化提示詞，如章節批註)：存活秒數、筆數上限、近似命中所需的 trigram 相似度
+        # similarity 預設 0 (只做精確命中)：規則只差一條的章節也可能近似命中而套用別張命盤的批註，需要時再自行開啟
+        "response_cache": {"enable": True, "ttl": 86400, "max_entries": 500, "similarity": 0},
+        # SSE 續傳：生成結束後緩衝保留秒數、緩衝數上限、無新輸出時的心跳間隔 (秒)
+        "sse": {"buffer_ttl": 300, "max_buffers": 200, "heartbeat": 15},
+        # 本地對話紀錄 (未使用 MongoDB 時)：JSONL 分段目錄、保留筆數、每個分段的筆數
+        "chat_log": {"dir": "chat_logs", "max_entries": 1000, "segment_size": 200},
+        # 本地使用者紀錄 (JSON 模式)：JSONL 分段目錄、每個分段的筆數 (全部保留，不淘汰)
+        "record_log": {"dir": "record_logs", "segment_size": 2000},
+        # 本地儲存後端 (未連線 MongoDB 時)："json" (JSON 檔 + 對話紀錄分段) 或 "sqlite" (WAL 模式資料庫)
+        "storage": {"backend": "json", "sqlite_path": "fate_purple.db"},
+        # MongoDB 批次背景寫入：批次間隔 (毫秒)、每批筆數、記憶體緩衝上限、中斷多久 (秒) 後改存本地 spill 檔
+        "mongo_writer": {"flush_interval_ms": 500, "batch_size": 100, "max_buffer": 5000, "spill_after": 30, "spill_file": "mongo_spill.jsonl"},
+        # 使用者紀錄的 Excel 備份：由背景執行緒在最後一筆儲存 debounce 秒後重寫 (連續儲存合併為一次)，
+        # 持續有新儲存時最晚於第一筆未寫入的儲存後 max_delay 秒寫入
+        "excel_mirror": {"enable": True, "path": "user_records.xlsx", "debounce": 5, "max_delay": 60},
+        # Google 試算表批次附加：每個工作表的送出間隔 (秒)、每次最多列數、每分鐘 API 呼叫上限、待送列的本地目錄
+        "sheets_appender": {"interval": 2, "batch_size": 500, "rate_per_min": 50, "pending_dir": "sheets_pending", "max_pending": 20000},
+        # 對話全文檢索索引 (中文 bigram 倒排索引)：索引目錄、每累積多少筆寫入一次快照
+        "chat_search": {"enable": True, "dir": "chat_index", "checkpoint_every": 500},
+        # 對話紀錄側錄：單次回覆最多記錄的字數；回覆超過 compress_over 字時另存 gzip 壓縮全文 (0 表示不壓縮)
+        "chat_capture": {"max_chars": 200000, "compress_over": 0},
+        # 對話封存：超過 after_days 天的對話 (JSON 模式另含超出保留筆數者) 移入 gzip 日分段；每 interval_hours 小時執行一次
+        "chat_archive": {"enable": True, "dir": "chat_archive", "after_days": 30, "interval_hours": 6, "batch_size": 1000}
     }
     
     # Load from file if exists
@@ -121,10 +182,52 @@ STEMS = CONSTANTS['STEMS']
 BRANCHES = CONSTANTS['BRANCHES']
 SI_HUA_TABLE = CONSTANTS['SI_HUA_TABLE']
 
+# --- Master Book Retrieval Index (import 時切段並建立索引) ---
+MASTER_INDEX = BookIndex(MASTER_BOOK)
+BAZI_INDEX = BookIndex(BAZI_MASTER_BOOK)
+STAR_NAMES = {n for n in STAR_MAP.values() if len(n) >= 2}
+
+def build_retrieval_query(user_prompt, matched_rules):
+    """組合秘卷檢索查詢：緣主提問 + 命中規則所涉之宮位與星曜"""
+    terms = [user_prompt]
+    for r in matched_rules[:40]:
+        terms.append(r.get('detected_palace_names', ''))
+        rule_txt = f"{r.get('description', '')}{r.get('text', '')}"
+        terms.extend(n for n in STAR_NAMES if n in rule_txt)
+    return " ".join(terms)
+
 # --- Global Data Paths ---
 CHAT_LOG_FILE = 'chat_history.json'
 RECORD_FILE = 'user_records.json'
 
+# 本地對話紀錄改為附加寫入的 JSONL 分段 (首次使用時自動匯入舊版 chat_history.json)
+CHAT_LOG_CFG = CONFIG.get('chat_log', {})
+# 對話封存 (壓縮日分段)：分段被淘汰前先封存，不再直接刪除
+ARCHIVE_CFG = CONFIG.get('chat_archive', {})
+CHAT_ARCHIVE = ChatArchive(ARCHIVE_CFG.get('dir', 'chat_archive')) if ARCHIVE_CFG.get('enable', True) else None
+CHAT_LOG = ChatLogStore(CHAT_LOG_CFG.get('dir', 'chat_logs'), legacy_file=CHAT_LOG_FILE,
+                        max_entries=CHAT_LOG_CFG.get('max_entries', 1000), segment_size=CHAT_LOG_CFG.get('segment_size', 200),
+                        on_evict=CHAT_ARCHIVE.archive if CHAT_ARCHIVE else None)
+# 本地使用者紀錄同樣改為單一寫入執行緒附加 JSONL (首次使用時匯入舊版 user_records.json)，儲存不再整檔重寫
+RECORD_LOG_CFG = CONFIG.get('record_log', {})
+RECORD_LOG = ChatLogStore(RECORD_LOG_CFG.get('dir', 'record_logs'), legacy_file=RECORD_FILE, max_entries=None,
+                          segment_size=RECORD_LOG_CFG.get('segment_size', 2000), label="使用者紀錄")
+
+# 本地 SQLite 後端：紀錄與對話改為索引查詢，首次啟用時匯入既有 JSON 資料
+STORAGE_CFG = CONFIG.get('storage', {})
+SQLITE_DB = None
+SQLITE_TABLES = {RECORD_FILE: "records", CHAT_LOG_FILE: "chats"}
+if STORAGE_CFG.get('backend', 'json') == 'sqlite':
+    try:
+        SQLITE_DB = SQLiteStore(STORAGE_CFG.get('sqlite_path', 'fate_purple.db'))
+        for _table, _loader in (("records", RECORD_LOG.load), ("chats", CHAT_LOG.load)):
+            if not SQLITE_DB.imported(_table):
+                print(f"📦 SQLite 匯入 {_table}: {SQLITE_DB.import_entries(_table, _loader(), 'json')} 筆")
+        print(f"✅ 本地 SQLite 資料庫已啟用: {SQLITE_DB.path}")
+    except Exception as e:
+        print(f"❌ SQLite 初始化失敗 ({e})，改用本地 JSON。")
+        SQLITE_DB = None
+
 # --- Persistence Layer (JSON vs MongoDB) ---
 MONGO_URI = os.environ.get("MONGO_URI") or CONFIG.get("mongo_uri")
 USE_MONGODB = CONFIG.get("use_mongodb", True) # Default to True, but allow disabling
@@ -132,6 +235,7 @@ db = None
 users_collection = None
 chats_collection = None
 MONGO_AVAILABLE = False
+MONGO_WRITER = None
 
 if USE_MONGODB:
     if MONGO_URI:
@@ -152,6 +256,18 @@ if USE_MONGODB:
             users_collection = db["user_records"]
             chats_collection = db["chat_history"]
             MONGO_AVAILABLE = True
+            mw_cfg = CONFIG.get("mongo_writer", {})
+            MONGO_WRITER = MongoWriteBehind(
+                {"user_records": users_collection, "chat_history": chats_collection},
+                flush_interval=mw_cfg.get("flush_interval_ms", 500) / 1000.0,
+                batch_size=mw_cfg.get("batch_size", 100),
+                max_buffer=mw_cfg.get("max_buffer", 5000),
+                spill_file=mw_cfg.get("spill_file", "mongo_spill.jsonl"),
+                spill_after=mw_cfg.get("spill_after", 30))
+            try:
+                ensure_mongo_indexes({"records": users_collection, "chats": chats_collection})
+            except Exception as e:
+                print(f"⚠️ MongoDB 索引建立失敗 (管理介面查詢會較慢): {e}")
             print(f"✅ MongoDB 連線成功！資料庫: {db.name}，數據將永久保存。")
         except Exception as e:
             print(f"❌ MongoDB 連線失敗。將使用本地 JSON 儲存，但在 GitHub/Render 重啟後資料會消失！")
@@ -191,13 +307,14 @@ def get_sheets_service():
             return None
     return None
 
-def append_to_sheet(sheet_name, row_data):
+def append_to_sheet(sheet_name, rows):
+    """以一次 API 呼叫附加多列；失敗時印出診斷後拋出，由 SHEETS_APPENDER 重試。"""
     service = get_sheets_service()
-    if not service or not SPREADSHEET_ID: return
+    if not service: raise RuntimeError("Google 試算表服務無法使用")
     
     try:
         range_name = f"{sheet_name}!A1"
-        body = {'values': [row_data]}
+        body = {'values': rows}
         service.spreadsheets().values().append(
             spreadsheetId=SPREADSHEET_ID, range=range_name,
             valueInputOption="USER_ENTERED", body=body).execute()
@@ -212,6 +329,17 @@ def append_to_sheet(sheet_name, row_data):
                 print("提示：請檢查 config.json 中的 spreadsheet_id 是否正確且為有效的試算表（非資料夾）。")
         else:
             print(f"⚠️ 試算表寫入錯誤 ({sheet_name}): {e}")
+        raise
+
+# 每個工作表一條背景執行緒批次送出；未設定試算表時不啟用
+SHEETS_APPENDER = None
+if SPREADSHEET_ID and os.path.exists(SHEETS_CREDENTIALS_FILE):
+    sa_cfg = CONFIG.get("sheets_appender", {})
+    SHEETS_APPENDER = SheetsAppender(
+        append_to_sheet, sheets=("Chats", "Users"),
+        interval=sa_cfg.get("interval", 2), batch_size=sa_cfg.get("batch_size", 500),
+        rate_per_min=sa_cfg.get("rate_per_min", 50), pending_dir=sa_cfg.get("pending_dir", "sheets_pending"),
+        max_pending=sa_cfg.get("max_pending", 20000))
 
 
 def load_json_file(filename):
@@ -232,6 +360,13 @@ def load_json_file(filename):
             pass
 
     # Local File Mode
+    if SQLITE_DB is not None and filename in SQLITE_TABLES:
+        return SQLITE_DB.all(SQLITE_TABLES[filename])
+    if filename == CHAT_LOG_FILE:
+        return CHAT_LOG.load()
+    if filename == RECORD_FILE:
+        RECORD_LOG.flush()  # 讀取前等候佇列中的紀錄寫入，剛儲存的紀錄立即可見
+        return RECORD_LOG.load()
     if os.path.exists(filename):
         try:
             with open(filename, 'r', encoding='utf-8') as f:
@@ -247,15 +382,24 @@ def save_json_file(filename, data):
         try:
             if filename == RECORD_FILE and data:
                 # Naive implementation: assume the last item is the new one
-                users_collection.insert_one(data[-1])
+                MONGO_WRITER.put("user_records", data[-1])
                 # Also save to local file for backup? Yes.
             elif filename == CHAT_LOG_FILE and data:
-                 chats_collection.insert_one(data[-1])
+                 MONGO_WRITER.put("chat_history", data[-1])
         except Exception as e:
             print(f"⚠️ Mongo 寫入錯誤 ({e})，切換至本地 JSON...")
             # MONGO_AVAILABLE = False # Uncomment to disable after failure
     
     # Local File Mode (Always save or fallback)
+    if SQLITE_DB is not None and filename in SQLITE_TABLES:
+        SQLITE_DB.replace(SQLITE_TABLES[filename], data)
+        return
+    if filename == CHAT_LOG_FILE:
+        CHAT_LOG.replace(data)
+        return
+    if filename == RECORD_FILE:
+        RECORD_LOG.replace(data)
+        return
     try:
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
@@ -263,18 +407,77 @@ def save_json_file(filename, data):
         print(f"儲存 {filename} 錯誤: {e}")
 
 HIDDEN_INSIGHTS_FILE = 'hidden_insights.json'
-def load_hidden_insights():
-    if os.path.exists(HIDDEN_INSIGHTS_FILE):
+# 隱藏密令常駐記憶體：對話時不讀檔，檔案 mtime 變動才重新載入；後台儲存時原子寫回並遞增版本號
+HIDDEN_INSIGHTS = JsonConfigCache(HIDDEN_INSIGHTS_FILE, defaults={
+    "report": "", "daily": "", "pastLife": "", "ritual": "",
+    "love": "", "finance": "", "bazi": "", "simple": "", "chat": ""
+})
+
+def append_local(filename, entry):
+    """本地模式附加單筆紀錄：SQLite 直接插入；JSON 模式對話與使用者紀錄皆放入分段附加的寫入佇列。"""
+    if SQLITE_DB is not None and filename in SQLITE_TABLES:
+        SQLITE_DB.insert(SQLITE_TABLES[filename], entry)
+    elif filename == CHAT_LOG_FILE:
+        CHAT_LOG.append(entry)
+    elif filename == RECORD_FILE:
+        RECORD_LOG.append(entry)
+    else:
+        recs = load_json_file(filename); recs.append(entry); save_json_file(filename, recs)
+
+EXCEL_CFG = CONFIG.get("excel_mirror", {})
+EXCEL_MIRROR = ExcelMirror(EXCEL_CFG.get("path", "user_records.xlsx"), lambda: load_json_file(RECORD_FILE),
+                           debounce=EXCEL_CFG.get("debounce", 5), max_delay=EXCEL_CFG.get("max_delay", 60))
+
+# 對話全文檢索：log_chat 時增量更新，索引為空時匯入既有對話紀錄
+CHAT_SEARCH_CFG = CONFIG.get("chat_search", {})
+CHAT_SEARCH = None
+if CHAT_SEARCH_CFG.get("enable", True):
+    CHAT_SEARCH = ChatSearchIndex(CHAT_SEARCH_CFG.get("dir", "chat_index"), legacy_loader=lambda: load_json_file(CHAT_LOG_FILE),
+                                  checkpoint_every=CHAT_SEARCH_CFG.get("checkpoint_every", 500))
+
+def rotate_chat_archive():
+    """將超過 after_days 天的對話自熱儲存移入封存 (先封存、後刪除)；回傳移動筆數。"""
+    if CHAT_ARCHIVE is None: return 0
+    days = ARCHIVE_CFG.get('after_days', 30)
+    cutoff = (datetime.now(timezone(timedelta(hours=8))) - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S')
+    batch = ARCHIVE_CFG.get('batch_size', 1000)
+    moved = 0
+    if chats_collection is not None and MONGO_AVAILABLE:
+        while True:
+            docs = list(chats_collection.find({"timestamp": {"$lt": cutoff}}).sort("timestamp", 1).limit(batch))
+            if not docs: break
+            ids = [d.pop("_id") for d in docs]
+            CHAT_ARCHIVE.archive(docs)
+            chats_collection.delete_many({"_id": {"$in": ids}})
+            moved += len(docs)
+    elif SQLITE_DB is not None:
+        while True:
+            rows = SQLITE_DB.older_than("chats", cutoff, batch)
+            if not rows: break
+            CHAT_ARCHIVE.archive([e for _, e in rows])
+            SQLITE_DB.delete_ids("chats", [i for i, _ in rows])
+            moved += len(rows)
+    else:
+        moved = CHAT_LOG.expire_before(cutoff)
+    if moved: print(f"🗄️ 已將 {moved} 筆超過 {days} 天的對話移入封存 ({CHAT_ARCHIVE.directory}/)")
+    return moved
+
+def run_archive_rotation():
+    time.sleep(60) # 啟動後稍候再執行，不拖慢開機
+    while True:
         try:
-            with open(HIDDEN_INSIGHTS_FILE, 'r', encoding='utf-8') as f: return json.load(f)
-        except: return {}
-    return {
-        "report": "", "daily": "", "pastLife": "", "ritual": "", 
-        "love": "", "finance": "", "bazi": "", "simple": "", "chat": ""
-    }
+            rotate_chat_archive()
+        except Exception as e:
+            print(f"⚠️ 對話封存失敗: {e}")
+        time.sleep(ARCHIVE_CFG.get('interval_hours', 6) * 3600)
+
+if CHAT_ARCHIVE is not None:
+    threading.Thread(target=run_archive_rotation, daemon=True, name="chat-archive").start()
 
-def save_hidden_insights(data):
-    with open(HIDDEN_INSIGHTS_FILE, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False, indent=2)
+CAPTURE_CFG = CONFIG.get("chat_capture", {})
+CAPTURE_MAX_CHARS = CAPTURE_CFG.get("max_chars", 200000)
+CAPTURE_COMPRESS_OVER = CAPTURE_CFG.get("compress_over", 0)
+SHEETS_CELL_MAX = 45000  # Google 試算表單一儲存格上限為 50000 字
 
 def log_chat(model, prompt, response, user_info=None):
     # In MongoDB mode, we don't need to load all logs just to append one.
@@ -286,19 +489,18 @@ def log_chat(model, prompt, response, user_info=None):
     }
     if user_info:
         entry.update(user_info)
+    if CAPTURE_COMPRESS_OVER and isinstance(response, str) and len(response) > CAPTURE_COMPRESS_OVER:
+        # 過長的回覆 (完整命譜) 只保留開頭預覽，全文壓縮存於 response_gz (讀取請用 stream_capture.full_response)
+        stored = dict(entry, response=response[:CAPTURE_COMPRESS_OVER] + "…", response_gz=compress_text(response))
+    else:
+        stored = entry
     
-    if db is not None and chats_collection is not None:
-        try:
-            chats_collection.insert_one(entry)
-        except Exception as e:
-            print(f"⚠️ MongoDB 寫入對話紀錄失敗: {e}，切換至本地儲存。")
-            logs = load_json_file(CHAT_LOG_FILE)
-            logs.append(entry)
-            save_json_file(CHAT_LOG_FILE, logs[-1000:])
+    if MONGO_WRITER is not None:
+        MONGO_WRITER.put("chat_history", stored) # 放入批次緩衝即返回，由背景執行緒 insert_many
     else:
-        logs = load_json_file(CHAT_LOG_FILE)
-        logs.append(entry)
-        save_json_file(CHAT_LOG_FILE, logs[-1000:]) # Keep last 1000
+        append_local(CHAT_LOG_FILE, stored) # JSON 模式放入寫入佇列即返回，保留最近 max_entries 筆
+    if CHAT_SEARCH is not None:
+        CHAT_SEARCH.add(entry) # 檢索索引使用未壓縮的全文
 
     # --- Google Sheets Export ---
     try:
@@ -311,9 +513,9 @@ def log_chat(model, prompt, response, user_info=None):
             entry.get("lunar_date", ""),
             model,
             prompt,
-            response
+            response[:SHEETS_CELL_MAX] if isinstance(response, str) else response
         ]
-        threading.Thread(target=append_to_sheet, args=("Chats", row), daemon=True).start()
+        if SHEETS_APPENDER: SHEETS_APPENDER.put("Chats", row)
     except: pass
 
 def get_location_from_ip(ip):
@@ -731,22 +933,18 @@ def get_gender_behavior_instruction(gender):
             "2. **現代語法**：融合『獨立女性』特質。在論及家庭的同時，必須肯定其專業能力與自我實現。避諱過於男尊女卑的說法，強調『巾嶹不讓鬚眉』的能量。"
         )
 
-def get_intent_sentiment_instruction(prompt):
+def get_intent_sentiment_instruction(prompt, intents=None):
     """針對緣主的提問語氣與內容，判定其當下的心理狀態並調整 AI 情緒"""
-    crisis_keywords = ["慘", "救", "死", "路", "絕", "走投無路", "怎麼辦", "救救我", "完了", "失敗"]
-    is_crisis = any(k in prompt for k in crisis_keywords)
+    if intents is None: intents = detect_intents(prompt)
     
-    if is_crisis:
+    if "crisis" in intents:
         return (
             "【情感密令：緊急安撫模式】\n"
             "- 緣主目前正處於『心神大亂』的危機時刻，語氣要極度溫柔且堅定，像是長輩握著他的手。\n"
             "- 先給予精神上的肯定（如：天無絕人之路），再從命盤中找出一絲『活水』或『貴人』所在，給予其求生的希望。"
         )
     
-    aggressive_keywords = ["贏", "賺", "發", "勝", "搞定", "擊敗", "超越"]
-    is_aggressive = any(k in prompt for k in aggressive_keywords)
-    
-    if is_aggressive:
+    if "aggressive" in intents:
         return (
             "【情感密令：謀略宗師模式】\n"
             "- 緣主目前『野心勃勃』，正欲大展宏圖。語氣要充滿張力與殺氣，重點在於『佈局』與『精確打擊』。\n"
@@ -810,14 +1008,15 @@ def get_bazi_analysis(birth_date_str, birth_hour_idx, gender_str):
         print(f"Bazi analysis error: {e}")
         return ""
 
-def get_nearby_temples(location, inquiry_text):
+def get_nearby_temples(location, inquiry_text, intents=None):
     """根據地點與所問之事，尋找適合的開運廟宇"""
+    if intents is None: intents = detect_intents(inquiry_text)
     # 判斷所問之事分類
     topic = "general"
-    if any(k in inquiry_text for k in ["情", "婚", "愛", "桃花", "姻緣", "對象"]): topic = "love"
-    elif any(k in inquiry_text for k in ["錢", "財", "投資", "發財", "發達", "買房"]): topic = "finance"
-    elif any(k in inquiry_text for k in ["工作", "事業", "官錄", "升職", "考", "學業", "官"]): topic = "career"
-    elif any(k in inquiry_text for k in ["病", "醫", "康", "災", "關", "平安"]): topic = "health"
+    if "temple_love" in intents: topic = "love"
+    elif "temple_finance" in intents: topic = "finance"
+    elif "temple_career" in intents: topic = "career"
+    elif "temple_health" in intents: topic = "health"
 
     temple_db = {
         "台北": {
@@ -1249,10 +1448,27 @@ def get_key_list(env_name, config_key):
 GROQ_KEYS = get_key_list("GROQ_API_KEY", "groq_key")
 GEMINI_KEYS = get_key_list("GEMINI_API_KEY", "api_key")
 
-# --- 排隊機制 (Request Queuing) ---
-# 限制同時進行 AI 運算的人數，防止 API 被瞬間打掛。
-# 設定同時最多 3 個人（可依伺服器性能調整）
-AI_LIMIT_SEMAPHORE = threading.Semaphore(3)
+# 金鑰排程：依各金鑰的令牌桶與冷卻狀態挑選，避免把請求送到已被限流的金鑰
+KEY_SCHED_CFG = CONFIG.get('key_scheduler', {})
+KEY_MAX_WAIT = KEY_SCHED_CFG.get('max_wait', 20)
+GROQ_SCHEDULER = KeyScheduler("groq", GROQ_KEYS, KEY_SCHED_CFG.get('groq_rpm', 30), KEY_SCHED_CFG.get('burst', 5))
+GEMINI_SCHEDULER = KeyScheduler("gemini", GEMINI_KEYS, KEY_SCHED_CFG.get('gemini_rpm', 15), KEY_SCHED_CFG.get('burst', 5))
+
+# --- 排隊機制 (Admission Control) ---
+# 依各供應商容量 (金鑰數 × 每把金鑰同時運算數) 准入 AI 運算，防止 API 被瞬間打掛；
+# 額滿時依優先權排隊 (對話優先於報告) 並回報名次，超過最長等候時間才放棄。
+ADMISSION_CFG = CONFIG.get('admission', {})
+
+def provider_limits():
+    per_key = ADMISSION_CFG.get('per_key_concurrency', 2)
+    limits = {"groq": per_key * len(GROQ_KEYS), "gemini": per_key * len(GEMINI_KEYS)}
+    if ollama_enabled(): limits["ollama"] = ADMISSION_CFG.get('ollama_concurrency', 1)
+    return limits
+
+AI_ADMISSION = AdmissionController(provider_limits, ADMISSION_CFG.get('max_queue', 50))
+
+class StatusText(str):
+    """排隊名次等狀態訊息：照常送給用戶端，但不計入對話紀錄與章節摘要。"""
 
 # --- AI Configuration & Model Selection ---
 conf_model = CONFIG['gemini'].get('model', 'gemini-2.0-flash')
@@ -1260,40 +1476,148 @@ GEMINI_MODEL = conf_model if ("gemini" in conf_model or "flash" in conf_model) e
 GROQ_MODEL = conf_model if ("llama" in conf_model or "mixtral" in conf_model or "gemma" in conf_model) else "llama-3.3-70b-versatile"
 import random
 
+# --- Provider Registry (長駐連線池) ---
+# 每個 (供應商, 金鑰) 只建立一次 client，跨請求執行緒共用，保留 HTTP keep-alive 連線。
+class ProviderRegistry:
+    """延遲建立並快取各供應商 client，同時記錄每個 (供應商, 金鑰) 的健康狀態。"""
+    def __init__(self, pool_maxsize=16):
+        self.pool_maxsize = pool_maxsize
+        self._clients = {}
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _create(self, provider, key):
+        if provider == "groq":
+            from groq import Groq, DefaultHttpxClient
+            # 429 重試交由金鑰排程處理；回應掛鉤讓對沖落敗的一路可立即中斷連線
+            return Groq(api_key=key, max_retries=0, http_client=DefaultHttpxClient(event_hooks={"response": [track_response]}))
+        if provider == "gemini":
+            return genai.Client(api_key=key, http_options={"client_args": {"event_hooks": {"response": [track_response]}}})
+        if provider == "ollama":
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_maxsize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            return session
+        raise ValueError(f"未知的 AI 供應商: {provider}")
+
+    def get(self, provider, key=""):
+        ident = (provider, key)
+        client = self._clients.get(ident)
+        if client is not None: return client
+        with self._lock:
+            client = self._clients.get(ident)
+            if client is None:
+                client = self._create(provider, key)
+                self._clients[ident] = client
+                self._health.setdefault(ident, {"ok": 0, "errors": 0, "consecutive_errors": 0, "last_error": "", "last_ok": None})
+        return client
+
+    def report(self, provider, key, ok, error=None):
+        """回報一次呼叫結果，供健康狀態統計。"""
+        with self._lock:
+            h = self._health.setdefault((provider, key), {"ok": 0, "errors": 0, "consecutive_errors": 0, "last_error": "", "last_ok": None})
+            if ok:
+                h["ok"] += 1
+                h["consecutive_errors"] = 0
+                h["last_ok"] = datetime.now().isoformat()
+            else:
+                h["errors"] += 1
+                h["consecutive_errors"] += 1
+                h["last_error"] = str(error)[:200] if error else ""
+
+    def discard(self, provider, key):
+        """金鑰失效時釋放其 client。"""
+        with self._lock:
+            client = self._clients.pop((provider, key), None)
+        close = getattr(client, "close", None)
+        if callable(close):
+            try: close()
+            except Exception: pass
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                dict(h, provider=provider, key=(key[:10] + "...") if key else "", active=(provider, key) in self._clients)
+                for (provider, key), h in self._health.items()
+            ]
+
+PROVIDERS = ProviderRegistry(CONFIG.get('ollama', {}).get('pool_maxsize', 16))
+
+# 供應商指標：TTFB、生成時間、吞吐量、錯誤類型、備援深度與排隊等候 (/api/admin/metrics)
+PROVIDER_METRICS = ProviderMetrics(("ollama", "groq", "gemini"))
+# 各供應商首段輸出延遲，供對沖延遲自動調整
+LATENCY = {name: PROVIDER_METRICS.stats(name).ttfb for name in ("ollama", "groq", "gemini")}
+
 # --- AI Engine Callers ---
-def call_ollama_api(prompt, system_prompt=""):
-    """呼叫本地 Ollama API (根據 config.json 設定)"""
+def ollama_enabled():
     # 如果是在 Render 等雲端環境，通常無法連線到本地 Ollama，直接跳過
-    if os.environ.get('RENDER'): return None
+    return not os.environ.get('RENDER') and CONFIG.get('ollama', {}).get('enable', True)
 
+def probe_ollama():
+    """背景探測：以 /api/tags 確認本地 Ollama 是否在線。"""
     ollama_cfg = CONFIG.get('ollama', {})
-    if not ollama_cfg.get('enable', True): return None
+    url = ollama_cfg.get('url', "http://127.0.0.1:11434/api/generate")
+    tags_url = ollama_cfg.get('probe_url') or url.split('/api/')[0] + '/api/tags'
+    res = PROVIDERS.get("ollama").get(tags_url, timeout=ollama_cfg.get('connect_timeout', 2))
+    return res.status_code == 200
+
+# 啟動時先視為斷路並立即於背景探測：本地模型未開啟時，請求路徑完全不需等待逾時
+OLLAMA_BREAKER = CircuitBreaker(
+    "Ollama", probe_ollama,
+    failure_threshold=CONFIG.get('ollama', {}).get('failure_threshold', 2),
+    probe_interval=CONFIG.get('ollama', {}).get('probe_interval', 15),
+    start_open=ollama_enabled()
+)
+
+def stream_ollama_api(prompt, system_prompt=""):
+    """以串流模式呼叫本地 Ollama (/api/generate 逐行 NDJSON)；斷路中直接略過"""
+    if not ollama_enabled() or not OLLAMA_BREAKER.allow(): return
 
+    ollama_cfg = CONFIG.get('ollama', {})
+    url = ollama_cfg.get('url', "http://127.0.0.1:11434/api/generate")
+    payload = {
+        "model": ollama_cfg.get('model', "gemma2:2b"),
+        "prompt": prompt,
+        "system": system_prompt,
+        "stream": True,
+        "options": {"num_ctx": 4096, "temperature": 0.7}
+    }
+    timeout = (ollama_cfg.get('connect_timeout', 2), ollama_cfg.get('timeout', 10))
     try:
-        url = ollama_cfg.get('url', "http://127.0.0.1:11434/api/generate")
-        payload = {
-            "model": ollama_cfg.get('model', "gemma2:2b"),
-            "prompt": prompt,
-            "system": system_prompt,
-            "stream": False,
-            "options": {"num_ctx": 4096, "temperature": 0.7}
-        }
-        res = requests.post(url, json=payload, timeout=10) # 增加超時，給予本地模型足夠緩衝
-        if res.status_code == 200:
-            return res.json().get("response")
+        with PROVIDERS.get("ollama").post(url, json=payload, stream=True, timeout=timeout) as res:
+            if res.status_code != 200:
+                raise requests.exceptions.HTTPError(f"HTTP {res.status_code}")
+            for line in res.iter_lines(chunk_size=None):
+                if not line: continue
+                data = json.loads(line)
+                if data.get("error"): raise RuntimeError(data["error"])
+                if data.get("response"): yield data["response"]
+                if data.get("done"): break
+        PROVIDERS.report("ollama", "", True)
+        OLLAMA_BREAKER.record_success()
     except Exception as e:
+        PROVIDERS.report("ollama", "", False, e)
+        PROVIDER_METRICS.record_error("ollama", e)
+        OLLAMA_BREAKER.record_failure()
         # 僅在偵錯模式顯示，避免干擾主日誌
         if CONFIG['server'].get('debug'): print(f"Ollama API 離線: {e}")
-    return None
 
-def stream_groq_api(prompt, system_prompt=""):
-    available_keys = list(GROQ_KEYS)
-    random.shuffle(available_keys)
-    
-    for current_key in available_keys:
+def call_ollama_api(prompt, system_prompt=""):
+    """呼叫本地 Ollama API (根據 config.json 設定)"""
+    full_response = "".join(stream_ollama_api(prompt, system_prompt))
+    return full_response if full_response else None
+
+def stream_groq_api(prompt, system_prompt="", cancel=None):
+    """cancel 為對沖請求的 CancelScope：落敗取消後不再換金鑰重試，連線中斷造成的錯誤也不計入金鑰。"""
+    tried = set()
+    while True:
+        if cancel is not None and cancel.is_set(): return
+        current_key = GROQ_SCHEDULER.acquire(exclude=tried, max_wait=KEY_MAX_WAIT)
+        if not current_key: return
+        tried.add(current_key)
         try:
-            from groq import Groq
-            client = Groq(api_key=current_key)
+            client = PROVIDERS.get("groq", current_key)
             completion = client.chat.completions.create(
                 model=GROQ_MODEL,
                 messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}],
@@ -1302,33 +1626,41 @@ def stream_groq_api(prompt, system_prompt=""):
             for chunk in completion:
                 content = chunk.choices[0].delta.content
                 if content: yield content
+            PROVIDERS.report("groq", current_key, True)
+            GROQ_SCHEDULER.on_success(current_key)
             return
         except Exception as e:
+            if cancel is not None and cancel.is_set(): return
             err_str = str(e)
+            PROVIDERS.report("groq", current_key, False, e)
+            PROVIDER_METRICS.record_error("groq", e)
             if "429" in err_str:
-                print(f">>> Groq API (Key: {current_key[:10]}...) 繁忙/限流，嘗試備援金鑰...")
+                GROQ_SCHEDULER.on_throttle(current_key, extract_retry_after(e))
+                print(f">>> Groq API (Key: {current_key[:10]}...) 繁忙/限流，進入冷卻並嘗試備援金鑰...")
                 continue
             elif "401" in err_str or "Invalid API Key" in err_str:
-                print(f"❌ Groq API 金鑰失效 ({current_key[:10]}...)，已從清單移除。")
-                if current_key in GROQ_KEYS:
-                    GROQ_KEYS.remove(current_key)
+                if GROQ_SCHEDULER.invalidate(current_key):
+                    print(f"❌ Groq API 金鑰失效 ({current_key[:10]}...)，已從清單移除。")
+                    PROVIDERS.discard("groq", current_key)
             else:
+                GROQ_SCHEDULER.on_error(current_key)
                 print(f"Groq API 錯誤 ({current_key[:10]}...): {e}")
                 continue # 嘗試下一個金鑰
 
 def call_groq_api(prompt, system_prompt=""):
-    full_response = ""
-    for chunk in stream_groq_api(prompt, system_prompt):
-        full_response += chunk
+    full_response = "".join(stream_groq_api(prompt, system_prompt))
     return full_response if full_response else None
 
-def stream_gemini_api(prompt, system_prompt=""):
-    available_keys = list(GEMINI_KEYS)
-    random.shuffle(available_keys)
-    
-    for current_key in available_keys:
+def stream_gemini_api(prompt, system_prompt="", cancel=None):
+    """cancel 同 stream_groq_api。"""
+    tried = set()
+    while True:
+        if cancel is not None and cancel.is_set(): return
+        current_key = GEMINI_SCHEDULER.acquire(exclude=tried, max_wait=KEY_MAX_WAIT)
+        if not current_key: return
+        tried.add(current_key)
         try:
-            client = genai.Client(api_key=current_key)
+            client = PROVIDERS.get("gemini", current_key)
             # Use safer model fallback for simulation future
             test_model = GEMINI_MODEL
             if "flash" in test_model and "1.5" in test_model:
@@ -1341,27 +1673,186 @@ def stream_gemini_api(prompt, system_prompt=""):
             )
             for chunk in response:
                 if chunk.text: yield chunk.text
+            PROVIDERS.report("gemini", current_key, True)
+            GEMINI_SCHEDULER.on_success(current_key)
             return
         except Exception as e:
+            if cancel is not None and cancel.is_set(): return
             err_str = str(e)
-            if "429" in err_str:
-                print(f">>> Gemini API (Key: {current_key[:10]}...) 繁忙/限流，嘗試備援金鑰...")
+            PROVIDERS.report("gemini", current_key, False, e)
+            PROVIDER_METRICS.record_error("gemini", e)
+            if "429" in err_str or "RESOURCE_EXHAUSTED" in err_str:
+                GEMINI_SCHEDULER.on_throttle(current_key, extract_retry_after(e))
+                print(f">>> Gemini API (Key: {current_key[:10]}...) 繁忙/限流，進入冷卻並嘗試備援金鑰...")
                 continue
             elif "401" in err_str or "Invalid API Key" in err_str or "API_KEY_INVALID" in err_str:
-                 print(f"❌ Gemini API 金鑰失效 ({current_key[:10]}...)，已從清單移除。")
-                 if current_key in GEMINI_KEYS:
-                     GEMINI_KEYS.remove(current_key)
+                 if GEMINI_SCHEDULER.invalidate(current_key):
+                     print(f"❌ Gemini API 金鑰失效 ({current_key[:10]}...)，已從清單移除。")
+                     PROVIDERS.discard("gemini", current_key)
             else:
+                GEMINI_SCHEDULER.on_error(current_key)
                 print(f"Gemini API 錯誤 ({current_key[:10]}...): {e}")
                 continue # 嘗試下一個金鑰
 
 def call_gemini_api(prompt, system_prompt=""):
-    full_response = ""
-    for chunk in stream_gemini_api(prompt, system_prompt):
-        full_response += chunk
+    full_response = "".join(stream_gemini_api(prompt, system_prompt))
     return full_response if full_response else None
 
-# --- UI Application Class ---
+# --- Response Cache (非個人化提示詞的回應快取) ---
+def char_trigrams(text):
+    return {text[i:i + 3] for i in range(max(1, len(text) - 2))}
+
+class ResponseCache:
+    """
+    以 (系統提示詞代號, 正規化提示詞, 模型) 的雜湊為鍵保存完整回應，命中時以串流重播。
+    similarity > 0 時，未精確命中可在同一系統提示詞/模型下以字元 trigram Jaccard 相似度找近似提示詞 (預設關閉)。
+    """
+    def __init__(self, ttl=86400, max_entries=500, similarity=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> {"ns", "grams", "text", "created"}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(str(text).split())
+
+    def make_key(self, block_ids, prompt, model):
+        ns = f"{'|'.join(block_ids)}@{model}"
+        digest = hashlib.sha256(f"{ns}\n{self.normalize(prompt)}".encode('utf-8')).hexdigest()
+        return ns, digest
+
+    def get(self, block_ids, prompt, model):
+        ns, key = self.make_key(block_ids, prompt, model)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry["created"] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["text"]
+            if self.similarity:
+                grams = char_trigrams(self.normalize(prompt))
+                best, best_score = None, self.similarity
+                for k, e in self._entries.items():
+                    if e["ns"] != ns or now - e["created"] > self.ttl: continue
+                    score = len(grams & e["grams"]) / (len(grams | e["grams"]) or 1)
+                    if score >= best_score: best, best_score = k, score
+                if best:
+                    self._entries.move_to_end(best)
+                    self.near_hits += 1
+                    return self._entries[best]["text"]
+            self.misses += 1
+            return None
+
+    def put(self, block_ids, prompt, model, text):
+        if not text: return
+        ns, key = self.make_key(block_ids, prompt, model)
+        with self._lock:
+            self._entries[key] = {"ns": ns, "grams": char_trigrams(self.normalize(prompt)), "text": text, "created": time.time()}
+            self._entries.move_to_end(key)
+            now = time.time()
+            for k in [k for k, e in self._entries.items() if now - e["created"] > self.ttl]:
+                del self._entries[k]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def replay(text, chunk_size=12):
+        for i in range(0, len(text), chunk_size):
+            yield text[i:i + chunk_size]
+
+    def snapshot(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "near_hits": self.near_hits, "misses": self.misses}
+
+RESPONSE_CACHE_CFG = CONFIG.get('response_cache', {})
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_CFG.get('ttl', 86400), RESPONSE_CACHE_CFG.get('max_entries', 500), RESPONSE_CACHE_CFG.get('similarity', 0))
+
+def cached_stream(block_ids, prompt, gen_factory):
+    """先查回應快取；未命中則轉送 AI 串流，且僅在成功生成 (產生器回傳 True) 後寫入快取。"""
+    model = CONFIG['gemini'].get('model', '')
+    if not RESPONSE_CACHE_CFG.get('enable', True):
+        return (yield from gen_factory())
+    text = RESPONSE_CACHE.get(block_ids, prompt, model)
+    if text is not None:
+        print(f">>> [回應快取] 命中 ({'/'.join(block_ids)})，直接重播。")
+        yield from ResponseCache.replay(text)
+        return True
+    parts = []
+    gen = gen_factory()
+    try:
+        while True:
+            try:
+                chunk = next(gen)
+            except StopIteration as done:
+                if done.value is True: RESPONSE_CACHE.put(block_ids, prompt, model, "".join(parts))
+                return done.value
+            if not isinstance(chunk, StatusText): parts.append(chunk)
+            yield chunk
+    finally:
+        gen.close()
+
+# --- Report Orchestration (章節並行生成) ---
+RULE_EXPLANATIONS = RuleExplanations() # 離線預生成的逐條規則解讀 (build_rule_explanations.py)
+SUMMARY_SNAPSHOT_CHARS = 250  # 總結所需之各章摘要長度
+
+class BackgroundStream:
+    """
+    於背景執行緒消費串流產生器：可即時轉送 (iter)，亦可在累積足量後截取摘要。
+    gen_factory(cancelled) 收到取消事件 (threading.Event)，可交給 stream_ai 讓排隊中的請求於 cancel() 時立即退出。
+    """
+    def __init__(self, gen_factory, snapshot_chars=SUMMARY_SNAPSHOT_CHARS):
+        self.chunks = []
+        self.snapshot_chars = snapshot_chars
+        self.snapshot_ready = threading.Event()
+        self.done = threading.Event()
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self._size = 0
+        threading.Thread(target=self._run, args=(gen_factory,), daemon=True).start()
+
+    def _run(self, gen_factory):
+        gen = None
+        try:
+            gen = gen_factory(self._cancelled)
+            for chunk in gen:
+                if self._cancelled.is_set(): break
+                self._queue.put(chunk)
+                if isinstance(chunk, StatusText): continue
+                self.chunks.append(chunk)
+                self._size += len(chunk)
+                if self._size > self.snapshot_chars: self.snapshot_ready.set()
+        except Exception as e:
+            print(f"⚠️ [報告生成] 背景章節錯誤: {e}")
+        finally:
+            if gen is not None: gen.close() # 釋放許可證等資源
+            self.done.set()
+            self.snapshot_ready.set()
+            self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None: return
+            yield chunk
+
+    def snapshot(self):
+        text = "".join(self.chunks)
+        return text[:self.snapshot_chars] + "..." if len(text) > self.snapshot_chars else text
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        AI_ADMISSION.wake() # 仍在排隊的章節立即退出佇列
+
 # --- UI Application Class ---
 if HAS_TK:
     BaseClass = tk.Tk
@@ -1569,33 +2060,102 @@ def db_check():
         "db_connected": db is not None,
         "users_collection": users_collection is not None,
         "db_name": db.name if db is not None else None,
-        "google_sheets_connected": sheets_ok
+        "google_sheets_connected": sheets_ok,
+        "ai_providers": PROVIDERS.snapshot(),
+        "ollama_breaker": OLLAMA_BREAKER.snapshot(),
+        "mongo_writer": MONGO_WRITER.snapshot() if MONGO_WRITER else None,
+        "excel_mirror": EXCEL_MIRROR.snapshot(),
+        "sheets_appender": SHEETS_APPENDER.snapshot() if SHEETS_APPENDER else None
     }
     return jsonify(status)
 
+def admin_page_query(kind, query):
+    """管理介面分頁查詢：依目前儲存後端 (MongoDB / SQLite / JSON) 取一頁紀錄 (kind: records / chats)。
+    對話的關鍵字篩選先走檢索索引 (各後端共用)，查詢不含中文詞時才由後端逐筆篩選。"""
+    if kind == "chats" and query["q"] and CHAT_SEARCH is not None:
+        page = page_search(CHAT_SEARCH, query)
+        if page is not None: return page
+    if users_collection is not None and MONGO_AVAILABLE:
+        return page_mongo(users_collection if kind == "records" else chats_collection, kind, query, restore_id)
+    if SQLITE_DB is not None:
+        return page_sqlite(SQLITE_DB, kind, query)
+    store = RECORD_LOG if kind == "records" else CHAT_LOG
+    store.flush()  # 剛放入寫入佇列的紀錄也列入
+    return page_log(store, kind, query)
+
+@app.route('/api/admin/<any(records, chats):kind>')
+def get_admin_page(kind):
+    """游標分頁 + 篩選：?cursor=&limit=&from=&to=&name=&model=&q= (q 搜尋提問與回覆)。"""
+    try:
+        return jsonify(admin_page_query(kind, parse_query(request.args)))
+    except Exception as e:
+        print(f"⚠️ 管理介面查詢失敗 ({kind}): {e}")
+        return jsonify({"error": str(e), "items": [], "next_cursor": None}), 503
+
+@app.route('/api/admin/chats/search')
+def search_chats():
+    """對話全文檢索：?q=關鍵字&k=筆數，依相關度排序並附命中摘要。"""
+    if CHAT_SEARCH is None:
+        return jsonify({"error": "對話檢索未啟用", "hits": []}), 404
+    try:
+        k = max(1, min(100, int(request.args.get('k', 20))))
+    except ValueError:
+        k = 20
+    start = time.time()
+    total, hits = CHAT_SEARCH.search(request.args.get('q', ''), k)
+    return jsonify({"total": total, "hits": hits, "took_ms": round((time.time() - start) * 1000, 2),
+                    "index": CHAT_SEARCH.snapshot()})
+
+@app.route('/api/admin/archive')
+def list_chat_archive():
+    """封存分段清單 (只讀索引)：?from=&to=&name=。"""
+    if CHAT_ARCHIVE is None: return jsonify({"error": "對話封存未啟用", "segments": []}), 404
+    name = (request.args.get('name') or '').strip() or None
+    segments = CHAT_ARCHIVE.segments(request.args.get('from'), request.args.get('to'), name)
+    return jsonify({"segments": segments, "summary": CHAT_ARCHIVE.snapshot()})
+
+@app.route('/api/admin/archive/<day>')
+def read_chat_archive(day):
+    """讀取單日封存 (解壓)：?name=&q=&offset=&limit=。"""
+    if CHAT_ARCHIVE is None: return jsonify({"error": "對話封存未啟用", "items": []}), 404
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = max(1, min(MAX_LIMIT, int(request.args.get('limit', 50))))
+    except ValueError:
+        offset, limit = 0, 50
+    total, items = CHAT_ARCHIVE.read(day, (request.args.get('name') or '').strip() or None,
+                                     (request.args.get('q') or '').strip() or None, offset, limit)
+    return jsonify({"day": day, "total": total, "offset": offset, "items": [clip(e) for e in items]})
+
+@app.route('/api/admin/archive/rotate', methods=['POST'])
+def rotate_chat_archive_now():
+    if CHAT_ARCHIVE is None: return jsonify({"error": "對話封存未啟用"}), 404
+    try:
+        return jsonify({"moved": rotate_chat_archive(), "summary": CHAT_ARCHIVE.snapshot()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/admin/data')
 def get_admin_data():
     # Detect if we should use Mongo directly for counts/recent to avoid timeouts
-    if users_collection is not None and MONGO_AVAILABLE:
-        try:
-            records_count = users_collection.count_documents({})
-            chats_count = chats_collection.count_documents({})
-            records = list(users_collection.find({}, {'_id': 0}).sort("timestamp", -1).limit(50))
-            chats = list(chats_collection.find({}, {'_id': 0}).sort("timestamp", -1).limit(50))
-        except Exception as e:
-            print(f"⚠️ Mongo Admin Data 讀取失敗: {e}")
-            records_count = 0
-            chats_count = 0
-            records = []
-            chats = []
-    else:
-        # Local JSON Fallback (only for small files)
-        full_records = load_json_file(RECORD_FILE)
-        full_chats = load_json_file(CHAT_LOG_FILE)
-        records_count = len(full_records)
-        chats_count = len(full_chats)
-        records = list(reversed(full_records[-50:]))
-        chats = list(reversed(full_chats[-50:]))
+    try:
+        if users_collection is not None and MONGO_AVAILABLE:
+            records_count = users_collection.estimated_document_count()  # 集合中繼資料，不掃描文件
+            chats_count = chats_collection.estimated_document_count()
+        elif SQLITE_DB is not None:
+            records_count = SQLITE_DB.count("records")
+            chats_count = SQLITE_DB.count("chats")
+        else:
+            RECORD_LOG.flush()
+            records_count = RECORD_LOG.count()  # 由分段索引加總，不讀取紀錄
+            chats_count = CHAT_LOG.count()
+        # 第一頁 (最新 50 筆)；後續頁面由 /api/admin/records、/api/admin/chats 依游標取得
+        records_page = admin_page_query("records", parse_query({}))
+        chats_page = admin_page_query("chats", parse_query({}))
+    except Exception as e:
+        print(f"⚠️ Admin Data 讀取失敗: {e}")
+        records_count = chats_count = 0
+        records_page = chats_page = {"items": [], "next_cursor": None}
     
     # Determine DB Status text
     status_parts = []
@@ -1610,30 +2170,60 @@ def get_admin_data():
         status_parts.append("Google 試算表")
         
     if not status_parts:
-        status_parts.append("本地 JSON")
+        status_parts.append("本地 SQLite" if SQLITE_DB is not None else "本地 JSON")
         
     status_text = " + ".join(status_parts)
     
     return jsonify({
         "records_count": records_count,
         "chats_count": chats_count,
-        "records": records,
-        "chats": chats,
+        "records": records_page["items"],
+        "chats": chats_page["items"],
+        "records_cursor": records_page["next_cursor"],
+        "chats_cursor": chats_page["next_cursor"],
         "status": "Online",
         "uptime": "Running",
         "db_status": status_text
     })
 
+@app.route('/api/admin/ai_keys')
+def get_ai_key_stats():
+    return jsonify({
+        "keys": GROQ_SCHEDULER.snapshot() + GEMINI_SCHEDULER.snapshot(),
+        "latency": {name: hist.snapshot() for name, hist in LATENCY.items()},
+        "admission": AI_ADMISSION.snapshot(),
+        "response_cache": RESPONSE_CACHE.snapshot(),
+        "sse": GENERATIONS.snapshot()
+    })
+
+@app.route('/api/admin/metrics')
+def get_provider_metrics():
+    """AI 供應商指標；?format=prometheus 時輸出 Prometheus 文字格式。"""
+    if request.args.get('format') == 'prometheus':
+        return Response(PROVIDER_METRICS.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    return jsonify(PROVIDER_METRICS.snapshot())
+
+@app.route('/api/admin/records.xlsx')
+def download_records_excel():
+    """即時產生完整的使用者紀錄 Excel 供下載 (不依賴背景備份檔是否為最新)。"""
+    try:
+        buf = EXCEL_MIRROR.render()
+    except Exception as e:
+        return jsonify({"error": f"Excel 產生失敗: {e}"}), 500
+    return send_file(buf, as_attachment=True, download_name='user_records.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
 @app.route('/api/admin/hidden_insights', methods=['GET', 'POST'])
 def handle_hidden_insights():
     if request.method == 'GET':
-        return jsonify(load_hidden_insights())
+        resp = jsonify(HIDDEN_INSIGHTS.get())
+        resp.headers['X-Config-Version'] = str(HIDDEN_INSIGHTS.version)
+        return resp
     
     data = request.json or {}
-    insights = load_hidden_insights()
-    insights.update(data)
-    save_hidden_insights(insights)
-    return jsonify({"success": True})
+    if not isinstance(data, dict): return jsonify({"error": "格式錯誤"}), 400
+    version = HIDDEN_INSIGHTS.update(data)
+    return jsonify({"success": True, "version": version})
 
 @app.route('/<path:filename>')
 def serve_static(filename):
@@ -1654,32 +2244,16 @@ def save_record():
     
     # --- Persistence Logic ---
     try:
-        if db is not None and users_collection is not None:
-            try:
-                users_collection.insert_one(record)
-            except Exception as e:
-                print(f"⚠️ MongoDB 寫入使用者紀錄失敗: {e}，切換至本地儲存。")
-                recs = load_json_file(RECORD_FILE); recs.append(record); save_json_file(RECORD_FILE, recs)
+        if MONGO_WRITER is not None:
+            MONGO_WRITER.put("user_records", record)
         else:
-            recs = load_json_file(RECORD_FILE); recs.append(record); save_json_file(RECORD_FILE, recs)
+            append_local(RECORD_FILE, record)
 
         # --- Local Excel Sync ---
-        # Ensure we have a list of records to write to Excel
-        if 'recs' not in locals():
-            recs = load_json_file(RECORD_FILE)
-            
-        if recs:
-            df = pd.DataFrame(recs)
-            df.rename(columns={
-                "timestamp": "紀錄時間", "name": "姓名", "gender": "性別",
-                "birth_date": "國曆生日", "birth_hour": "時辰(支)", "lunar_date": "農曆日期"
-            }, inplace=True)
-            excel_path = 'user_records.xlsx'
-            df.to_excel(excel_path, index=False, engine='openpyxl')
-            print(f"💾 已同步備份至本地 Excel: {excel_path}")
+        # 只標記需要更新，由背景執行緒合併連續儲存後重寫 Excel
+        if EXCEL_CFG.get("enable", True): EXCEL_MIRROR.mark_dirty()
     except Exception as e:
-        if "pandas" not in str(e).lower(): 
-            print(f"⚠️ 紀錄儲存或 Excel 備份失敗: {e}")
+        print(f"⚠️ 紀錄儲存失敗: {e}")
 
     # --- Google Sheets Export ---
     try:
@@ -1691,17 +2265,14 @@ def save_record():
             record.get("birth_hour"),
             str(record.get("lunar_date"))
         ]
-        threading.Thread(target=append_to_sheet, args=("Users", row), daemon=True).start()
+        if SHEETS_APPENDER: SHEETS_APPENDER.put("Users", row)
     except: pass
         
     return make_response(jsonify({"success": True}), 200, {"Access-Control-Allow-Origin": "*"})
 
-@app.route('/api/chat', methods=['POST', 'OPTIONS'])
-def chat():
-    if request.method == 'OPTIONS':
-        resp = make_response(); resp.headers.add("Access-Control-Allow-Origin", "*"); resp.headers.add("Access-Control-Allow-Headers", "*"); return resp
-    
-    data = request.json or {}
+# --- Chat Core (Flask 與 ASGI 串流路徑共用) ---
+def prepare_chat_context(data, user_ip, user_agent=""):
+    """解析命盤規則、偵測意圖並組裝系統提示詞，回傳串流階段所需的對話情境。"""
     user_prompt = data.get('prompt', '')
     client_sys = data.get('system_prompt', '')
     gender = data.get('gender', 'M')
@@ -1716,439 +2287,493 @@ def chat():
         "gender": data.get("gender", "")
     }
 
-    def generate():
-        print(f">>> [命譜詳評啟動] 緣主: {user_info.get('user_name', '未知')}")
-        
-        # 1. 解析命盤規則 (保持非阻塞，但訊息簡約化)
-        yield "【大師解析中，請稍候...】\n\n"
-        
-        matched = []
-        if chart_data:
-            try:
-                chart = create_chart_from_dict(chart_data, gender=gender)
-                rule_path = "ziwei_rules.json"
-                if os.path.exists(rule_path):
-                    with open(rule_path, 'r', encoding='utf-8') as f: 
-                        rules_data = json.load(f)
-                        matched = evaluate_rules(chart, rules_data)
-            except Exception as e: 
-                print(f"規則引擎錯誤: {e}")
-        
-        is_full = any(kw in (user_prompt + client_sys) for kw in ["詳評", "命譜詳評", "格局報告", "八字詳解", "命盤解析", "詳細解析", "八字論命"])
-        
-        # 注入後台「隱藏密令」
-        insights = load_hidden_insights()
-        target_type = data.get("model", "chat")
-        hidden_msg = insights.get(target_type, "")
-        
-        # 獲取天時資訊 (時辰、節氣)
-        heavenly_timing = get_heavenly_timing()
-        
-        # 計算年齡
-        age = 30 # default
+    matched = []
+    if chart_data:
         try:
-            birth_year = int(user_info.get("birth_date", "1990").split("-")[0])
-            age = datetime.now().year - birth_year
-        except: pass
-        user_info["age"] = age
-
-        # 獲取各項靈感數據
-        user_ip = request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0].strip()
-        location = get_location_from_ip(user_ip)
-        weather_sensing = get_weather_metaphor(location)
-        device_sensing = get_device_metaphor(request.headers.get('User-Agent', ''))
-        name_sensing = get_name_sensing(user_info.get("user_name"))
-        market_energy = get_market_energy()
-        
-        # 獲取網際網路上的緣主背景資訊 (若有姓名)
-        internet_insights = get_internet_insights(user_info.get("user_name"))
+            chart = create_chart_from_dict(chart_data, gender=gender)
+            rule_path = "ziwei_rules.json"
+            if os.path.exists(rule_path):
+                with open(rule_path, 'r', encoding='utf-8') as f: 
+                    rules_data = json.load(f)
+                    matched = evaluate_rules(chart, rules_data)
+        except Exception as e: 
+            print(f"規則引擎錯誤: {e}")
+    
+    # 單次掃描比對所有意圖關鍵字 (Aho–Corasick)
+    intents = detect_intents(user_prompt)
+    is_full = "full_report" in intents or "full_report" in detect_intents(client_sys)
+    
+    # 注入後台「隱藏密令」
+    insights = HIDDEN_INSIGHTS.get()
+    target_type = data.get("model", "chat")
+    hidden_msg = insights.get(target_type, "")
+    
+    # 獲取天時資訊 (時辰、節氣)
+    heavenly_timing = get_heavenly_timing()
+    
+    # 計算年齡
+    age = 30 # default
+    try:
+        birth_year = int(user_info.get("birth_date", "1990").split("-")[0])
+        age = datetime.now().year - birth_year
+    except: pass
+    user_info["age"] = age
+
+    # 獲取各項靈感數據
+    location = get_location_from_ip(user_ip)
+    weather_sensing = get_weather_metaphor(location)
+    device_sensing = get_device_metaphor(user_agent)
+    name_sensing = get_name_sensing(user_info.get("user_name"))
+    market_energy = get_market_energy()
+    
+    # 獲取網際網路上的緣主背景資訊 (若有姓名)
+    internet_insights = get_internet_insights(user_info.get("user_name"))
+    
+    # 獲取適合的廟宇推薦 (根據地點與所問之事)
+    temple_insights = get_nearby_temples(location, user_prompt, intents)
+    
+    # 獲取天機吉凶
+    daily_omens = get_daily_omens(user_info)
+    
+    # 獲取年齡行為準則
+    age_behavior = get_age_behavior_instruction(age)
+    
+    # 獲取性別行為準則
+    gender_behavior = get_gender_behavior_instruction(gender)
+    
+    # 獲取提問情緒密令
+    intent_vibe = get_intent_sentiment_instruction(user_prompt, intents)
+    
+    # 獲取八字技術分析 (後台加持)
+    bazi_tech_notes = get_bazi_analysis(user_info.get("birth_date"), user_info.get("birth_hour"), gender)
+    
+    # 擴寫地理位置與感應訊息
+    location_metaphor = get_metaphorical_location(location)
+    seed_str = f"{user_info.get('user_name')}{user_info.get('birth_date')}"
+    is_bazi_mode = (target_type == "bazi" or "bazi" in intents)
+
+    # --- 提示詞組裝：依區塊 id 收集，最後一次 join ---
+    pb = PromptBuilder()
+    pb.add("header_full" if is_full else "header_chat")
+    pb.add("persona")
+    pb.add_text("context", (f"\n\n{age_behavior}\n\n"
+              f"{gender_behavior}\n\n"
+              f"{intent_vibe}\n\n"
+              f"【天機感應】：\n"
+              f"- 位置：{location}。{location_metaphor}。\n"
+              f"- 天時：{heavenly_timing}。\n"
+              f"- 氣候感應：{weather_sensing}\n"
+              f"- 緣主狀態：{device_sensing}\n"
+              f"- 姓名共振：{name_sensing}\n"
+              f"{daily_omens}"))
+    
+    if bazi_tech_notes:
+        pb.add_text("bazi_notes", f"\n\n【八字技術批註】：\n{bazi_tech_notes}")
+    if internet_insights:
+        pb.add_text("internet", f"\n{internet_insights}")
+    if temple_insights:
+        pb.add_text("temple", f"\n{temple_insights}")
+    if target_type in ["finance", "chat"]:
+        pb.add_text("market", f"\n- 財富能量：{market_energy}")
         
-        # 獲取適合的廟宇推薦 (根據地點與所問之事)
-        temple_insights = get_nearby_temples(location, user_prompt)
+    # 偵測是否有股票相關提問
+    if "stock" in intents:
+        # 嘗試提取可能是代號的四位數字
+        import re
+        match = re.search(r'\d{4}', user_prompt)
+        stock_id = match.group(0) if match else user_prompt[:10] # 取前10字作為識別
+        pb.add_text("stock", f"\n{get_stock_prediction(stock_id, seed_str)}")
+
+    # 職業 / 健康 / 理財 / 大限 / 流年 / 流月 參考表 (靜態區塊於 import 時即已組好)
+    if "career" in intents: pb.add("career")
+    if "health" in intents: pb.add("health")
+    if "finance" in intents: pb.add("finance")
+    if "limit" in intents: pb.add("limit", age=age)
+    if "yearly" in intents:
+        pb.add("yearly", year_label=target_type if '20' in str(target_type) else '今年')
+    if "monthly" in intents: pb.add("monthly")
+
+    if target_type == "love":
+        pb.add("love", love_vibe=get_love_vibe_instruction(age, gender), age=age)
+    if is_bazi_mode:
+        pb.add("bazi")
         
-        # --- 核心邏輯：緣主個性與身份重構指令 ---
-        personality_synthesis = (
-            f"【最高密令：靈識身份統合】\n"
-            f"1. **命盤人格**：深度分析「命、身宮」主星。若有煞星則代表性格孤傲或波折，若有吉星則代表溫潤或貴氣。\n"
-            f"2. **因果印證**：結合上述「宿世因果印記」所獲之資訊。若因果顯示其為科技業，而命盤官祿宮有機、月、同、梁，請點出這是『精算天機』的文職之命。請以『本座一眼看穿你凡間身分』的語氣進行論斷。\n"
-            f"3. **即時狀態察覺**：根據「緣主狀態（設備）」與「氣候感應」，揣摩其目前的心理壓力或放鬆程度並融入語氣。\n"
-            f"4. **生活的演繹 (生活化)**：**絕對禁止枯燥地背誦課本定義**。請將命理術語轉化為「現代生活場景」。例如：『命宮帶煞』不只說凶，要說『你這脾氣就像夏天的午後雷陣雨，來得快去得快，身邊的人得帶傘才行』。語氣要幽默、犀利且充滿故事感，讓緣主聽得進去、看得明白。\n"
-            f"**絕對禁忌**：禁止提及「後台線索」、「搜尋資料」、「查閱資料」、「數據」、「API」等科技詞彙。請使用『神識感應』、『撥開迷霧』、『因果顯現』等宗師語氣。"
-        )
+    # 注入隱晦提示規範：防止 AI 直接像地圖導航一樣報出地址
+    pb.add("no_reveal")
+
+    # 注入今日財運偏財靈動數 (僅針對財運、每日錦囊、或一般聊天)
+    if target_type in ["finance", "daily", "chat"]:
+        # 使用 用戶名+生日 作為隨機種子，讓號碼專屬於該人且當日固定
+        lottery_msg = get_lottery_prediction(seed_str)
+        if lottery_msg:
+            pb.add("lottery", lottery_msg=lottery_msg)
+
+    # --- 輸出模組規範 (Markdown 格式) ---
+    pb.add_text("sep", "\n")
+    if is_full:
+        pb.add("spec_full_bazi" if is_bazi_mode else "spec_full_ziwei")
+    else:
+        pb.add("spec_chat")
+
+    # 動態系統提示詞：平常對話不帶秘卷以節省 Token
+    # 重要：將前端指定的 client_sys 放在最後，並加上最高指令標籤，確保 AI 嚴格執行格式要求
+    pb.add_text("sep", "\n")
+    pb.add_text("hidden", hidden_msg)
+    pb.add("priority")
+    pb.add_text("client_sys", client_sys)
+    retrieval_cfg = CONFIG.get('retrieval', {})
+    if retrieval_cfg.get('enable', True):
+        # 僅注入與提問、命中規則之星曜宮位相關的秘卷段落
+        query = build_retrieval_query(user_prompt, matched)
+        if is_full:
+            master_passages = MASTER_INDEX.retrieve(query, retrieval_cfg.get('master_top_k', 8))
+            if master_passages:
+                pb.add_text("master_book", f"\n\n【紫微心法秘卷】\n{master_passages}")
+        # 八字論命模式下秘卷本身即為主軸 (篇幅短)，整本注入
+        bazi_passages = BAZI_MASTER_BOOK if is_bazi_mode else BAZI_INDEX.retrieve(query, retrieval_cfg.get('bazi_top_k', 4))
+        if bazi_passages:
+            pb.add_text("bazi_book", f"\n\n【八字心法秘卷】\n{bazi_passages}")
+    else:
+        if is_full:
+            pb.add_text("master_book", f"\n\n【紫微心法秘卷】\n{MASTER_BOOK}")
+        pb.add_text("bazi_book", f"\n\n【八字心法秘卷】\n{BAZI_MASTER_BOOK}")
+
+    # 依模式套用 token 預算，避免一句簡短提問也送出上萬字的秘卷
+    prompt_mode = ("bazi_full" if is_bazi_mode else "full") if is_full else "chat"
+    mode_intents = set(intents) | {prompt_mode}
+    if is_bazi_mode: mode_intents.add("bazi")
+    budget = CONFIG.get('prompt_budget', {}).get(prompt_mode)
+    final_system_prompt = pb.build(budget=budget, intents=mode_intents)
+    print(f">>> [提示詞組裝] 模式: {prompt_mode}，約 {pb.tokens} tokens (預算 {budget}) / {len(final_system_prompt)} 字 / {len(pb.blocks)} 區塊，耗時 {pb.elapsed_ms:.3f} ms"
+          + (f"，捨棄: {','.join(pb.dropped)}" if pb.dropped else ""))
 
-        # 獲取天機吉凶
-        daily_omens = get_daily_omens(user_info)
-        
-        # 獲取年齡行為準則
-        age_behavior = get_age_behavior_instruction(age)
-        
-        # 獲取性別行為準則
-        gender_behavior = get_gender_behavior_instruction(gender)
-        
-        # 獲取提問情緒密令
-        intent_vibe = get_intent_sentiment_instruction(user_prompt)
-        
-        # 獲取八字技術分析 (後台加持)
-        bazi_tech_notes = get_bazi_analysis(user_info.get("birth_date"), user_info.get("birth_hour"), gender)
-        
-        # 擴寫地理位置與感應訊息
-        location_metaphor = get_metaphorical_location(location)
-        geo_msg = (f"{personality_synthesis}\n\n"
-                  f"{age_behavior}\n\n"
-                  f"{gender_behavior}\n\n"
-                  f"{intent_vibe}\n\n"
-                  f"【天機感應】：\n"
-                  f"- 位置：{location}。{location_metaphor}。\n"
-                  f"- 天時：{heavenly_timing}。\n"
-                  f"- 氣候感應：{weather_sensing}\n"
-                  f"- 緣主狀態：{device_sensing}\n"
-                  f"- 姓名共振：{name_sensing}\n"
-                  f"{daily_omens}")
-        
-        if bazi_tech_notes:
-            geo_msg += f"\n\n【八字技術批註】：\n{bazi_tech_notes}"
+    return {
+        "data": data,
+        "user_prompt": user_prompt,
+        "user_info": user_info,
+        "matched": matched,
+        "is_full": is_full,
+        "is_bazi_mode": is_bazi_mode,
+        "prompt_mode": prompt_mode,
+        "final_system_prompt": final_system_prompt
+    }
+
+MSG_NO_KEYS = "【天機未啟】系統尚未配置 AI 金鑰。若是部署在雲端，請檢查環境變數 (Environment Variables) 設定。\n"
+MSG_BUSY = "【天機繁忙】目前求問人數眾多，大師正在為其他緣主詳批，請稍候片刻再試... \n"
+MSG_OFFLINE = "【天機中斷】目前 API 服務暫時無法感應，請確認金鑰配額或網路連線。"
+
+def ai_provider_order():
+    """回傳 (主力雲端供應商, 准入偏好順序)：本地 Ollama 可用時優先，其次依 config 的 provider。"""
+    provider = CONFIG.get('gemini', {}).get('provider', 'gemini').lower()
+    cloud = [name for name, keys in (("groq", GROQ_KEYS), ("gemini", GEMINI_KEYS)) if keys]
+    if provider != 'groq': cloud.reverse()
+    local = ["ollama"] if (ollama_enabled() and OLLAMA_BREAKER.allow()) else []
+    return provider, local + cloud
+
+def admission_max_wait(priority):
+    return ADMISSION_CFG.get('chat_max_wait' if priority == PRIORITY_CHAT else 'report_max_wait', 30)
+
+def hedge_racer(name, factory, ticket=None, started=None):
+    """
+    對沖請求的每一路都持有准入名額：正常結束時歸還，落敗時由 CancelScope 立即歸還 (同時中斷其連線)。
+    ticket 為主力請求已取得的名額 (改由本路歸還，開始時設定 started)；未提供時另取空位，無空位則不啟動對沖。
+    factory 以該路的 CancelScope 呼叫。
+    """
+    def run(scope):
+        held = ticket or AI_ADMISSION.try_acquire(name)
+        if held is None:
+            print(f">>> [對沖請求] {name} 無空閒名額，略過對沖。")
+            return
+        if started is not None: started.set()
+        once = threading.Lock()
+        def release():
+            if once.acquire(blocking=False): AI_ADMISSION.release(held)
+        scope.on_cancel(release)
+        try:
+            yield from factory(scope)
+        finally:
+            release()
+    return run
+
+# Updated AI Caller with Streaming Support (Includes Queuing)
+def stream_ai(p, s, priority=PRIORITY_CHAT, feedback=True, cancel=None):
+    provider, order = ai_provider_order()
+    if not order:
+        yield MSG_NO_KEYS
+        return
+
+    ticket = AI_ADMISSION.submit(order, priority)
+    if ticket is None:
+        print(">>> [排隊系統] 排隊人數已滿，拒絕新請求。")
+        yield MSG_BUSY
+        return
+
+    handoff = None # 對沖時主力名額改由該路執行緒歸還
+    try:
+        max_wait = admission_max_wait(priority)
+        waiter = AI_ADMISSION.wait(ticket, max_wait, ADMISSION_CFG.get('feedback_interval', 3), cancel)
+        last_pos = None
+        while True:
+            try:
+                pos = next(waiter)
+            except StopIteration as done:
+                granted = done.value
+                break
+            if feedback and pos != last_pos:
+                yield StatusText(f"⏳【天機排隊】目前求問人數眾多，您排在第 {pos} 位，請稍候...\n")
+            last_pos = pos
+
+        if cancel is not None and cancel.is_set():
+            print(">>> [排隊系統] 請求已取消，不再呼叫 AI。")
+            return
+        if not granted:
+            print(f">>> [排隊系統] 排隊超過 {max_wait} 秒，放棄請求。")
+            yield MSG_BUSY
+            return
 
-        if internet_insights:
-            geo_msg += f"\n{internet_insights}"
+        PROVIDER_METRICS.record_queue_wait(ticket.granted_at - ticket.enqueued_at)
+        print(f">>> AI 請求 (Prompt: {p[:15]}..., 分配: {ticket.provider})")
         
-        if temple_insights:
-            geo_msg += f"\n{temple_insights}"
-            
-        if target_type in ["finance", "chat"]:
-            geo_msg += f"\n- 財富能量：{market_energy}"
-            
-        # 偵測是否有股票相關提問
-        stock_keywords = ["股票", "股", "代號", "代碼", "漲", "跌", "投資", "2330", "台積電", "鴻海", "聯發科"]
-        has_stock_query = any(k in user_prompt for k in stock_keywords)
-        if has_stock_query:
-            # 嘗試提取可能是代號的四位數字
-            import re
-            match = re.search(r'\d{4}', user_prompt)
-            stock_id = match.group(0) if match else user_prompt[:10] # 取前10字作為識別
-            seed_str = f"{user_info.get('user_name')}{user_info.get('birth_date')}"
-            stock_insight = get_stock_prediction(stock_id, seed_str)
-            geo_msg += f"\n{stock_insight}"
-            
-        # 偵測是否有職業相關提問
-        career_keywords = ["職業", "工作", "事業", "轉職", "就業", "行業", "找事", "找頭路", "做什麼好", "適合什麼"]
-        has_career_query = any(k in user_prompt for k in career_keywords)
-        if has_career_query:
-            career_mapping = (
-                "\n\n【天機指路：各星曜具體對應之行業參考表】\n"
-                "若緣主問及職業，必須嚴格依照其「官祿宮」或「命宮」之主星，直接點出以下列表中的 3~5 個具體實體職業，不得說空話：\n"
-                "- 紫微：企業負責人、高階主管、政治家、精品業、獨立創業者、高級公務員。\n"
-                "- 天機：軟體工程師、企劃專員、行銷人員、資料科學家、程式設計、宗教學者、命理幕僚。\n"
-                "- 太陽：外交官、公關人員、大眾傳播、教育工作者、能源產業、政治人物、跨國貿易。\n"
-                "- 武曲：金融業經理、銀行員、會計師、軍警人員、五金機械工程師、外科醫生、理財專員。\n"
-                "- 天同：幼教老師、餐飲業老闆、旅遊業導遊、社工、美容美髮師、娛樂休閒業、客服人員。\n"
-                "- 廉貞：科技業工程師、法律從業人員、警察、醫美醫師、護理師、藝術設計師、公職人員。\n"
-                "- 天府：金融管理、房地產仲介代銷、銀行主管、企業人資、財務長。\n"
-                "- 太陰：房地產投資、室內設計師、財務會計、教育機構行政、飯店管理、美妝保養銷售、作家。\n"
-                "- 貪狼：演藝娛樂人員、公關行銷、業務代表、設計師、醫學美容、餐飲休閒業、運動教練。\n"
-                "- 巨門：律師、業務推銷員、補習班講師、翻譯員、企管顧問、醫事人員、法務專員。\n"
-                "- 天相：秘書、特助、人力資源、公眾服務、服飾業、攝影師、機關行政主管。\n"
-                "- 天梁：西醫、中醫師、醫護衛教、社福人員、法官、宗教事業推廣、長照管理員。\n"
-                "- 七殺：軍警武職、外科醫生、新市場業務開發、土木建築工程師、職業運動員。\n"
-                "- 破軍：創新科技研發、創投經理、物流運輸業、軍警、拆除工程、破壞性創新行業。\n"
-                "- 文昌/文曲：學術研究員、作家、記者、教育學者、出版社編輯、藝術從業、會計。\n"
-                "- 左輔/右弼：特別助理、房仲中介、車行經理、人力派遣管理、客服中心督導。\n"
-                "【嚴格規定】：請從命盤挑出對應星曜，直接給出並解釋這幾個明確的現代職業選項！\n"
-            )
-            geo_msg += career_mapping
-
-        # 偵測是否有疾病/健康相關提問
-        health_keywords = ["健康", "疾病", "生病", "身體", "注意什麼病", "養生", "看哪一科", "醫", "病"]
-        has_health_query = any(k in user_prompt for k in health_keywords)
-        if has_health_query:
-            health_mapping = (
-                "\n\n【天機指路：各星曜具體對應之健康/疾病參考表】\n"
-                "若緣主問及健康，必須嚴格依照其「疾厄宮」或「命宮」之星曜（特別是化忌或煞星），點出具體的現代醫學病狀或器官，不得只說陰陽五行：\n"
-                "- 紫微：脾胃失調、消化不良、頭痛、腦神經衰弱、高血壓。\n"
-                "- 天機：肝膽功能、神經系統衰弱、失眠、四肢關節痠痛、甲狀腺異常。\n"
-                "- 太陽：心血管疾病、血壓異常、眼部疾病(白內障/青光眼)、偏頭痛。\n"
-                "- 武曲：呼吸道問題、肺部疾病、氣喘、骨骼牙齒問題、金屬創傷。\n"
-                "- 天同：泌尿系統、腎臟功能、膀胱炎、耳鳴、體重過重或水腫。\n"
-                "- 廉貞：血液循環問題、免疫系統異常、心臟病、傳染性疾病、腫瘤。\n"
-                "- 天府：胃病、消化性潰瘍、肌肉痠痛、脾臟問題、脹氣。\n"
-                "- 太陰：女性婦科疾病、內分泌失調、糖尿病、腎臟虛寒、皮膚過敏。\n"
-                "- 貪狼：肝臟疾病(脂肪肝、肝炎)、解毒功能低下、性器官異常、縱慾過度之併發症。\n"
-                "- 巨門：呼吸系統、腸胃病、口腔潰瘍、牙神經痛、呼吸道感染。\n"
-                "- 天相：泌尿系統疾病、腎結石、皮膚過敏、面部皮膚問題、水腫。\n"
-                "- 天梁：腸胃病、慢性病、風濕、免疫力低下。\n"
-                "- 七殺：呼吸系統炎、肺結核、外傷骨折、交通意外傷害、痔瘡。\n"
-                "- 破軍：生殖系統異常、骨骼牙齒損壞、外傷、消耗性疾病。\n"
-                "- 擎羊/陀羅：開刀手術、慢性扭傷、神經痛、慢性發炎。\n"
-                "- 火星/鈴星：急性發炎、高燒、突發性心臟病、燙傷。\n"
-                "【嚴格規定】：直接講出現代醫學器官與症狀名稱，並給予具體的就診科別建議或養生作為（如：建議做心血管檢查，少熬夜）。\n"
-            )
-            geo_msg += health_mapping
-
-        # 偵測是否有財運/理財相關提問
-        finance_keywords = ["財", "理財", "投資", "賺錢", "偏財", "正財", "買什麼", "致富", "發財", "缺錢"]
-        has_finance_query = any(k in user_prompt for k in finance_keywords)
-        if has_finance_query:
-            finance_mapping = (
-                "\n\n【天機指路：各星曜具體對應之理財/投資工具參考表】\n"
-                "若緣主問及財運與投資，必須嚴格依照其「財帛宮」或「命宮」之星曜，給出具體的投資工具與求財方式：\n"
-                "- 紫微：適合大型績優股(如台積電)、藍籌股、高級實體房地產、名表/藝術品收藏投資。\n"
-                "- 天機：適合短期波段操作、ETF定期定額、科技類股、依靠專業技能或智慧財產權變現。\n"
-                "- 太陽：適合能源股、跨國國外基金、外匯投資、依靠知名度/流量/公眾影響力得財。\n"
-                "- 武曲：(正財星)適合金融股、黃金存摺、金屬原物料、穩健保單、技術勞作或實業致富。\n"
-                "- 天同：適合休閒娛樂產業投資、餐飲股、傳產配息股、依靠人際關係或合夥獲利，不宜高風險。\n"
-                "- 廉貞：適合高科技股、電商產業、偏財投機(需見吉星)、透過設計或精密技術專利賺錢。\n"
-                "- 天府：(庫星)適合土地投資、房地產租金收益、定存、保守型基金，重「守財」與長線。\n"
-                "- 太陰：(富星)適合購買房地產(房產收租)、民生消費股、美妝醫療股、女性市場相關投資。\n"
-                "- 貪狼：(偏財星)適合高風險高報酬投資、虛擬貨幣、生技股、娛樂產業、交際應酬帶來之暗財。\n"
-                "- 巨門：適合依靠口條/教學賺錢、專業證照引進之財、醫藥生技股、或透過特殊專門知識收費。\n"
-                "- 天相：適合投資代理商、連鎖加盟、民生必需品、或以協助他人理財抽取佣金。\n"
-                "- 天梁：(蔭星)適合長照綠能產業、醫療股、保險理賠金、長輩贈與繼承、或存股領息。\n"
-                "- 七殺/破軍：大起大落，適合高波動期貨、新興市場、創業型股票，但建議設立停損點，賺短線。\n"
-                "【嚴格規定】：請具體說出「股票種類、房地產、基金、虛擬貨幣」等現代名詞，並告知風險屬性是要短線還是長線定存。\n"
-            )
-            geo_msg += finance_mapping
-            
-        # 偵測是否有十年大限/運勢相關提問
-        limit_keywords = ["大限", "十年", "未來十年", "這十年", "大運", "十年運程", "十年運勢"]
-        has_limit_query = any(k in user_prompt for k in limit_keywords)
-        if has_limit_query:
-            limit_mapping = (
-                f"\n\n【天機指路：十年大限推算準則】\n"
-                f"緣主正在詢問「十年大限/大運」。請務必嚴格執行以下步驟：\n"
-                f"1. 查閱上述命盤資訊中，每個宮位後面標示的「大限:(例如 34-43)」。\n"
-                f"2. 將緣主的當前歲數（目前的年齡約 {age} 歲）套入這些區間，找出他「目前」或「未來即將進入」的大限是落在哪個宮位（例如：找出大限區間包含 {age} 的宮位）。\n"
-                f"3. 找到該宮位後，將其視為「大限命宮」。\n"
-                f"4. 根據這個宮位內的主星與四化，具體指出這十年的『重心是什麼』（如：如果大限落在財帛宮，這十年重心必然在求財；若在夫妻宮，重心在感情與人際）。\n"
-                f"5. 給出這十年中會遇到最大的 2 個挑戰與 2 個機遇（例如：這十年武曲化忌，有財務危機；但有天鉞，會有長輩貴人相助）。\n"
-                f"【嚴格規定】：不可籠統講述一生的命運，必須精準點出這十年（包含具體歲數區間）的吉凶與應該採取的具體策略（如：守成不宜擴張，或該積極創業）。\n"
-            )
-            geo_msg += limit_mapping
-
-
-        # 偵測是否有流年/年運相關提問
-        yearly_keywords = ["流年", "年運", "今年", "2024", "2025", "明年", "流年運勢"]
-        has_yearly_query = any(k in user_prompt for k in yearly_keywords)
-        if has_yearly_query:
-            yearly_mapping = (
-                f"\n\n【天機指路：流年運勢推算準則】\n"
-                f"緣主正在詢問「流年運勢」。請務必嚴格執行以下步驟：\n"
-                f"1. 查閱上述命盤資訊中，【流年命宮】所落的宮位（例如：流年命宮在辰宮，對應本命的子女宮）。\n"
-                f"2. 找到該宮位在原盤中的主星，並結合該年的「流年四化」（如 2024 甲辰年是廉破武陽）。\n"
-                f"3. 具體指出今年的『整體基調』（如：變動劇烈、適合守成、利於求名、或是有桃花劫）。\n"
-                f"4. 列出今年最旺的宮位與最弱（需防範）的宮位。\n"
-                f"【嚴格規定】：必須針對該年度（例如 {target_type if '20' in str(target_type) else '今年'}）的吉凶進行預測，禁止泛泛而談。\n"
-            )
-            geo_msg += yearly_mapping
-
-        # 偵測是否有流月/月運相關提問
-        monthly_keywords = ["流月", "月運", "這個月", "本月", "流月運勢"]
-        has_monthly_query = any(k in user_prompt for k in monthly_keywords)
-        if has_monthly_query:
-            monthly_mapping = (
-                f"\n\n【天機指路：流月運勢推算準則】\n"
-                f"緣主正在詢問「流月運勢」。請務必嚴格執行以下步驟：\n"
-                f"1. 查閱上述命盤資訊中，【流月命宮】所落的宮位。\n"
-                f"2. 結合該月的主星與流月四化分析本月的『氣場強弱』。\n"
-                f"3. 給出本月的行動方針（如：適合簽約、不宜遠行、注意口舌是非）。\n"
-                f"【嚴格規定】：只需點出本月（及未來一個月）的情況，語氣要短促有力。\n"
-            )
-            geo_msg += monthly_mapping
-
-        if target_type == "love":
-            love_vibe = get_love_vibe_instruction(age, gender)
-            geo_msg += f"\n\n【紅塵情慾密令】：\n{love_vibe}\n- 目前緣主正值 {age} 歲之春秋。請針對此年輪的肉體與靈魂需求，給予極度『曖昧且具侵略性』的桃花攻略。"
-
-        if target_type == "bazi" or "八字" in user_prompt:
-            bazi_instruction = (
-                "\n\n【最高密令：八字正宗論斷】\n"
-                "1. **絕對優先權**：緣主目前正在進行「八字論命」，請務必捨棄繁雜的紫微斗數術語（除非兩者有極度明顯的印證），「全神貫注」於【八字四柱資訊】（年、月、日、時柱）。\n"
-                "2. **運用卷宗**：請嚴格引用《八字心法秘卷》中的內容。特別是「日主天干」的性情描述、以及「地支互動」（合、沖、刑、害）的解析。\n"
-                "3. **技術要點**：必須先判斷「日主強弱」與「月令得失」，再以此為基礎論斷財、官、印、食之吉凶。語氣要像是一位手持八字命譜的資深命理宗師。\n"
-                "4. **絕不空談**：直接引用干支（如：日主甲木見庚金為偏官）來進行論證。但請務必將這些術語「轉化為生活故事」，例如甲木見庚金，你可以說：『你就像一棵參天大樹，最近遇到了一把生鏽的好斧頭在修理你，雖然有點痛，但那是為了讓你成材啊！』，讓聽眾感到有趣且有共鳴。"
-            )
-            geo_msg += bazi_instruction
-            
-        # 根據模式決定推薦指令
-        # 注入隱晦提示規範：防止 AI 直接像地圖導航一樣報出地址
-        geo_msg += " \n【禁止直接揭露指令】：絕對禁止提及具體城市名或使用地圖導航語氣（如：在某路某號）。請說「本座觀此地東北方有瑞氣、某區中有一處香火極盛之處...」等宗師口吻，緩緩點出廟宇名稱。"
-            
-        # --- 輸出模組規範 (Markdown 格式) ---
-        if is_full:
-            # 判斷是否為八字導向
-            is_bazi_mode = (target_type == "bazi" or "八字" in user_prompt)
-            pillar_term = "【命譜詳批：五行定論】" if is_bazi_mode else "【命譜詳批：星曜定論】"
-            pillar_desc = "深入解析八字格局、日主強弱、喜用神與五行生剋。" if is_bazi_mode else "深入解析格局與星曜。"
-            
-            output_module_spec = f"""
-【輸出模組規範】：請務必依序包含以下章節，並使用 Markdown 格式呈現：
-1. ### 🌌 【天機啟示：靈識同步】
-   - 描述環境磁場（隱晦點出位置，禁提城市名）與天時時辰。
-2. ### 🕯️ 【因果印證：凡塵真身】
-   - (若有姓名) 結合感應到之因果足跡與命盤，點出其職業或近期生活狀態。語氣需神祕：「本座觀你凡塵之氣...」。
-3. ### 📜 {pillar_term}
-   - {pillar_desc}
-4. ### 💡 【大師點撥：趨吉避凶】
-   - 給予具體建議與 1-2 處適合緣主當前氣場的廟宇點撥。
-"""
+        # Phase 1: Local Ollama (串流；本地名額已滿或斷路中則直接交給雲端)
+        depth = 0 # 備援深度：已失敗的供應商數
+        if ticket.provider == "ollama":
+            has_local = False
+            for chunk in measured_stream(stream_ollama_api(p, s), PROVIDER_METRICS, "ollama"):
+                has_local = True
+                yield chunk
+            if has_local:
+                PROVIDER_METRICS.record_fallback(depth)
+                return True
+            depth = 1
         else:
-            output_module_spec = """
-【對話回應規範】：
-1. **直接破題，切中要害**：針對緣主的具體提問（例如：適合什麼職業、財運在哪裡、感情狀況等），必須**直接給出具體答案**，**絕對禁止打高空、含糊其辭或講一堆空泛的玄學套話**。
-2. **引述命盤，具體佐證**：你的論點必須直接引用命盤證據。若是紫微斗數，請明確指出哪個「宮位」的哪顆「星曜」或「四化」；若是八字論命，請明確指出是哪一「柱」的「干支」或「五行生剋」導致這個結果。
-3. **給予具體選項**：如果問職業，直接給出 3~5 種現代具體行業。如果問財運，直接說可以投資哪一類標的。
-4. **捨棄繁瑣格式**：直接以「本座觀你盤中...」開頭，直搗黃龍解析問題。
-"""
-
-        # 注入今日財運偏財靈動數 (僅針對財運、每日錦囊、或一般聊天)
-        if target_type in ["finance", "daily", "chat"]:
-            # 使用 用戶名+生日 作為隨機種子，讓號碼專屬於該人且當日固定
-            seed_str = f"{user_info.get('user_name')}{user_info.get('birth_date')}"
-            lottery_msg = get_lottery_prediction(seed_str)
-            if lottery_msg:
-                geo_msg += f"\n\n【今日天機財數】：{lottery_msg}。若緣主問及財運或幸運號碼，請以「天機乍現」的語氣，神祕地透露這組號碼，並提醒切勿沉迷，僅供結緣參考。"
-
-        # 動態系統提示詞：平常對話不帶秘卷以節省 Token
-        # 重要：將前端指定的 client_sys 放在最後，並加上最高指令標籤，確保 AI 嚴格執行格式要求
-        priority_tag = "\n【最高優先權指令：請嚴格執行上述格式與內容要求，務必極度具體、精準、直接】\n"
+            provider = ticket.provider # 以分配到名額的雲端供應商為主力
         
-        if is_full:
-            final_system_prompt = f"你是【紫微天機道長】，命理宗師。\n{geo_msg}\n{output_module_spec}\n{hidden_msg}{priority_tag}{client_sys}\n\n【紫微心法秘卷】\n{MASTER_BOOK}\n\n【八字心法秘卷】\n{BAZI_MASTER_BOOK}"
-        else:
-            final_system_prompt = f"你是【紫微天機道長】，語氣精煉犀利，一針見血。\n{geo_msg}\n{output_module_spec}\n{hidden_msg}{priority_tag}{client_sys}\n\n【八字心法秘卷】\n{BAZI_MASTER_BOOK}"
-
-        # Updated AI Caller with Streaming Support (Includes Queuing)
-        def stream_ai(p, s):
-            # 嘗試獲取許可證，若 5 秒內排不到隊就放棄，避免伺服器掛死
-            acquired = AI_LIMIT_SEMAPHORE.acquire(blocking=True, timeout=5)
-            
-            if not acquired:
-                print(">>> [排隊系統] 請求過多，許可證已用完。")
-                yield "【天機繁忙】目前求問人數眾多，大師正在為其他緣主詳批，請稍候片刻再試... \n"
-                return
+        def try_groq_flow():
+            has_content = False
+            for chunk in measured_stream(stream_groq_api(p, s), PROVIDER_METRICS, "groq"):
+                has_content = True
+                yield chunk
+            return has_content
+
+        def try_gemini_flow():
+            has_content = False
+            for chunk in measured_stream(stream_gemini_api(p, s), PROVIDER_METRICS, "gemini"):
+                has_content = True
+                yield chunk
+            return has_content
+
+        if not GROQ_KEYS and not GEMINI_KEYS:
+            PROVIDER_METRICS.record_fallback("exhausted")
+            yield MSG_NO_KEYS
+            return
 
-            try:
-                print(f">>> AI 請求 (Prompt: {p[:15]}...)")
-                
-                # Phase 1: Local Ollama
-                if not os.environ.get('RENDER'):
-                    res = call_ollama_api(p, s)
-                    if res and len(res.strip()) > 5: 
-                        yield res
-                        return
-
-                provider = CONFIG.get('gemini', {}).get('provider', 'gemini').lower()
-                
-                def try_groq_flow():
-                    has_content = False
-                    for chunk in stream_groq_api(p, s):
-                        has_content = True
-                        yield chunk
-                    return has_content
-
-                def try_gemini_flow():
-                    has_content = False
-                    for chunk in stream_gemini_api(p, s):
-                        has_content = True
-                        yield chunk
-                    return has_content
-
-                if not GROQ_KEYS and not GEMINI_KEYS:
-                    yield "【天機未啟】系統尚未配置 AI 金鑰。若是部署在雲端，請檢查環境變數 (Environment Variables) 設定。\n"
-                    return
-
-                if provider == 'groq':
-                    print(">>> 優先嘗試 Groq 串流模式...")
-                    if (GROQ_KEYS and (yield from try_groq_flow())):
-                        return
-                    print(">>> Groq 失敗或未配置，嘗試 Gemini 備援...")
-                    if (GEMINI_KEYS and (yield from try_gemini_flow())):
-                        return
-                    yield "【天機中斷】目前 API 服務暫時無法感應，請確認金鑰配額或網路連線。"
-                else:
-                    print(">>> 優先嘗試 Gemini 串流模式...")
-                    if (GEMINI_KEYS and (yield from try_gemini_flow())):
-                        return
-                    print(">>> Gemini 失敗或未配置，嘗試 Groq 備援...")
-                    if (GROQ_KEYS and (yield from try_groq_flow())):
-                        return
-                    yield "【天機中斷】目前 API 服務暫時無法感應，請確認金鑰配額或網路連線。"
-            
-            finally:
-                # 務必釋放許可證，否則會造成死鎖 (Deadlock)
-                AI_LIMIT_SEMAPHORE.release()
-                print(">>> [排隊系統] AI 運算結束，釋放許可證。")
-
-        if is_full and not is_bazi_mode:
-            # 如果規則引擎沒對到什麼，至少也給基本的
-            actual_matched = matched if matched else []
-            yield "【天機分析成功...】宗師正在為您以「紫微斗數」詳批格局...\n\n"
-            titles = {"A": "【第一章：星曜坐守與神煞特徵】", "B": "【第二章：命宮宮干飛化】", "C": "【第三章：宮位間的交互飛化】"}
-            
-            all_chapter_summaries = "" 
-            chapter_sys = "你是【紫微天機道長】，命理宗師。請針對此命盤格局，像是在與老友喝茶聊天一般，給予緣主白話、生動且生活化的命解讀。運用譬喻與現代職場/感情場景，切發「本章節」、「規則」等生硬詞彙，直接點破吉凶。"
+        hedge_cfg = CONFIG.get('hedge', {})
+        if hedge_cfg.get('enable') and GROQ_KEYS and GEMINI_KEYS:
+            racers = [("groq", lambda scope: measured_stream(stream_groq_api(p, s, scope), PROVIDER_METRICS, "groq")),
+                      ("gemini", lambda scope: measured_stream(stream_gemini_api(p, s, scope), PROVIDER_METRICS, "gemini"))]
+            if provider != 'groq': racers.reverse()
+            handoff = threading.Event()
+            racers = [(racers[0][0], hedge_racer(*racers[0], ticket=ticket, started=handoff)), (racers[1][0], hedge_racer(*racers[1]))]
+            delay = hedge_delay(LATENCY[racers[0][0]], hedge_cfg.get('percentile', 95), hedge_cfg.get('default_delay', 3.0),
+                                hedge_cfg.get('min_delay', 0.5), hedge_cfg.get('max_delay', 8.0), hedge_cfg.get('min_samples', 20))
+            print(f">>> 對沖模式：{racers[0][0]} 優先，{delay:.1f}s 無回應即同時啟動 {racers[1][0]}...")
+            winner = yield from hedged_stream(racers, delay)
+            if winner:
+                PROVIDER_METRICS.record_fallback(depth + [name for name, _ in racers].index(winner))
+                return True
+            PROVIDER_METRICS.record_fallback("exhausted")
+            yield MSG_OFFLINE
+            return
 
-            for g_code, g_title in titles.items():
-                items = [r for r in matched if r.get("rule_group") == g_code]
-                if items:
-                    yield f"\n{g_title}\n" + "-"*35 + "\n"
-                    
-                    chapter_content = ""
-                    for r in items[:15]: 
-                        rule_txt = f"● 【{r.get('detected_palace_names','全盤')}】{r.get('description')}：{r.get('text')}"
-                        yield rule_txt + "\n"
-                        chapter_content += rule_txt + "\n"
-                    
-                    yield f"\n💡 大師章節批註：\n"
-                    explain_prompt = f"章節：{g_title}\n包含規則：\n{chapter_content}\n請給予本章節的綜合命理解讀。"
-                    
-                    # Use streaming for chapter explanations too
-                    explanation_accum = ""
-                    for chunk in stream_ai(explain_prompt, chapter_sys):
-                        yield chunk
-                        explanation_accum += chunk
-                    yield "\n\n"
-                    
-                    summary_snapshot = explanation_accum[:250] + "..." if len(explanation_accum) > 250 else explanation_accum
-                    all_chapter_summaries += f"### {g_title} 重點摘要：\n{summary_snapshot}\n\n"
-            
-            if all_chapter_summaries:
-                yield "="*45 + "\n【天機判語 · 命理終極總結】\n"
-                
-                mini_final_sys = "你是【紫微天機道長】，命理宗師。請根據命盤摘要給予緣主最後的人生意義總結（300字）。請用白話、充滿生活智慧的語氣，直接給予具體指引，每遇到句號請換行。語氣要像是一位看透世事但又接地氣的長輩。"
-                final_prompt = f"以下是緣主的命盤章節摘要：\n{all_chapter_summaries}\n\n用戶提問：{user_prompt}\n\n請做最後的總結與建議，每遇到句號請換行。"
-                
-                final_accum = ""
-                for chunk in stream_ai(final_prompt, mini_final_sys):
-                     yield chunk
-                     final_accum += chunk
-            elif not actual_matched:
-                yield "\n【基礎格局開示】\n"
-                for chunk in stream_ai(user_prompt, final_system_prompt):
-                    yield chunk
-            else:
-                yield "無法生成足夠資訊以進行總結。"
-            
-            log_chat("Hybrid-Report-Chapter", user_prompt, "Detailed Ziwei report generated.", user_info)
-        elif is_full and is_bazi_mode:
-            # 針對八字的高級詳評模式：不走紫微章節，直接讓 AI 根據八字心法發揮
-            yield "【天機分析成功...】宗師正在為您以「正統八字」詳批格局...\n\n"
-            full_response = ""
-            for chunk in stream_ai(user_prompt, final_system_prompt):
-                if chunk:
-                    yield chunk
-                    full_response += chunk
-            log_chat("Bazi-Full-Report", user_prompt, "Detailed Bazi report generated.", user_info)
+        if provider == 'groq':
+            print(">>> 優先嘗試 Groq 串流模式...")
+            if (GROQ_KEYS and (yield from try_groq_flow())):
+                PROVIDER_METRICS.record_fallback(depth)
+                return True
+            print(">>> Groq 失敗或未配置，嘗試 Gemini 備援...")
+            if (GEMINI_KEYS and (yield from try_gemini_flow())):
+                PROVIDER_METRICS.record_fallback(depth + bool(GROQ_KEYS))
+                return True
+            PROVIDER_METRICS.record_fallback("exhausted")
+            yield MSG_OFFLINE
         else:
-            # Standard Streaming Chat
-            full_response = ""
+            print(">>> 優先嘗試 Gemini 串流模式...")
+            if (GEMINI_KEYS and (yield from try_gemini_flow())):
+                PROVIDER_METRICS.record_fallback(depth)
+                return True
+            print(">>> Gemini 失敗或未配置，嘗試 Groq 備援...")
+            if (GROQ_KEYS and (yield from try_groq_flow())):
+                PROVIDER_METRICS.record_fallback(depth + bool(GEMINI_KEYS))
+                return True
+            PROVIDER_METRICS.record_fallback("exhausted")
+            yield MSG_OFFLINE
+    
+    finally:
+        # 務必歸還名額，否則後續排隊者將無法取得
+        if handoff is None or not handoff.is_set(): AI_ADMISSION.release(ticket)
+        print(">>> [排隊系統] AI 運算結束，釋放許可證。")
+
+REPORT_CHAPTER_TITLES = {"A": "【第一章：星曜坐守與神煞特徵】", "B": "【第二章：命宮宮干飛化】", "C": "【第三章：宮位間的交互飛化】"}
+CHAPTER_SYS = "你是【紫微天機道長】，命理宗師。請針對此命盤格局，像是在與老友喝茶聊天一般，給予緣主白話、生動且生活化的命解讀。運用譬喻與現代職場/感情場景，切發「本章節」、「規則」等生硬詞彙，直接點破吉凶。"
+SUMMARY_SYS = "你是【紫微天機道長】，命理宗師。請根據命盤摘要給予緣主最後的人生意義總結（300字）。請用白話、充滿生活智慧的語氣，直接給予具體指引，每遇到句號請換行。語氣要像是一位看透世事但又接地氣的長輩。"
+
+def plan_report_chapters(matched):
+    """依規則群組切分命譜章節，回傳 [(標題, 規則列, 已有解讀 [(規則, 解讀)], 需即時批註的提示詞或 None)]。"""
+    chapters = []
+    for g_code, g_title in REPORT_CHAPTER_TITLES.items():
+        items = [r for r in matched if r.get("rule_group") == g_code]
+        if not items: continue
+        rule_lines = [f"● 【{r.get('detected_palace_names','全盤')}】{r.get('description')}：{r.get('text')}\n" for r in items[:15]]
+        known, live = RULE_EXPLANATIONS.split(items[:15])
+        explain_prompt = None
+        if live:
+            live_lines = [f"● 【{r.get('detected_palace_names','全盤')}】{r.get('description')}：{r.get('text')}\n" for r in live]
+            explain_prompt = f"章節：{g_title}\n包含規則：\n{''.join(live_lines)}\n請給予本章節的綜合命理解讀。"
+        chapters.append((g_title, rule_lines, known, explain_prompt))
+    return chapters
+
+def build_summary_prompt(snapshots, user_prompt):
+    all_chapter_summaries = "".join(f"### {t} 重點摘要：\n{text}\n\n" for t, text in snapshots)
+    return f"以下是緣主的命盤章節摘要：\n{all_chapter_summaries}\n\n用戶提問：{user_prompt}\n\n請做最後的總結與建議，每遇到句號請換行。"
+
+def chat_log_model(ctx):
+    """對話紀錄中的模型/功能名稱。"""
+    if ctx["is_full"]:
+        return "Bazi-Full-Report" if ctx["is_bazi_mode"] else "Hybrid-Report-Chapter"
+    return ctx["data"].get("model", "Hybrid-Stream")
+
+def stream_chat_response(ctx):
+    """串流回應並側錄完整內容 (含整份命譜)，結束後寫入對話紀錄。"""
+    capture = StreamCapture(CAPTURE_MAX_CHARS, skip=(StatusText,))
+    yield from capture.tee(generate_chat_response(ctx))
+    log_chat(chat_log_model(ctx), ctx["user_prompt"], capture.text(), ctx["user_info"])
+
+def generate_chat_response(ctx):
+    """依對話情境串流回應 (紫微命譜分章並行 / 八字詳評 / 一般對話)。"""
+    user_prompt = ctx["user_prompt"]
+    matched = ctx["matched"]
+    is_full = ctx["is_full"]
+    is_bazi_mode = ctx["is_bazi_mode"]
+    final_system_prompt = ctx["final_system_prompt"]
+
+    if is_full and not is_bazi_mode:
+        # 如果規則引擎沒對到什麼，至少也給基本的
+        actual_matched = matched if matched else []
+        yield "【天機分析成功...】宗師正在為您以「紫微斗數」詳批格局...\n\n"
+
+        # 三章批註同時啟動 (各自經准入排隊，優先權低於一般對話)；第一章即時轉送並回報排隊名次，其餘先行緩衝
+        def chapter_flow(known, explain_prompt, feedback, cancel):
+            # 已預先生成解讀的規則立即送出，其餘規則才即時請 AI 批註
+            for r, exp in known:
+                yield f"◆ {r.get('description')}：{exp}\n"
+            if explain_prompt:
+                if known: yield "\n"
+                # 章節批註只含規則文字 (不含個人提問)，相同規則組合可直接重用快取
+                yield from cached_stream(("chapter_sys",), explain_prompt, lambda: stream_ai(explain_prompt, CHAPTER_SYS, PRIORITY_REPORT, feedback=feedback, cancel=cancel))
+
+        chapters = []
+        for g_title, rule_lines, known, explain_prompt in plan_report_chapters(matched):
+            stream = BackgroundStream(lambda cancel, k=known, p=explain_prompt, fb=not chapters: chapter_flow(k, p, fb, cancel), SUMMARY_SNAPSHOT_CHARS)
+            chapters.append((g_title, rule_lines, stream))
+
+        def summary_flow(cancel):
+            # 各章累積到足以截取摘要 (或已結束) 即開始總結，不必等全部章節寫完
+            for _, _, ch in chapters: ch.snapshot_ready.wait()
+            if any(ch.cancelled for _, _, ch in chapters): return
+            final_prompt = build_summary_prompt([(t, ch.snapshot()) for t, _, ch in chapters], user_prompt)
+            yield from stream_ai(final_prompt, SUMMARY_SYS, PRIORITY_REPORT, feedback=False, cancel=cancel)
+
+        summary = BackgroundStream(summary_flow) if chapters else None
+        try:
+            for g_title, rule_lines, ch in chapters:
+                yield f"\n{g_title}\n" + "-"*35 + "\n"
+                for line in rule_lines:
+                    yield line
+                yield f"\n💡 大師章節批註：\n"
+                yield from ch
+                yield "\n\n"
+
+            if summary:
+                yield "="*45 + "\n【天機判語 · 命理終極總結】\n"
+                yield from summary
+        finally:
+            # 緣主中途離線時，停止仍在背景生成的章節
+            for _, _, ch in chapters: ch.cancel()
+            if summary: summary.cancel()
+
+        if not chapters and not actual_matched:
+            yield "\n【基礎格局開示】\n"
             for chunk in stream_ai(user_prompt, final_system_prompt):
-                if chunk:
-                    yield chunk
-                    full_response += chunk
-            
-            log_chat(data.get("model", "Hybrid-Stream"), user_prompt, full_response, user_info)
+                yield chunk
+        elif not chapters:
+            yield "無法生成足夠資訊以進行總結。"
+    elif is_full and is_bazi_mode:
+        # 針對八字的高級詳評模式：不走紫微章節，直接讓 AI 根據八字心法發揮
+        yield "【天機分析成功...】宗師正在為您以「正統八字」詳批格局...\n\n"
+        for chunk in stream_ai(user_prompt, final_system_prompt):
+            if chunk: yield chunk
+    else:
+        # Standard Streaming Chat
+        for chunk in stream_ai(user_prompt, final_system_prompt):
+            if chunk: yield chunk
+
+# --- SSE 串流 (可續傳) ---
+SSE_CFG = CONFIG.get('sse', {})
+GENERATIONS = GenerationStore(SSE_CFG.get('buffer_ttl', 300), SSE_CFG.get('max_buffers', 200))
+SSE_RESUME_PATH = '/api/chat/events'
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def wants_sse(accept, mode):
+    return 'text/event-stream' in (accept or '') or mode == 'sse'
+
+def sse_response(buf, start=0, meta=False):
+    def events():
+        if meta: yield meta_event(buf, SSE_RESUME_PATH)
+        yield from sse_events(buf, start, SSE_CFG.get('heartbeat', 15), StatusText)
+    return Response(events(), content_type='text/event-stream; charset=utf-8', headers=SSE_HEADERS)
+
+def resume_sse(gen_id, start):
+    """自序號 start 起續讀既有生成；緩衝已過期回傳 410，由用戶端重新發問。"""
+    buf = GENERATIONS.get(gen_id) if gen_id else None
+    if buf is None:
+        return jsonify({"error": "generation expired", "message": "此次解析已過期，請重新發問。"}), 410
+    print(f">>> [SSE] 續傳生成 {buf.id[:8]}，自第 {start} 段起。")
+    return sse_response(buf, start)
+
+@app.route('/api/chat', methods=['POST', 'OPTIONS'])
+def chat():
+    if request.method == 'OPTIONS':
+        resp = make_response(); resp.headers.add("Access-Control-Allow-Origin", "*"); resp.headers.add("Access-Control-Allow-Headers", "*"); return resp
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id:
+        return resume_sse(*parse_event_id(last_event_id))
+
+    data = request.json or {}
+    user_ip = request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0].strip()
+    user_agent = request.headers.get('User-Agent', '')
 
+    def generate():
+        print(f">>> [命譜詳評啟動] 緣主: {data.get('name', 'Unknown')}")
+        
+        # 1. 解析命盤規則 (保持非阻塞，但訊息簡約化)
+        yield "【大師解析中，請稍候...】\n\n"
+        ctx = prepare_chat_context(data, user_ip, user_agent)
+        yield from stream_chat_response(ctx)
+
+    if wants_sse(request.headers.get('Accept'), request.args.get('stream') or data.get('stream')):
+        # SSE 模式：生成於背景寫入緩衝，與本次連線脫鉤
+        return sse_response(GENERATIONS.start(generate), meta=True)
     return Response(stream_with_context(generate()), content_type='text/plain; charset=utf-8')
 
+@app.route('/api/chat/events/<gen_id>')
+def chat_events(gen_id):
+    """EventSource 重連端點：自 Last-Event-ID (或 ?from=序號) 之後續傳。"""
+    event_gen, start = parse_event_id(request.headers.get('Last-Event-ID'))
+    if event_gen != gen_id:
+        start = int(request.args['from']) if request.args.get('from', '').isdigit() else 0
+    return resume_sse(gen_id, start)
+
 @app.route('/api/tts', methods=['POST', 'OPTIONS'])
 def tts_handler():
     if request.method == 'OPTIONS':
@@ -0,0 +1,527 @@
+"""
+紫微天機：非同步對話串流 (ASGI)
+================================
+/api/chat 的每個串流回應往往橫跨 1~4 次 AI 呼叫 (30 秒以上)，在 Flask/gunicorn 下會全程佔住一條工作執行緒。
+本模組以 asyncio 改寫對話串流核心：排隊、金鑰冷卻與等待 AI 首段輸出都只是暫停中的協程，
+大量緣主同時等候時只耗用協程而非執行緒。其餘路徑 (管理後台、股票、TTS 等) 原封不動交給 app.py 的 Flask app。
+
+- 命盤解析 (prepare_chat_context) 與對話紀錄 (log_chat) 含同步 I/O，交由 asyncio.to_thread 執行。
+- 金鑰排程、排隊准入、斷路器、回應快取與延遲統計皆與 Flask 路徑共用同一組實例。
+- 命譜詳評三章以 asyncio task 並行生成，總結於各章摘要足量後即開始。
+
+用法：
+    uvicorn asgi_chat:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs
+
+import httpx
+from groq import AsyncGroq
+from google import genai
+
+import app as core
+from admission import PRIORITY_CHAT, PRIORITY_REPORT
+from key_scheduler import extract_retry_after
+from provider_metrics import ameasured_stream
+from sse_stream import parse_event_id, meta_event, asse_events
+from stream_capture import StreamCapture
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*"), (b"access-control-allow-headers", b"*")]
+
+# --- Admission Wakeup (排隊通知) ---
+class AsyncWakeup:
+    """讓協程等候其他執行緒的通知：notify() 可於任何執行緒呼叫，以 call_soon_threadsafe 設定各等候者的 asyncio.Event。"""
+    def __init__(self):
+        self._waiters = set()
+        self._lock = threading.Lock()
+
+    def register(self):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock: self._waiters.add(waiter)
+        return waiter
+
+    def unregister(self, waiter):
+        with self._lock: self._waiters.discard(waiter)
+
+    def notify(self):
+        with self._lock: waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # 事件迴圈已關閉
+
+ADMISSION_WAKEUP = AsyncWakeup()
+
+def watch_admission(controller):
+    """讓排隊中的協程在名額釋放 / 佇列變動時立即醒來 (取代定時輪詢)。"""
+    if ADMISSION_WAKEUP.notify not in controller.listeners:
+        controller.listeners.append(ADMISSION_WAKEUP.notify)
+
+watch_admission(core.AI_ADMISSION)
+
+# --- Async Provider Registry ---
+class AsyncProviders:
+    """每個 (供應商, 金鑰) 只建立一次非同步 client；健康狀態仍記入 core.PROVIDERS。"""
+    def __init__(self):
+        self._clients = {}
+
+    def get(self, provider, key=""):
+        ident = (provider, key)
+        client = self._clients.get(ident)
+        if client is None:
+            if provider == "groq":
+                client = AsyncGroq(api_key=key, max_retries=0) # 429 重試交由金鑰排程處理
+            elif provider == "gemini":
+                client = genai.Client(api_key=key).aio
+            elif provider == "ollama":
+                pool = core.CONFIG.get('ollama', {}).get('pool_maxsize', 16)
+                client = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool, max_keepalive_connections=pool))
+            else:
+                raise ValueError(f"未知的 AI 供應商: {provider}")
+            self._clients[ident] = client
+        return client
+
+    def discard(self, provider, key):
+        self._clients.pop((provider, key), None)
+
+    async def aclose(self):
+        for client in self._clients.values():
+            close = getattr(client, "aclose", None) or getattr(client, "close", None)
+            if close is None: continue
+            try:
+                result = close()
+                if asyncio.iscoroutine(result): await result
+            except Exception:
+                pass
+        self._clients.clear()
+
+ASYNC_PROVIDERS = AsyncProviders()
+
+# --- Async AI Engine Callers ---
+async def acquire_key(scheduler, tried):
+    """非阻塞版 KeyScheduler.acquire：全部冷卻中時 asyncio.sleep 到最快可用的時間點，最多等 KEY_MAX_WAIT 秒。"""
+    deadline = time.time() + core.KEY_MAX_WAIT
+    while True:
+        key, wait = scheduler.try_acquire(exclude=tried)
+        if key: return key
+        if wait is None or time.time() + wait > deadline: return None
+        await asyncio.sleep(wait)
+
+def handle_key_error(name, scheduler, key, e):
+    """依錯誤類型更新金鑰狀態 (限流冷卻 / 失效移除 / 一般錯誤)，與同步版規則一致。"""
+    err_str = str(e)
+    core.PROVIDERS.report(name, key, False, e)
+    core.PROVIDER_METRICS.record_error(name, e)
+    if "429" in err_str or "RESOURCE_EXHAUSTED" in err_str:
+        scheduler.on_throttle(key, extract_retry_after(e))
+        print(f">>> {name} API (Key: {key[:10]}...) 繁忙/限流，進入冷卻並嘗試備援金鑰...")
+    elif "401" in err_str or "Invalid API Key" in err_str or "API_KEY_INVALID" in err_str:
+        if scheduler.invalidate(key):
+            print(f"❌ {name} API 金鑰失效 ({key[:10]}...)，已從清單移除。")
+            core.PROVIDERS.discard(name, key)
+            ASYNC_PROVIDERS.discard(name, key)
+    else:
+        scheduler.on_error(key)
+        print(f"{name} API 錯誤 ({key[:10]}...): {e}")
+
+async def astream_ollama_api(prompt, system_prompt=""):
+    if not core.ollama_enabled() or not core.OLLAMA_BREAKER.allow(): return
+
+    ollama_cfg = core.CONFIG.get('ollama', {})
+    url = ollama_cfg.get('url', "http://127.0.0.1:11434/api/generate")
+    payload = {
+        "model": ollama_cfg.get('model', "gemma2:2b"),
+        "prompt": prompt,
+        "system": system_prompt,
+        "stream": True,
+        "options": {"num_ctx": 4096, "temperature": 0.7}
+    }
+    timeout = httpx.Timeout(ollama_cfg.get('timeout', 10), connect=ollama_cfg.get('connect_timeout', 2))
+    try:
+        async with ASYNC_PROVIDERS.get("ollama").stream("POST", url, json=payload, timeout=timeout) as res:
+            if res.status_code != 200:
+                raise httpx.HTTPStatusError(f"HTTP {res.status_code}", request=res.request, response=res)
+            async for line in res.aiter_lines():
+                if not line: continue
+                data = json.loads(line)
+                if data.get("error"): raise RuntimeError(data["error"])
+                if data.get("response"): yield data["response"]
+                if data.get("done"): break
+        core.PROVIDERS.report("ollama", "", True)
+        core.OLLAMA_BREAKER.record_success()
+    except Exception as e:
+        core.PROVIDERS.report("ollama", "", False, e)
+        core.PROVIDER_METRICS.record_error("ollama", e)
+        core.OLLAMA_BREAKER.record_failure()
+        if core.CONFIG['server'].get('debug'): print(f"Ollama API 離線: {e}")
+
+async def astream_groq_api(prompt, system_prompt=""):
+    tried = set()
+    while True:
+        key = await acquire_key(core.GROQ_SCHEDULER, tried)
+        if not key: return
+        tried.add(key)
+        try:
+            completion = await ASYNC_PROVIDERS.get("groq", key).chat.completions.create(
+                model=core.GROQ_MODEL,
+                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}],
+                temperature=0.7, max_tokens=3000, stream=True
+            )
+            async for chunk in completion:
+                content = chunk.choices[0].delta.content
+                if content: yield content
+            core.PROVIDERS.report("groq", key, True)
+            core.GROQ_SCHEDULER.on_success(key)
+            return
+        except Exception as e:
+            handle_key_error("groq", core.GROQ_SCHEDULER, key, e)
+
+async def astream_gemini_api(prompt, system_prompt=""):
+    tried = set()
+    while True:
+        key = await acquire_key(core.GEMINI_SCHEDULER, tried)
+        if not key: return
+        tried.add(key)
+        try:
+            model = core.GEMINI_MODEL
+            if "flash" in model and "1.5" in model: model = "gemini-1.5-flash-latest"
+            response = await ASYNC_PROVIDERS.get("gemini", key).models.generate_content_stream(
+                model=model,
+                contents=f"{system_prompt}\n\n{prompt}"
+            )
+            async for chunk in response:
+                if chunk.text: yield chunk.text
+            core.PROVIDERS.report("gemini", key, True)
+            core.GEMINI_SCHEDULER.on_success(key)
+            return
+        except Exception as e:
+            handle_key_error("gemini", core.GEMINI_SCHEDULER, key, e)
+
+ASYNC_CALLERS = {"ollama": astream_ollama_api, "groq": astream_groq_api, "gemini": astream_gemini_api}
+
+async def astream_ai(p, s, priority=PRIORITY_CHAT, feedback=True, outcome=None):
+    """
+    stream_ai 的協程版：排隊期間等候 AdmissionController 的佇列變動通知，核准後依「分配供應商 → 其餘雲端」順序串流。
+    async 產生器無法回傳值，成功生成時改以 outcome["ok"] = True 告知呼叫端 (供回應快取判斷)。
+    對沖請求 (hedge) 僅在同步路徑提供；此處依序備援。
+    """
+    _, order = core.ai_provider_order()
+    if not order:
+        yield core.MSG_NO_KEYS
+        return
+
+    ticket = core.AI_ADMISSION.submit(order, priority)
+    if ticket is None:
+        print(">>> [排隊系統] 排隊人數已滿，拒絕新請求。")
+        yield core.MSG_BUSY
+        return
+
+    waiter = ADMISSION_WAKEUP.register()
+    try:
+        max_wait = core.admission_max_wait(priority)
+        deadline = time.time() + max_wait
+        last_pos = None
+        while True:
+            waiter[1].clear()  # 先清除再檢查，檢查後才發生的變動仍會喚醒下方的等候
+            if ticket.provider is not None: break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if core.AI_ADMISSION.expire(ticket):
+                    print(f">>> [排隊系統] 排隊超過 {max_wait} 秒，放棄請求。")
+                    yield core.MSG_BUSY
+                    return
+                continue  # 逾時前一刻已核准
+            pos = core.AI_ADMISSION.position(ticket)
+            if feedback and pos and pos != last_pos:
+                yield core.StatusText(f"⏳【天機排隊】目前求問人數眾多，您排在第 {pos} 位，請稍候...\n")
+                last_pos = pos
+            try:
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        ADMISSION_WAKEUP.unregister(waiter)  # 已核准：串流期間不再需要通知
+
+        core.PROVIDER_METRICS.record_queue_wait(ticket.granted_at - ticket.enqueued_at)
+        print(f">>> AI 請求 (Prompt: {p[:15]}..., 分配: {ticket.provider}, async)")
+        # 分配到的供應商為主力，其餘雲端供應商依偏好順序備援
+        cloud = [name for name in order if name not in ("ollama", ticket.provider)]
+        candidates = [ticket.provider] + cloud
+        for depth, name in enumerate(candidates):
+            has_content = False
+            async for chunk in ameasured_stream(ASYNC_CALLERS[name](p, s), core.PROVIDER_METRICS, name):
+                has_content = True
+                yield chunk
+            if has_content:
+                core.PROVIDER_METRICS.record_fallback(depth)
+                if outcome is not None: outcome["ok"] = True
+                return
+            if name != "ollama": print(f">>> {name} 失敗或未配置，嘗試備援...")
+        core.PROVIDER_METRICS.record_fallback("exhausted")
+        yield core.MSG_OFFLINE if len(candidates) > 1 or ticket.provider != "ollama" else core.MSG_NO_KEYS
+    finally:
+        # 串流被取消 (緣主離線) 時也會執行，務必歸還名額
+        ADMISSION_WAKEUP.unregister(waiter)
+        core.AI_ADMISSION.release(ticket)
+        print(">>> [排隊系統] AI 運算結束，釋放許可證。")
+
+async def acached_stream(block_ids, prompt, agen_factory):
+    """cached_stream 的協程版：agen_factory(outcome) 成功時設定 outcome["ok"]，才寫入快取。"""
+    model = core.CONFIG['gemini'].get('model', '')
+    outcome = {}
+    if not core.RESPONSE_CACHE_CFG.get('enable', True):
+        async for chunk in agen_factory(outcome): yield chunk
+        return
+    text = core.RESPONSE_CACHE.get(block_ids, prompt, model)
+    if text is not None:
+        print(f">>> [回應快取] 命中 ({'/'.join(block_ids)})，直接重播。")
+        for chunk in core.ResponseCache.replay(text): yield chunk
+        return
+    parts = []
+    async for chunk in agen_factory(outcome):
+        if not isinstance(chunk, core.StatusText): parts.append(chunk)
+        yield chunk
+    if outcome.get("ok"): core.RESPONSE_CACHE.put(block_ids, prompt, model, "".join(parts))
+
+# --- Report Orchestration (章節並行生成) ---
+class TaskStream:
+    """BackgroundStream 的協程版：以 asyncio task 消費串流，可即時轉送，亦可在累積足量後截取摘要。"""
+    def __init__(self, agen_factory, snapshot_chars=core.SUMMARY_SNAPSHOT_CHARS):
+        self.chunks = []
+        self.snapshot_chars = snapshot_chars
+        self.snapshot_ready = asyncio.Event()
+        self._queue = asyncio.Queue()
+        self._size = 0
+        self.task = asyncio.ensure_future(self._run(agen_factory))
+
+    async def _run(self, agen_factory):
+        try:
+            async for chunk in agen_factory():
+                self._queue.put_nowait(chunk)
+                if isinstance(chunk, core.StatusText): continue
+                self.chunks.append(chunk)
+                self._size += len(chunk)
+                if self._size > self.snapshot_chars: self.snapshot_ready.set()
+        except Exception as e:
+            print(f"⚠️ [報告生成] 背景章節錯誤: {e}")
+        finally:
+            self.snapshot_ready.set()
+            self._queue.put_nowait(None)
+
+    async def stream(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None: return
+            yield chunk
+
+    def snapshot(self):
+        text = "".join(self.chunks)
+        return text[:self.snapshot_chars] + "..." if len(text) > self.snapshot_chars else text
+
+    def cancel(self):
+        self.task.cancel()
+
+async def achat_response(ctx):
+    """stream_chat_response 的協程版：串流回應並側錄完整內容，結束後寫入對話紀錄。"""
+    capture = StreamCapture(core.CAPTURE_MAX_CHARS, skip=(core.StatusText,))
+    async for chunk in capture.atee(agenerate_response(ctx)): yield chunk
+    await asyncio.to_thread(core.log_chat, core.chat_log_model(ctx), ctx["user_prompt"], capture.text(), ctx["user_info"])
+
+async def agenerate_response(ctx):
+    """generate_chat_response 的協程版 (紫微命譜分章並行 / 八字詳評 / 一般對話)。"""
+    user_prompt = ctx["user_prompt"]
+    final_system_prompt = ctx["final_system_prompt"]
+
+    if ctx["is_full"] and not ctx["is_bazi_mode"]:
+        yield "【天機分析成功...】宗師正在為您以「紫微斗數」詳批格局...\n\n"
+
+        async def chapter_flow(known, explain_prompt, feedback):
+            for r, exp in known:
+                yield f"◆ {r.get('description')}：{exp}\n"
+            if explain_prompt:
+                if known: yield "\n"
+                async for chunk in acached_stream(("chapter_sys",), explain_prompt,
+                                                  lambda outcome: astream_ai(explain_prompt, core.CHAPTER_SYS, PRIORITY_REPORT, feedback, outcome)):
+                    yield chunk
+
+        chapters = []
+        for g_title, rule_lines, known, explain_prompt in core.plan_report_chapters(ctx["matched"]):
+            stream = TaskStream(lambda k=known, p=explain_prompt, fb=not chapters: chapter_flow(k, p, fb))
+            chapters.append((g_title, rule_lines, stream))
+
+        async def summary_flow():
+            for _, _, ch in chapters: await ch.snapshot_ready.wait()
+            final_prompt = core.build_summary_prompt([(t, ch.snapshot()) for t, _, ch in chapters], user_prompt)
+            async for chunk in astream_ai(final_prompt, core.SUMMARY_SYS, PRIORITY_REPORT, feedback=False):
+                yield chunk
+
+        summary = TaskStream(summary_flow) if chapters else None
+        try:
+            for g_title, rule_lines, ch in chapters:
+                yield f"\n{g_title}\n" + "-"*35 + "\n"
+                for line in rule_lines:
+                    yield line
+                yield f"\n💡 大師章節批註：\n"
+                async for chunk in ch.stream(): yield chunk
+                yield "\n\n"
+
+            if summary:
+                yield "="*45 + "\n【天機判語 · 命理終極總結】\n"
+                async for chunk in summary.stream(): yield chunk
+        finally:
+            # 緣主中途離線時，取消仍在生成的章節
+            for _, _, ch in chapters: ch.cancel()
+            if summary: summary.cancel()
+
+        if not chapters and not ctx["matched"]:
+            yield "\n【基礎格局開示】\n"
+            async for chunk in astream_ai(user_prompt, final_system_prompt): yield chunk
+        elif not chapters:
+            yield "無法生成足夠資訊以進行總結。"
+        return
+
+    if ctx["is_full"]:
+        yield "【天機分析成功...】宗師正在為您以「正統八字」詳批格局...\n\n"
+    async for chunk in astream_ai(user_prompt, final_system_prompt):
+        if chunk: yield chunk
+
+async def agenerate(data, user_ip, user_agent):
+    print(f">>> [命譜詳評啟動] 緣主: {data.get('name', 'Unknown')} (async)")
+    yield "【大師解析中，請稍候...】\n\n"
+    ctx = await asyncio.to_thread(core.prepare_chat_context, data, user_ip, user_agent)
+    async for chunk in achat_response(ctx): yield chunk
+
+# --- ASGI Application ---
+def header(scope, name):
+    for k, v in scope.get("headers", []):
+        if k == name: return v.decode('latin-1')
+    return ""
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect": return None
+        body += message.get("body", b"")
+        if not message.get("more_body"): return body
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+def query_param(scope, name):
+    return parse_qs(scope.get("query_string", b"").decode('latin-1')).get(name, [""])[0]
+
+async def send_json(send, status, payload):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json")] + CORS_HEADERS[:1]})
+    await send({"type": "http.response.body", "body": json.dumps(payload, ensure_ascii=False).encode('utf-8')})
+
+async def send_stream(receive, send, agen, content_type, extra_headers=()):
+    """逐段送出 agen 的輸出；用戶端離線即取消 agen。"""
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", content_type)] + CORS_HEADERS[:1] + list(extra_headers)})
+
+    async def pump():
+        async for chunk in agen:
+            await send({"type": "http.response.body", "body": chunk.encode('utf-8'), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    stream_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait({stream_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (stream_task, disconnect_task):
+            if not task.done(): task.cancel()
+        if stream_task.done() and not stream_task.cancelled() and stream_task.exception():
+            print(f"⚠️ [非同步串流] 錯誤: {stream_task.exception()}")
+
+SSE_HEADERS = [(k.lower().encode(), v.encode()) for k, v in core.SSE_HEADERS.items()]
+
+async def send_sse(receive, send, buf, start=0, meta=False):
+    async def events():
+        if meta: yield meta_event(buf, core.SSE_RESUME_PATH)
+        async for event in asse_events(buf, start, core.SSE_CFG.get('heartbeat', 15), core.StatusText):
+            yield event
+    await send_stream(receive, send, events(), b"text/event-stream; charset=utf-8", SSE_HEADERS)
+
+async def resume_sse(receive, send, gen_id, start):
+    buf = core.GENERATIONS.get(gen_id) if gen_id else None
+    if buf is None:
+        return await send_json(send, 410, {"error": "generation expired", "message": "此次解析已過期，請重新發問。"})
+    print(f">>> [SSE] 續傳生成 {buf.id[:8]}，自第 {start} 段起。")
+    await send_sse(receive, send, buf, start)
+
+async def chat_events_endpoint(scope, receive, send):
+    """EventSource 重連端點：自 Last-Event-ID (或 ?from=序號) 之後續傳。"""
+    gen_id = scope["path"][len(core.SSE_RESUME_PATH) + 1:]
+    event_gen, start = parse_event_id(header(scope, b"last-event-id"))
+    if event_gen != gen_id:
+        start = int(query_param(scope, "from")) if query_param(scope, "from").isdigit() else 0
+    await resume_sse(receive, send, gen_id, start)
+
+async def chat_endpoint(scope, receive, send):
+    if scope["method"] == "OPTIONS":
+        await send({"type": "http.response.start", "status": 200, "headers": CORS_HEADERS})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    last_event_id = header(scope, b"last-event-id") or query_param(scope, "last_event_id")
+    if last_event_id:
+        return await resume_sse(receive, send, *parse_event_id(last_event_id))
+
+    body = await read_body(receive)
+    if body is None: return
+    try:
+        data = json.loads(body or b"{}") or {}
+    except ValueError:
+        data = {}
+    client = scope.get("client") or ("", 0)
+    user_ip = (header(scope, b"x-forwarded-for") or client[0]).split(',')[0].strip()
+    user_agent = header(scope, b"user-agent")
+
+    if core.wants_sse(header(scope, b"accept"), query_param(scope, "stream") or data.get("stream")):
+        # SSE 模式：生成以獨立 task 寫入緩衝，連線中斷只停止轉送
+        buf = core.GENERATIONS.astart(lambda: agenerate(data, user_ip, user_agent))
+        return await send_sse(receive, send, buf, meta=True)
+    # 緣主中途離線即取消串流 (連帶釋放排隊名額與背景章節)
+    await send_stream(receive, send, agenerate(data, user_ip, user_agent), b"text/plain; charset=utf-8")
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await ASYNC_PROVIDERS.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+def make_wsgi_fallback():
+    from a2wsgi import WSGIMiddleware
+    return WSGIMiddleware(core.app)
+
+WSGI_FALLBACK = None
+
+async def application(scope, receive, send):
+    global WSGI_FALLBACK
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/api/chat":
+        return await chat_endpoint(scope, receive, send)
+    if scope["type"] == "http" and scope["path"].startswith(core.SSE_RESUME_PATH + "/"):
+        return await chat_events_endpoint(scope, receive, send)
+    # 其他路徑沿用 Flask 路由 (於執行緒池中執行)
+    if WSGI_FALLBACK is None: WSGI_FALLBACK = make_wsgi_fallback()
+    await WSGI_FALLBACK(scope, receive, send)
+
+if __name__ == "__main__":
+    import uvicorn
+    server_cfg = core.CONFIG.get('server', {})
+    uvicorn.run(application, host=server_cfg.get('host', '0.0.0.0'), port=int(os.environ.get("PORT", server_cfg.get('port', 5000))))
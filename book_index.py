@@ -0,0 +1,99 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+# --- Tokenization (中文字元 bigram + 英數單字) ---
+
+_CJK_RUN = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+')
+_WORD = re.compile(r'[A-Za-z0-9]{2,}')
+
+def cjk_bigrams(text):
+    """將文字切成中文 bigram (單字詞保留 unigram) 與小寫英數單字。"""
+    tokens = []
+    if not text: return tokens
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(w.lower() for w in _WORD.findall(text))
+    return tokens
+
+
+# --- Section Splitting ---
+
+_HEADER = re.compile(r'^【[^】]+】\s*$')
+
+def split_sections(book, max_chars=300):
+    """依【標題】切分章節，章節內再依行聚成不超過 max_chars 的段落。回傳 [(標題, 段落內文)]。"""
+    passages = []
+    title = ""
+    buf = []
+    size = 0
+
+    def flush():
+        nonlocal buf, size
+        if buf:
+            passages.append((title, "\n".join(buf)))
+        buf, size = [], 0
+
+    for raw in book.split("\n"):
+        line = raw.strip()
+        if not line: continue
+        if _HEADER.match(line):
+            flush()
+            title = line
+            continue
+        if buf and size + len(line) > max_chars:
+            flush()
+        buf.append(line)
+        size += len(line)
+    flush()
+    return passages
+
+
+# --- BM25 Index ---
+
+class BookIndex:
+    """秘卷段落的 BM25 倒排索引 (純本地、無外部服務)。"""
+
+    def __init__(self, book, max_chars=300, k1=1.5, b=0.75):
+        self.passages = split_sections(book, max_chars)
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list) # term -> [(doc_idx, tf)]
+        self.doc_len = []
+        for idx, (title, body) in enumerate(self.passages):
+            tf = Counter(cjk_bigrams(f"{title}\n{body}"))
+            self.doc_len.append(sum(tf.values()))
+            for term, cnt in tf.items():
+                self.postings[term].append((idx, cnt))
+        n = len(self.passages) or 1
+        self.avgdl = (sum(self.doc_len) / n) if self.doc_len else 1.0
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+
+    def search(self, query, k=5):
+        """回傳分數最高的 k 個段落 [(score, idx)]。"""
+        scores = defaultdict(float)
+        for term in set(cjk_bigrams(query)):
+            plist = self.postings.get(term)
+            if not plist: continue
+            idf = self.idf[term]
+            for idx, tf in plist:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[idx] / self.avgdl)
+                scores[idx] += idf * tf * (self.k1 + 1) / norm
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:k]
+        return [(score, idx) for idx, score in ranked]
+
+    def retrieve(self, query, k=5):
+        """取出前 k 段並依原書順序排列，同章節段落合併於同一標題下。"""
+        hits = sorted(idx for _, idx in self.search(query, k))
+        out = []
+        last_title = None
+        for idx in hits:
+            title, body = self.passages[idx]
+            if title != last_title:
+                if title: out.append(title)
+                last_title = title
+            out.append(body)
+        return "\n".join(out)
@@ -0,0 +1,138 @@
+"""
+紫微斗數：規則解讀離線預生成 (Rule Explanation Builder)
+=====================================================
+為 ziwei_rules.json 的每條規則預先生成一段 50-80 字的白話解讀，存入 ziwei_rule_explanations.json。
+規則文字不會變動，報告流程 (app.py 章節批註、server_headless.py 大師解讀) 即可直接串流已收錄的解讀，
+只有尚未收錄的規則 id 才需即時呼叫 AI。
+
+- 可中斷續跑：已收錄的規則 id 一律略過，每批完成即寫檔。
+- 依金鑰節流：每把金鑰以 KeyScheduler 令牌桶控速，遇 429 依 retry-after 冷卻後換金鑰重試。
+
+用法：
+    python build_rule_explanations.py                      # 補齊所有未收錄的規則
+    python build_rule_explanations.py --limit 50           # 只處理 50 條 (分次執行)
+    python build_rule_explanations.py --provider groq --rpm 20 --batch-size 15
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from key_scheduler import KeyScheduler, extract_retry_after
+from rule_explanations import RULE_EXPLANATIONS_FILE, BATCH_SYSTEM_PROMPT, load_explanations, save_explanations, build_batch_prompt, split_numbered
+
+RULE_FILE = "ziwei_rules.json"
+CONFIG_FILE = "config.json"
+MAX_ATTEMPTS = 6
+
+def load_config():
+    if not os.path.exists(CONFIG_FILE): return {}
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def get_keys(config, env_name, config_key):
+    val = os.environ.get(env_name) or os.environ.get("AI_API_KEY") or config.get('gemini', {}).get(config_key, "")
+    if isinstance(val, list): return val
+    raw_keys = str(val or "").replace("\n", ",").replace(" ", ",").split(",")
+    return [k.strip() for k in raw_keys if k.strip() and len(k.strip()) > 10]
+
+class Generator:
+    """以單一供應商的金鑰池生成批次解讀 (每把金鑰的 client 只建立一次)。"""
+    def __init__(self, provider, keys, model, rpm):
+        self.provider = provider
+        self.model = model
+        self.scheduler = KeyScheduler(provider, keys, rate_per_min=rpm, burst=1)
+        self.clients = {}
+
+    def client(self, key):
+        if key not in self.clients:
+            if self.provider == "groq":
+                from groq import Groq
+                self.clients[key] = Groq(api_key=key, max_retries=0)
+            else:
+                from google import genai
+                self.clients[key] = genai.Client(api_key=key)
+        return self.clients[key]
+
+    def call(self, key, prompt):
+        client = self.client(key)
+        if self.provider == "groq":
+            completion = client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "system", "content": BATCH_SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+                temperature=0.5, max_tokens=4000
+            )
+            return completion.choices[0].message.content
+        response = client.models.generate_content(model=self.model, contents=f"{BATCH_SYSTEM_PROMPT}\n\n{prompt}")
+        return response.text
+
+    def generate(self, prompt):
+        for _ in range(MAX_ATTEMPTS):
+            key = self.scheduler.acquire(max_wait=600)
+            if not key:
+                print("❌ 沒有可用的金鑰 (全數失效或冷卻過久)。")
+                return None
+            try:
+                text = self.call(key, prompt)
+                self.scheduler.on_success(key)
+                return text
+            except Exception as e:
+                err_str = str(e)
+                if "429" in err_str or "RESOURCE_EXHAUSTED" in err_str:
+                    self.scheduler.on_throttle(key, extract_retry_after(e))
+                    print(f"⏳ 金鑰 {key[:10]}... 限流，冷卻後重試。")
+                elif "401" in err_str or "Invalid API Key" in err_str or "API_KEY_INVALID" in err_str:
+                    self.scheduler.invalidate(key)
+                    print(f"❌ 金鑰 {key[:10]}... 失效，已移除。")
+                else:
+                    self.scheduler.on_error(key)
+                    print(f"⚠️ 生成失敗 ({key[:10]}...): {e}")
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="預先生成 ziwei_rules.json 各規則的白話解讀")
+    parser.add_argument("--provider", choices=["gemini", "groq"], help="預設依 config.json 的 gemini.provider")
+    parser.add_argument("--model", help="預設依供應商選用 config.json 模型或 llama-3.3-70b-versatile")
+    parser.add_argument("--batch-size", type=int, default=10, help="每次請求包含的規則數")
+    parser.add_argument("--rpm", type=float, default=10, help="每把金鑰每分鐘請求上限")
+    parser.add_argument("--limit", type=int, default=0, help="本次最多處理幾條 (0 表示全部)")
+    parser.add_argument("--output", default=RULE_EXPLANATIONS_FILE)
+    args = parser.parse_args()
+
+    config = load_config()
+    provider = args.provider or config.get('gemini', {}).get('provider', 'gemini').lower()
+    if provider == "groq":
+        keys = get_keys(config, "GROQ_API_KEY", "groq_key")
+        model = args.model or "llama-3.3-70b-versatile"
+    else:
+        provider = "gemini"
+        keys = get_keys(config, "GEMINI_API_KEY", "api_key")
+        model = args.model or config.get('gemini', {}).get('model', 'gemini-2.0-flash')
+    if not keys:
+        print(f"❌ 未設定 {provider} 金鑰，請檢查 config.json 或環境變數。")
+        sys.exit(1)
+
+    with open(RULE_FILE, 'r', encoding='utf-8') as f:
+        rules = json.load(f)
+    items = load_explanations(args.output)
+    todo = [r for r in rules if r.get("id") and r["id"] not in items]
+    if args.limit: todo = todo[:args.limit]
+    print(f"規則共 {len(rules)} 條，已收錄 {len(items)} 條，本次處理 {len(todo)} 條 ({provider} / {model}，{len(keys)} 把金鑰)。")
+
+    gen = Generator(provider, keys, model, args.rpm)
+    done = 0
+    for start in range(0, len(todo), args.batch_size):
+        batch = todo[start:start + args.batch_size]
+        answers = split_numbered(gen.generate(build_batch_prompt(batch)), len(batch))
+        for i, rule in enumerate(batch, 1):
+            if i in answers: items[rule["id"]] = answers[i]
+        done += len(answers)
+        save_explanations(items, model, args.output)
+        print(f"✅ 第 {start // args.batch_size + 1} 批：{len(answers)}/{len(batch)} 條完成 (累計 {len(items)}/{len(rules)})")
+        if not gen.scheduler.keys: break
+
+    print(f"完成：本次新增 {done} 條，輸出至 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import gzip
+import io
+import json
+import os
+import threading
+
+from stream_capture import full_response
+
+# --- Chat Archive (對話紀錄壓縮封存) ---
+# 超過保存期限 (或被熱儲存淘汰) 的對話移入依日期分檔的 gzip 封存：chat_archive/chats-YYYY-MM-DD.jsonl.gz
+# - 同一天之後再封存的紀錄以新的 gzip member 附加在檔尾 (gzip 格式允許多個 member 串接)，不必重寫。
+# - index.json 記錄每個分段的筆數、時間範圍、出現過的姓名與位元組長度，管理介面先查索引，只解壓需要的分段。
+#   附加前若檔案比索引記錄的長 (上次寫入後、更新索引前當機)，先截掉未記入索引的部分。
+# - 呼叫端應在 archive() 返回後才自熱儲存刪除，當機時最多重複封存，不會遺失。
+
+class ChatArchive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        self._segments = None  # 日期 -> {"file", "count", "first", "last", "users", "bytes"}
+
+    def _load_index(self):
+        if self._segments is not None: return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._segments = json.load(f).get("segments", {})
+        except FileNotFoundError:
+            self._segments = self._scan()
+        except Exception as e:
+            print(f"⚠️ 封存索引損毀 ({e})，重新掃描封存分段...")
+            self._segments = self._scan()
+
+    def _scan(self):
+        segs = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith("chats-") and name.endswith(".jsonl.gz"):
+                day = name[6:16]
+                entries = self._read_file(name)
+                seg = segs[day] = {"file": name, "count": 0, "first": None, "last": None, "users": []}
+                self._merge_stats(seg, entries)
+                seg["bytes"] = os.path.getsize(os.path.join(self.directory, name))
+        return segs
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"segments": self._segments}, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _merge_stats(seg, entries):
+        stamps = [str(e.get("timestamp")) for e in entries if e.get("timestamp")]
+        if stamps:
+            seg["first"] = min([seg["first"]] + stamps if seg["first"] else stamps)
+            seg["last"] = max([seg["last"]] + stamps if seg["last"] else stamps)
+        users = set(seg["users"])
+        users.update(str(e["user_name"]) for e in entries if e.get("user_name"))
+        seg["users"] = sorted(users)
+        seg["count"] += len(entries)
+
+    def _read_file(self, name, size=None):
+        """解壓分段；size 為索引記錄的長度 (只讀已完整寫入的 member，不受同時附加影響)。"""
+        out = []
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as raw:
+                data = raw.read() if size is None else raw.read(size)
+            with gzip.open(io.BytesIO(data), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        out.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except (OSError, EOFError) as e:  # 寫到一半的最後一個 member：保留已讀出的部分
+            print(f"⚠️ 封存分段 {name} 讀取不完整: {e}")
+        return out
+
+    # --- 寫入 ---
+    def archive(self, entries):
+        """依日期附加到各封存分段並更新索引；回傳封存筆數。"""
+        by_day = {}
+        for e in entries:
+            if isinstance(e, dict):
+                by_day.setdefault(str(e.get("timestamp") or "unknown")[:10], []).append(e)
+        if not by_day: return 0
+        with self._lock:
+            self._load_index()
+            for day, items in sorted(by_day.items()):
+                name = f"chats-{day}.jsonl.gz"
+                data = "".join(json.dumps(e, ensure_ascii=False, default=str) + "\n" for e in items).encode('utf-8')
+                path = os.path.join(self.directory, name)
+                seg = self._segments.get(day)
+                if os.path.exists(path) and os.path.getsize(path) > (seg["bytes"] if seg else 0):
+                    with open(path, 'r+b') as f: f.truncate(seg["bytes"] if seg else 0)
+                with open(path, 'ab') as f:
+                    f.write(gzip.compress(data))
+                    f.flush()
+                    os.fsync(f.fileno())
+                seg = self._segments.setdefault(day, {"file": name, "count": 0, "first": None, "last": None, "users": []})
+                self._merge_stats(seg, items)
+                seg["bytes"] = os.path.getsize(path)
+            self._save_index()
+        return sum(len(items) for items in by_day.values())
+
+    # --- 查詢 ---
+    def segments(self, date_from=None, date_to=None, name=None):
+        """依索引篩選封存分段 (新到舊)，不需解壓。"""
+        with self._lock:
+            self._load_index()
+            out = []
+            for day, seg in sorted(self._segments.items(), reverse=True):
+                if date_from and day < date_from[:10]: continue
+                if date_to and day > date_to[:10]: continue
+                if name and not any(name in u for u in seg["users"]): continue
+                out.append(dict(seg, day=day))
+            return out
+
+    def read(self, day, name=None, q=None, offset=0, limit=50):
+        """解壓單日分段並篩選；回傳 (符合筆數, 該頁紀錄 (新到舊))。"""
+        with self._lock:
+            self._load_index()
+            seg = self._segments.get(day)
+        if not seg: return 0, []
+        hits = []
+        for e in reversed(self._read_file(seg["file"], seg.get("bytes"))):
+            if name and name not in str(e.get("user_name") or ""): continue
+            if q and q not in str(e.get("prompt") or "") and q not in str(full_response(e) or ""): continue
+            hits.append(e)
+        return len(hits), hits[offset:offset + limit]
+
+    def snapshot(self):
+        with self._lock:
+            self._load_index()
+            segs = self._segments.values()
+            return {"segments": len(self._segments), "chats": sum(s["count"] for s in segs),
+                    "bytes": sum(s.get("bytes", 0) for s in segs)}
@@ -0,0 +1,272 @@
+import atexit
+import json
+import os
+import queue
+import threading
+
+# --- Append-only Chat Log Store (對話紀錄分段附加寫入) ---
+# 取代「讀入整份 chat_history.json → 附加一筆 → 整檔重寫」：
+# - 每筆紀錄以一行 JSON 附加到目前分段 (seg-000001.jsonl ...)，寫滿 segment_size 筆即換新分段。
+# - 只保留最近 max_entries 筆：最舊的整個分段超出保留量時直接刪檔 (不需重寫)。
+# - index.json 記錄各分段的筆數與位元組長度 (偏移索引)；分段尾端若因當機留下半行，載入時依索引截掉。
+# - 由單一寫入執行緒從佇列取出紀錄寫檔，log_chat 只需放入佇列 (O(1))。
+# - 分段被淘汰 (超出保留量或過期) 前先交給 on_evict (如封存)，刪檔在其返回之後。
+# - max_entries=None 表示不淘汰 (如用戶紀錄)，全部保留。
+
+def segment_seq(seg):
+    return int(seg["name"][4:10])
+
+class ChatLogStore:
+    def __init__(self, directory, legacy_file=None, max_entries=1000, segment_size=200, fsync=True, on_evict=None, label="對話紀錄"):
+        self.directory = directory
+        self.label = label  # 訊息中的名稱
+        self.legacy_file = legacy_file
+        self.max_entries = max_entries
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.on_evict = on_evict  # on_evict(紀錄清單)：分段刪除前呼叫
+        self.index_path = os.path.join(directory, "index.json")
+        self.segments = []  # [{"name", "count", "bytes"}]，由舊到新
+        self._last_seq = 0  # 最近使用的分段序號 (replace 清空後沿用遞增，分頁游標不會指到新內容)
+        self._queue = queue.Queue()
+        self._lock = threading.RLock()  # 保護分段檔與索引 (寫入執行緒與讀取者共用)
+        self._writer = None
+        self._ready = False
+
+    # --- 初始化與索引 ---
+    def _ensure_ready(self):
+        if self._ready: return
+        with self._lock:
+            if self._ready: return
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(self.index_path):
+                try:
+                    with open(self.index_path, 'r', encoding='utf-8') as f:
+                        self.segments = json.load(f).get("segments", [])
+                except Exception as e:
+                    print(f"⚠️ {self.label}索引損毀 ({e})，重新掃描分段...")
+                    self.segments = self._scan_segments()
+                self._repair_tail()
+                # 建立新分段後、索引更新前當機：補回索引中沒有的新分段
+                last = self.segments[-1]["name"] if self.segments else ""
+                self.segments += [seg for seg in self._scan_segments() if seg["name"] > last]
+            else:
+                self.segments = self._scan_segments()
+                if not self.segments: self._import_legacy()
+            self._save_index()
+            self._ready = True
+
+    def _segment_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _scan_segments(self):
+        segs = []
+        for name in sorted(n for n in os.listdir(self.directory) if n.startswith("seg-") and n.endswith(".jsonl")):
+            with open(self._segment_path(name), 'rb') as f:
+                data = f.read()
+            valid = data[:data.rfind(b"\n") + 1]
+            segs.append({"name": name, "count": valid.count(b"\n"), "bytes": len(valid)})
+        return segs
+
+    def _repair_tail(self):
+        """依索引截斷最後一個分段：丟棄當機時寫到一半、尚未記入索引的內容。"""
+        if not self.segments: return
+        last = self.segments[-1]
+        path = self._segment_path(last["name"])
+        if not os.path.exists(path):
+            self.segments.pop()
+            return
+        size = os.path.getsize(path)
+        if size > last["bytes"]:
+            with open(path, 'rb') as f:
+                f.seek(last["bytes"])
+                extra = f.read()
+            keep = extra[:extra.rfind(b"\n") + 1]  # 索引後仍有完整的行 (索引落後) 則保留
+            last["count"] += keep.count(b"\n")
+            last["bytes"] += len(keep)
+            if len(keep) < len(extra):
+                with open(path, 'r+b') as f: f.truncate(last["bytes"])
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"segments": self.segments}, f)
+        os.replace(tmp, self.index_path)
+
+    def _import_legacy(self):
+        if not self.legacy_file or not os.path.exists(self.legacy_file): return
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"⚠️ 舊版{self.label} {self.legacy_file} 無法匯入: {e}")
+            return
+        entries = self._retained(entries)
+        self._write_entries(entries)
+        print(f"📦 已將 {self.legacy_file} 的 {len(entries)} 筆{self.label}匯入 {self.directory}/")
+
+    def _retained(self, entries):
+        entries = list(entries)
+        return entries if self.max_entries is None else entries[-self.max_entries:]
+
+    # --- 寫入 ---
+    def _write_entries(self, entries):
+        """於鎖內附加多筆紀錄 (必要時換分段)，寫完後更新索引並淘汰過舊分段。"""
+        i = 0
+        while i < len(entries):
+            if not self.segments or self.segments[-1]["count"] >= self.segment_size:
+                seq = max(self._last_seq, segment_seq(self.segments[-1]) if self.segments else 0) + 1
+                self._last_seq = seq
+                self.segments.append({"name": f"seg-{seq:06d}.jsonl", "count": 0, "bytes": 0})
+            seg = self.segments[-1]
+            batch = entries[i:i + self.segment_size - seg["count"]]
+            data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in batch).encode('utf-8')
+            with open(self._segment_path(seg["name"]), 'ab') as f:
+                f.write(data)
+                f.flush()
+                if self.fsync: os.fsync(f.fileno())
+            seg["count"] += len(batch)
+            seg["bytes"] += len(data)
+            i += len(batch)
+        self._compact()
+        self._save_index()
+
+    def _compact(self):
+        if self.max_entries is None: return
+        total = sum(s["count"] for s in self.segments)
+        while len(self.segments) > 1 and total - self.segments[0]["count"] >= self.max_entries:
+            total -= self.segments[0]["count"]
+            if not self._evict_oldest(): break
+
+    def _evict_oldest(self):
+        """淘汰最舊的分段；on_evict 失敗時保留分段待下次處理並回傳 False。"""
+        old = self.segments[0]
+        if self.on_evict:
+            try:
+                self.on_evict(self._read_segment(old))
+            except Exception as e:
+                print(f"⚠️ {self.label}分段 {old['name']} 封存失敗，暫不刪除: {e}")
+                return False
+        self.segments.pop(0)
+        try:
+            os.remove(self._segment_path(old["name"]))
+        except OSError:
+            pass
+        return True
+
+    def expire_before(self, cutoff):
+        """淘汰最後一筆早於 cutoff (timestamp 字串) 的整個分段 (不含目前寫入中的分段)；回傳淘汰筆數。"""
+        self._ensure_ready()
+        self.flush()
+        removed = 0
+        with self._lock:
+            while len(self.segments) > 1:
+                entries = self._read_segment(self.segments[0])
+                if entries and str(entries[-1].get("timestamp") or "") >= cutoff: break
+                count = self.segments[0]["count"]
+                if not self._evict_oldest(): break
+                removed += count
+            if removed: self._save_index()
+        return removed
+
+    def _run_writer(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            while True:  # 一次寫入佇列中累積的所有紀錄
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            entries = [e for e in batch if e is not None]
+            try:
+                if entries:
+                    with self._lock: self._write_entries(entries)
+            except Exception as e:
+                print(f"⚠️ {self.label}寫入錯誤: {e}")
+            finally:
+                for _ in batch: self._queue.task_done()
+
+    def append(self, entry):
+        """放入寫入佇列後立即返回。"""
+        self._ensure_ready()
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run_writer, daemon=True, name=f"log-writer-{os.path.basename(self.directory)}")
+                    self._writer.start()
+                    atexit.register(self.flush)
+        self._queue.put(entry)
+
+    def flush(self):
+        """等候佇列中的紀錄全部寫入磁碟。"""
+        if self._writer is not None: self._queue.join()
+
+    def replace(self, entries):
+        """以整份清單取代現有紀錄 (相容舊 save_json_file 介面；一般寫入請用 append)。"""
+        self._ensure_ready()
+        self.flush()
+        with self._lock:
+            for seg in self.segments:
+                try:
+                    os.remove(self._segment_path(seg["name"]))
+                except OSError:
+                    pass
+            if self.segments: self._last_seq = max(self._last_seq, segment_seq(self.segments[-1]))
+            self.segments = []
+            self._write_entries(self._retained(entries))
+
+    # --- 讀取 ---
+    def _read_segment(self, seg, numbered=False):
+        """讀取分段內已記入索引的紀錄；numbered=True 時回傳 [(行號, 紀錄)] (行號為檔案中的實際行位置)。"""
+        with open(self._segment_path(seg["name"]), 'rb') as f:
+            data = f.read(seg["bytes"])
+        out = []
+        for line_no, line in enumerate(data.splitlines()):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            out.append((line_no, entry) if numbered else entry)
+        return out
+
+    def iter_newest(self, before=None):
+        """由新到舊產生 ((分段序號, 行號), 紀錄)；before 為上一頁最後一筆的鍵 (不含)。
+        鍵值是紀錄在檔案中的絕對位置，不會因新紀錄附加而位移；讀取期間被淘汰的分段視為已無更舊的紀錄。"""
+        self._ensure_ready()
+        with self._lock:
+            segs = [dict(s) for s in self.segments]
+        for seg in reversed(segs):
+            seq = segment_seq(seg)
+            if before is not None and seq > before[0]: continue
+            try:
+                rows = self._read_segment(seg, numbered=True)
+            except FileNotFoundError:
+                return
+            for line_no, entry in reversed(rows):
+                if before is not None and (seq, line_no) >= tuple(before): continue
+                yield (seq, line_no), entry
+
+    def tail(self, n):
+        """最近 n 筆紀錄 (舊到新；n=None 為全部)，只讀取涵蓋所需筆數的分段。"""
+        self._ensure_ready()
+        with self._lock:
+            picked, count = [], 0
+            for seg in reversed(self.segments):
+                if n is not None and count >= n: break
+                picked.append(seg)
+                count += seg["count"]
+            entries = []
+            for seg in reversed(picked):
+                entries.extend(self._read_segment(seg))
+        if n is None: return entries
+        return entries[-n:] if n else []
+
+    def load(self):
+        return self.tail(self.max_entries)
+
+    def count(self):
+        self._ensure_ready()
+        with self._lock:
+            total = sum(s["count"] for s in self.segments)
+            return total if self.max_entries is None else min(self.max_entries, total)
@@ -0,0 +1,368 @@
+import atexit
+import bisect
+import glob
+import json
+import math
+import os
+import pickle
+import queue
+import threading
+from array import array
+
+import numpy as np
+
+from book_index import cjk_bigrams
+
+# --- Chat Search Index (對話紀錄全文檢索) ---
+# 對話提問與回覆的倒排索引 (中文 bigram，與秘卷檢索共用 cjk_bigrams)，不必逐筆掃描 chat_history：
+# - docs.jsonl：索引自有的對話副本 (每行一筆，只附加)，查詢時依位元組偏移讀出命中的對話產生摘要。
+# - postings：詞 -> (遞增的文件編號 array, 詞頻 array)；查詢時所有 bigram 都須出現 (AND)，
+#   以 numpy 對整個候選清單一次計算交集 (searchsorted) 與 BM25 分數。
+# - 檢查點為增量：每 checkpoint_every 筆與程式結束時，只把上次檢查點之後新增的文件與 posting 寫成
+#   差異檔 delta-<起始文件編號>.pkl (鎖內只切片新增部分，序列化在鎖外，查詢不會被擋住)；
+#   差異檔累積的文件數達到基底 index.pkl 時，由寫入執行緒讀取磁碟上的檔案合併成新的基底 (總成本為線性)。
+#   啟動時載入基底與相接的差異檔，再補讀 docs.jsonl 中較新的部分。
+# - log_chat 只把紀錄放入佇列，由單一背景執行緒分詞並更新索引。
+# - iter_matches 供管理介面的關鍵字篩選 (各儲存後端共用)：由新到舊產生含查詢所有中文 bigram 的對話，
+#   docs.jsonl 的 x 欄保存提問/回覆以外的欄位 (姓名、生日等)，可還原成完整的對話紀錄。
+# - 首次使用時由 legacy_loader 匯入既有紀錄；觸發匯入的那筆對話可能已寫入熱儲存而被一併載入，
+#   匯入後不早於最新匯入時間的紀錄依 (時間, 姓名, 提問) 比對略過，同一筆不會編入兩次。
+
+SNAPSHOT_VERSION = 1
+NEWLINE = b"\n"
+DOC_FIELDS = {"timestamp": "t", "user_name": "u", "model": "m", "prompt": "p", "response": "r"}
+
+def doc_entry(doc):
+    """docs.jsonl 的一行還原為對話紀錄。"""
+    entry = dict(doc.get("x") or {})
+    entry.update((field, doc.get(short)) for field, short in DOC_FIELDS.items())
+    return entry
+
+def write_pickle(path, obj):
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def read_snapshots(snapshot_path, delta_paths):
+    """載入基底快照並依序套用相接的差異檔；回傳 (索引狀態, 基底文件數)，基底不存在或版本不符時為 (None, 0)。"""
+    try:
+        with open(snapshot_path, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        state = {"version": SNAPSHOT_VERSION, "offsets": array('Q'), "doc_len": array('I'), "postings": {},
+                 "total_len": 0, "docs_bytes": 0}
+    if state.get("version") != SNAPSHOT_VERSION: return None, 0
+    base_docs = len(state["offsets"])
+    postings = state["postings"]
+    for path in delta_paths:
+        with open(path, 'rb') as f:
+            delta = pickle.load(f)
+        if delta.get("version") != SNAPSHOT_VERSION or delta["start"] > len(state["offsets"]): break  # 有缺漏：其後由 docs.jsonl 補讀
+        if delta["start"] < len(state["offsets"]): continue  # 已合併進基底 (合併後、刪檔前當機)
+        state["offsets"].extend(delta["offsets"])
+        state["doc_len"].extend(delta["doc_len"])
+        for term, (ids, tfs) in delta["postings"].items():
+            plist = postings.get(term)
+            if plist is None:
+                postings[term] = (ids, tfs)
+            else:
+                plist[0].extend(ids)
+                plist[1].extend(tfs)
+        state["total_len"], state["docs_bytes"] = delta["total_len"], delta["docs_bytes"]
+    return state, base_docs
+
+def entry_key(entry):
+    return (str(entry.get("timestamp") or ""), str(entry.get("user_name") or ""), str(entry.get("prompt") or ""))
+
+def snippet(text, query, terms, width=80):
+    """取出命中位置附近的一段文字 (優先找完整查詢字串，其次找第一個命中的 bigram)。"""
+    pos, hit = text.find(query), query
+    if pos < 0:
+        for term in terms:
+            pos = text.lower().find(term)
+            if pos >= 0:
+                hit = term
+                break
+    if pos < 0: return text[:width] + ("…" if len(text) > width else "")
+    start = max(0, pos - width // 3)
+    end = min(len(text), start + width + len(hit))
+    return ("…" if start else "") + text[start:end] + ("…" if end < len(text) else "")
+
+
+class ChatSearchIndex:
+    def __init__(self, directory, legacy_loader=None, checkpoint_every=500, k1=1.2, b=0.75):
+        self.directory = directory
+        self.legacy_loader = legacy_loader  # 索引為空時用來匯入既有對話紀錄的函式
+        self.checkpoint_every = checkpoint_every
+        self.k1 = k1
+        self.b = b
+        self.docs_path = os.path.join(directory, "docs.jsonl")
+        self.snapshot_path = os.path.join(directory, "index.pkl")
+        self._reset()
+        self._since_checkpoint = 0
+        self._queue = queue.Queue()
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()  # 檢查點與合併依序進行 (寫入執行緒與 close)
+        self._writer = None
+        self._ready = False
+        self._bootstrap_tail = None  # 匯入的最新時間與該時間的紀錄鍵，用於略過重複送入的紀錄
+
+    def _reset(self):
+        self.offsets = array('Q')   # 文件編號 -> docs.jsonl 位元組偏移
+        self.doc_len = array('I')   # 文件編號 -> 詞數
+        self.postings = {}          # 詞 -> (array('I') 文件編號, array('B') 詞頻)
+        self.total_len = 0
+        self.docs_bytes = 0         # docs.jsonl 已編入索引的長度
+        self._saved_docs = 0        # 基底與差異檔已涵蓋的文件數
+        self._delta_start = {}      # 詞 -> 上次檢查點時的 posting 長度 (只記錄之後有新增的詞)
+        self._base_docs = 0         # 基底 index.pkl 的文件數
+
+    # --- 載入 ---
+    def _ensure_ready(self):
+        if self._ready: return
+        with self._lock:
+            if self._ready: return
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_snapshot()
+            self._replay_docs()
+            self._ready = True
+            self._writer = threading.Thread(target=self._run_writer, daemon=True, name="chat-search-index")
+            self._writer.start()
+            atexit.register(self.close)
+            if not self.offsets and self.legacy_loader: self._queue.put("bootstrap")
+
+    def _delta_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, "delta-*.pkl")))
+
+    def _load_snapshot(self):
+        try:
+            snap, base_docs = read_snapshots(self.snapshot_path, self._delta_paths())
+        except Exception as e:
+            print(f"⚠️ 對話檢索索引損毀 ({e})，將由 docs.jsonl 重建...")
+            return
+        if snap is None: return
+        self.offsets, self.doc_len, self.postings = snap["offsets"], snap["doc_len"], snap["postings"]
+        self.total_len, self.docs_bytes = snap["total_len"], snap["docs_bytes"]
+        self._saved_docs, self._base_docs = len(self.offsets), base_docs
+
+    def _replay_docs(self):
+        """補讀快照之後才附加的文件；結尾若有當機留下的半行則截掉。"""
+        if not os.path.exists(self.docs_path): return
+        size = os.path.getsize(self.docs_path)
+        if size < self.docs_bytes: self._reset()  # 快照與文件檔不一致：整個重建 (下次檢查點重寫基底)
+        with open(self.docs_path, 'rb') as f:
+            f.seek(self.docs_bytes)
+            data = f.read()
+        complete = data[:data.rfind(NEWLINE) + 1]
+        if len(complete) < len(data):
+            with open(self.docs_path, 'r+b') as f: f.truncate(self.docs_bytes + len(complete))
+        pos = self.docs_bytes
+        for line in complete.splitlines(keepends=True):
+            try:
+                self._index_doc(json.loads(line), pos)
+            except ValueError:
+                pass
+            pos += len(line)
+        self.docs_bytes = pos
+        if complete: print(f"🔎 對話檢索索引已補讀 {complete.count(NEWLINE)} 筆 (共 {len(self.offsets)} 筆)")
+
+    # --- 建立索引 ---
+    def _index_doc(self, doc, offset):
+        terms = {}
+        for term in cjk_bigrams(f"{doc.get('p') or ''}\n{doc.get('r') or ''}"):
+            terms[term] = terms.get(term, 0) + 1
+        doc_id = len(self.offsets)
+        self.offsets.append(offset)
+        self.doc_len.append(sum(terms.values()))
+        self.total_len += self.doc_len[-1]
+        for term, tf in terms.items():
+            plist = self.postings.get(term)
+            if plist is None:
+                plist = self.postings[term] = (array('I'), array('B'))
+            if term not in self._delta_start: self._delta_start[term] = len(plist[0])
+            plist[0].append(doc_id)
+            plist[1].append(min(tf, 255))
+
+    def _append_docs(self, entries):
+        docs = [{"t": e.get("timestamp"), "u": e.get("user_name"), "m": e.get("model"),
+                 "p": str(e.get("prompt") or ""), "r": str(e.get("response") or ""),
+                 "x": {k: v for k, v in e.items() if k not in DOC_FIELDS and k not in ("_id", "response_gz")}}
+                for e in entries if isinstance(e, dict)]
+        lines = [(json.dumps(d, ensure_ascii=False) + "\n").encode('utf-8') for d in docs]
+        with self._lock:
+            with open(self.docs_path, 'ab') as f:
+                f.write(b"".join(lines))
+            for doc, line in zip(docs, lines):
+                self._index_doc(doc, self.docs_bytes)
+                self.docs_bytes += len(line)
+            self._since_checkpoint += len(docs)
+            due = self._since_checkpoint >= self.checkpoint_every
+        if due: self._checkpoint()
+
+    def _checkpoint(self):
+        """寫入上次檢查點之後新增部分的差異檔 (從頭開始時直接寫成基底)；差異累積到與基底同量時合併。"""
+        with self._save_lock:
+            with self._lock:  # 只複製新增的切片 (與新增量成正比)
+                start = self._saved_docs
+                if len(self.offsets) == start: return
+                delta = {"version": SNAPSHOT_VERSION, "start": start,
+                         "offsets": self.offsets[start:], "doc_len": self.doc_len[start:],
+                         "postings": {t: (self.postings[t][0][i:], self.postings[t][1][i:]) for t, i in self._delta_start.items()},
+                         "total_len": self.total_len, "docs_bytes": self.docs_bytes}
+                self._saved_docs = len(self.offsets)
+                self._delta_start = {}
+                self._since_checkpoint = 0
+            try:
+                if start == 0:
+                    write_pickle(self.snapshot_path, delta)
+                    for path in self._delta_paths(): os.remove(path)
+                    self._base_docs = self._saved_docs
+                    return
+                write_pickle(os.path.join(self.directory, f"delta-{start:010d}.pkl"), delta)
+            except Exception as e:
+                print(f"⚠️ 對話檢索索引檢查點寫入失敗: {e}")
+                self._rewind(start)
+                return
+            if self._saved_docs - self._base_docs >= max(self._base_docs, self.checkpoint_every):
+                self._merge_snapshots()
+
+    def _rewind(self, start):
+        """差異檔寫入失敗：下次檢查點改從 start 重寫 (依文件編號找回各詞在 start 之後的位置)。"""
+        with self._lock:
+            self._saved_docs = start
+            self._delta_start = {t: bisect.bisect_left(ids, start) for t, (ids, _) in self.postings.items() if ids and ids[-1] >= start}
+
+    def _merge_snapshots(self):
+        """由磁碟上的基底與差異檔合併出新的基底 (不讀取記憶體中的索引，也不持有 _lock)。"""
+        try:
+            deltas = self._delta_paths()
+            state, _ = read_snapshots(self.snapshot_path, deltas)
+            if state is None or len(state["offsets"]) < self._saved_docs:
+                # 基底不一致或差異檔缺漏：合併結果不完整，改由記憶體重寫全部
+                self._rewind(0)
+                return
+            write_pickle(self.snapshot_path, state)
+            for path in deltas: os.remove(path)
+            self._base_docs = len(state["offsets"])
+        except Exception as e:
+            print(f"⚠️ 對話檢索索引合併失敗: {e}")
+
+    def _run_writer(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if "bootstrap" in batch:
+                    legacy = self.legacy_loader() or []
+                    if legacy and not self.offsets:
+                        self._append_docs(legacy)
+                        self._checkpoint()
+                        print(f"🔎 已將 {len(legacy)} 筆既有對話紀錄編入檢索索引")
+                        newest = max((entry_key(e)[0] for e in legacy if isinstance(e, dict)), default="")
+                        self._bootstrap_tail = (newest, {entry_key(e) for e in legacy if isinstance(e, dict) and entry_key(e)[0] == newest})
+                entries = self._skip_bootstrapped([e for e in batch if isinstance(e, dict)])
+                if entries: self._append_docs(entries)
+            except Exception as e:
+                print(f"⚠️ 對話檢索索引更新錯誤: {e}")
+            finally:
+                for _ in batch: self._queue.task_done()
+
+    def _skip_bootstrapped(self, entries):
+        """略過匯入時已收錄的紀錄；一旦出現比匯入資料新的紀錄即停止比對 (之後都是新紀錄)。"""
+        if self._bootstrap_tail is None: return entries
+        newest, seen = self._bootstrap_tail
+        out = []
+        for e in entries:
+            key = entry_key(e)
+            if self._bootstrap_tail is not None:
+                if key[0] < newest or (key[0] == newest and key in seen): continue
+                if key[0] > newest: self._bootstrap_tail = None
+            out.append(e)
+        return out
+
+    def add(self, entry):
+        """放入索引佇列後立即返回。"""
+        self._ensure_ready()
+        self._queue.put(entry)
+
+    def flush(self):
+        if self._writer is not None: self._queue.join()
+
+    def close(self):
+        self.flush()
+        if self._since_checkpoint: self._checkpoint()
+
+    # --- 查詢 ---
+    def _read_doc(self, doc_id):
+        with open(self.docs_path, 'rb') as f:
+            f.seek(self.offsets[doc_id])
+            return json.loads(f.readline())
+
+    def search(self, query, k=20):
+        """回傳 (命中總數, [{score, timestamp, user_name, model, prompt, snippet}])，依相關度排序。"""
+        self._ensure_ready()
+        query = (query or "").strip()
+        terms = list(dict.fromkeys(cjk_bigrams(query)))
+        if not terms: return 0, []
+        with self._lock:
+            plists = [self.postings.get(t) for t in terms]
+            if any(p is None for p in plists): return 0, []
+            n = len(self.offsets)
+            avgdl = self.total_len / n if n else 1.0
+            plists.sort(key=lambda p: len(p[0]))
+            # 複製成 numpy 陣列 (不直接引用 array 緩衝區，避免之後附加時無法擴充)
+            docs = np.array(plists[0][0], dtype=np.uint32)  # 以最稀有的詞為候選
+            scores = np.zeros(len(docs))
+            dl = np.array(self.doc_len, dtype=np.float64)
+            for ids, tfs in plists:
+                ids_np = np.array(ids, dtype=np.uint32)
+                j = np.minimum(np.searchsorted(ids_np, docs), len(ids_np) - 1)
+                keep = ids_np[j] == docs
+                docs, scores, j = docs[keep], scores[keep], j[keep]
+                tf = np.array(tfs, dtype=np.float64)[j]
+                idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl[docs] / avgdl))
+            top = np.lexsort((-docs.astype(np.int64), -scores))[:k]  # 分數高者在前，同分時較新者在前
+            ranked = [(int(docs[i]), float(scores[i])) for i in top]
+            hits = []
+            for doc_id, score in ranked:
+                doc = self._read_doc(doc_id)
+                text = doc["p"] if any(t in doc["p"].lower() for t in terms) else doc["r"]
+                hits.append({"score": round(score, 3), "timestamp": doc.get("t"), "user_name": doc.get("u"),
+                             "model": doc.get("m"), "prompt": doc["p"][:200], "snippet": snippet(text, query, terms)})
+        return len(docs), hits
+
+    def iter_matches(self, query, before=None):
+        """由新到舊產生 (文件編號, 對話紀錄)，只含查詢中所有中文 bigram 都出現的文件 (子字串命中的超集，
+        呼叫端須再精確比對)；before 為上一頁最後的文件編號 (不含)。查詢沒有中文 bigram 時回傳 None。"""
+        self._ensure_ready()
+        terms = [t for t in dict.fromkeys(cjk_bigrams(query or "")) if len(t) == 2 and not t.isascii()]
+        if not terms: return None
+        with self._lock:
+            plists = [self.postings.get(t) for t in terms]
+            if any(p is None for p in plists): return iter(())
+            plists.sort(key=lambda p: len(p[0]))
+            docs = np.array(plists[0][0], dtype=np.uint32)
+            if before is not None: docs = docs[docs < before]
+            for ids, _ in plists[1:]:
+                docs = docs[np.isin(docs, np.array(ids, dtype=np.uint32), assume_unique=True)]
+            docs = docs[::-1]
+            offsets = [self.offsets[i] for i in docs]
+        return self._iter_docs(docs, offsets)
+
+    def _iter_docs(self, docs, offsets):
+        # docs.jsonl 只附加，已編入索引的偏移內容不變，可在鎖外讀取
+        with open(self.docs_path, 'rb') as f:
+            for doc_id, offset in zip(docs, offsets):
+                f.seek(offset)
+                yield int(doc_id), doc_entry(json.loads(f.readline()))
+
+    def snapshot(self):
+        with self._lock:
+            return {"docs": len(self.offsets), "terms": len(self.postings), "pending": self._queue.qsize(),
+                    "unsaved": len(self.offsets) - self._saved_docs, "delta_docs": self._saved_docs - self._base_docs}
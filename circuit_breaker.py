@@ -0,0 +1,70 @@
+import threading
+import time
+
+# --- Circuit Breaker (斷路器) ---
+
+class CircuitBreaker:
+    """
+    連續失敗達門檻即斷路 (open)，請求路徑直接略過該服務；
+    斷路期間由背景執行緒定期探測，探測成功才恢復 (closed)。
+    """
+    def __init__(self, name, probe, failure_threshold=2, probe_interval=15, start_open=False):
+        self.name = name
+        self.probe = probe  # 無參數函式，服務正常時回傳 True
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.last_probe = None
+        self._lock = threading.Lock()
+        self._prober = None
+        if start_open:
+            self._open(probe_now=True)
+
+    def allow(self):
+        return self.state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "closed" and self.failures >= self.failure_threshold:
+                print(f">>> [斷路器] {self.name} 連續失敗 {self.failures} 次，暫停使用並於背景探測。")
+                self._open()
+
+    def _open(self, probe_now=False):
+        self.state = "open"
+        self.opened_at = time.time()
+        if self._prober is None:
+            self._prober = threading.Thread(target=self._probe_loop, args=(probe_now,), daemon=True)
+            self._prober.start()
+
+    def _probe_loop(self, probe_now):
+        if not probe_now: time.sleep(self.probe_interval)
+        while self.state == "open":
+            try:
+                ok = bool(self.probe())
+            except Exception:
+                ok = False
+            self.last_probe = time.time()
+            if ok:
+                with self._lock:
+                    self.failures = 0
+                    self.state = "closed"
+                    self._prober = None
+                print(f">>> [斷路器] {self.name} 探測成功，恢復服務。")
+                return
+            time.sleep(self.probe_interval)
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "opened_at": self.opened_at,
+            "last_probe": self.last_probe,
+        }
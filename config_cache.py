@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+import time
+
+# --- JSON Config Cache (設定檔記憶體快取) ---
+# 熱路徑 (每次對話) 直接讀取記憶體中的設定，不開檔也不解析 JSON：
+# - 最多每 check_interval 秒 stat 一次檔案，mtime 改變 (如手動編輯) 才重新載入。
+# - update() 以「寫入暫存檔 + os.replace」原子更新，並換上新的 dict (copy-on-write)，讀取端不會看到一半的內容。
+# - version 每次內容變動時遞增，可供用戶端判斷設定是否已更新。
+
+class JsonConfigCache:
+    def __init__(self, path, defaults=None, check_interval=1.0):
+        self.path = path
+        self.defaults = dict(defaults or {})
+        self.check_interval = check_interval
+        self.version = 0
+        self._data = dict(self.defaults)
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._reload()
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload(self):
+        mtime = self._stat_mtime()
+        if mtime is None:
+            data = dict(self.defaults)
+        else:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"⚠️ 設定檔 {self.path} 讀取失敗，沿用目前內容: {e}")
+                self._mtime = mtime
+                return
+        self._data = data
+        self._mtime = mtime
+        self.version += 1
+
+    def get(self):
+        """目前的設定 (唯讀，請勿直接修改)。"""
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            with self._lock:
+                if now - self._checked >= self.check_interval:
+                    self._checked = now
+                    if self._stat_mtime() != self._mtime: self._reload()
+        return self._data
+
+    def update(self, changes):
+        """合併變更並原子寫回檔案；回傳新版本號。"""
+        with self._lock:
+            data = dict(self._data)
+            data.update(changes)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._data = data
+            self._mtime = self._stat_mtime()
+            self._checked = time.monotonic()
+            self.version += 1
+            return self.version
@@ -0,0 +1,107 @@
+import atexit
+import io
+import os
+import threading
+import time
+
+# --- Excel Mirror (使用者紀錄的 Excel 備份) ---
+# 原本每次 save_record 都在請求執行緒上以 pandas 重建全部紀錄並重寫 user_records.xlsx (筆數越多越慢)。
+# 改為只標記「需要更新」，由背景執行緒在最後一次標記後 debounce 秒才重寫一次 (連續多筆註冊合併為一次)，
+# 但距第一筆未寫入的標記最多 max_delay 秒必定寫入 (註冊不斷時備份也不會無限延後)；
+# 以 openpyxl write-only 模式逐列串流寫入暫存檔再原子替換，讀取端不會看到寫到一半的檔案。
+
+# 欄位順序與中文表頭 (其餘欄位依出現順序附加在後，沿用原欄名)
+EXCEL_COLUMNS = [
+    ("timestamp", "紀錄時間"), ("name", "姓名"), ("gender", "性別"),
+    ("birth_date", "國曆生日"), ("birth_hour", "時辰(支)"), ("lunar_date", "農曆日期"),
+]
+
+def cell_value(value):
+    if value is None or isinstance(value, (str, int, float, bool)): return value
+    return str(value)
+
+def write_workbook(records, target):
+    """將紀錄串流寫入 .xlsx (target 可為路徑或檔案物件)。"""
+    from openpyxl import Workbook
+    keys = [k for k, _ in EXCEL_COLUMNS]
+    for rec in records:
+        keys += [k for k in rec if k not in keys and k != "_id"]
+    titles = dict(EXCEL_COLUMNS)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append([titles.get(k, k) for k in keys])
+    for rec in records:
+        ws.append([cell_value(rec.get(k)) for k in keys])
+    wb.save(target)
+
+
+class ExcelMirror:
+    def __init__(self, path, loader, debounce=5.0, max_delay=60.0):
+        self.path = path
+        self.loader = loader  # 回傳全部紀錄清單的函式
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.stats = {"requested": 0, "written": 0, "last_written": None, "last_error": None}
+        self._dirty_at = None
+        self._first_dirty_at = None  # 第一筆尚未寫入的標記時間
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()  # 背景寫入與 flush() 不同時寫同一個暫存檔
+        self._thread = None
+
+    def mark_dirty(self):
+        """紀錄有變動：安排一次背景重寫並立即返回。"""
+        with self._cond:
+            self._dirty_at = time.time()
+            if self._first_dirty_at is None: self._first_dirty_at = self._dirty_at
+            self.stats["requested"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="excel-mirror")
+                self._thread.start()
+                atexit.register(self.flush)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._dirty_at is None:
+                    self._cond.wait()
+                # 等到最後一次標記滿 debounce 秒 (期間的新標記會延後寫入)，但不超過第一筆標記後 max_delay 秒
+                while self._dirty_at is not None:
+                    deadline = min(self._dirty_at + self.debounce, self._first_dirty_at + self.max_delay)
+                    if time.time() >= deadline: break
+                    self._cond.wait(deadline - time.time())
+                if self._dirty_at is None: continue  # 已由 flush() 寫入
+                self._dirty_at = self._first_dirty_at = None
+            self._write()
+
+    def _write(self):
+        tmp = self.path + ".tmp"
+        with self._write_lock:
+            try:
+                records = self.loader()
+                write_workbook(records, tmp)
+                os.replace(tmp, self.path)
+                self.stats["written"] += 1
+                self.stats["last_written"] = time.time()
+                print(f"💾 已同步備份至本地 Excel: {self.path} ({len(records)} 筆)")
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                print(f"⚠️ Excel 備份失敗: {e}")
+
+    def flush(self):
+        """若有尚未寫入的變動，立即同步寫入 (程式結束時呼叫)。"""
+        with self._cond:
+            if self._dirty_at is None: return
+            self._dirty_at = self._first_dirty_at = None
+        self._write()
+
+    def render(self):
+        """即時產生完整 .xlsx 內容 (供管理介面下載)。"""
+        buf = io.BytesIO()
+        write_workbook(self.loader(), buf)
+        buf.seek(0)
+        return buf
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, pending=self._dirty_at is not None)
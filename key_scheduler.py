@@ -0,0 +1,157 @@
+import re
+import threading
+import time
+
+# --- Key Scheduler (金鑰池排程：令牌桶 + 限流冷卻) ---
+
+MIN_RATE_PER_MIN = 1.0     # 連續被限流後的最低推估速率
+DEFAULT_COOLDOWN = 10.0    # 429 未附 retry-after 時的基礎冷卻秒數
+MAX_COOLDOWN = 300.0
+
+_RETRY_PATTERNS = [
+    re.compile(r"retry[_-]?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", re.I),  # Gemini: 'retryDelay': '37s'
+    re.compile(r"(?:try again|retry) in (\d+(?:\.\d+)?)\s*s", re.I),            # Groq: Please try again in 7.5s
+]
+
+def extract_retry_after(error):
+    """從例外 (HTTP 標頭或錯誤訊息) 取出建議等待秒數，取不到則回傳 None。"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        try:
+            val = headers.get("retry-after")
+            if val: return float(val)
+        except (TypeError, ValueError):
+            pass
+    text = str(error)
+    for pat in _RETRY_PATTERNS:
+        m = pat.search(text)
+        if m: return float(m.group(1))
+    return None
+
+
+class KeyScheduler:
+    """
+    單一供應商的金鑰池排程器 (執行緒安全)。
+    每把金鑰各有令牌桶，速率由 429 學習 (乘法遞減、成功後加法回升，不設上限)；rate_per_min 只是初始推估。
+    金鑰在第一次被限流前不受令牌桶限制 (實際配額以供應商的 429 為準)；
+    被限流的金鑰進入冷卻期，之後冷卻中或無令牌的金鑰不會被選出。
+    """
+    def __init__(self, provider, keys, rate_per_min=30, burst=5):
+        self.provider = provider
+        self.keys = keys  # 與呼叫端共用的清單，失效金鑰會在鎖內移除
+        self.rate_per_min = float(rate_per_min)
+        self.burst = float(burst)
+        self._lock = threading.Lock()
+        self._state = {}
+        for key in keys:
+            self._init_key(key)
+
+    def _init_key(self, key):
+        self._state[key] = {
+            "rate": self.rate_per_min, "tokens": self.burst, "updated": time.time(), "limited": False,
+            "cooldown_until": 0.0, "last_throttled": 0.0, "last_used": 0.0, "strikes": 0,
+            "requests": 0, "success": 0, "throttled": 0, "errors": 0, "invalid": False,
+        }
+
+    def _refill(self, st, now):
+        st["tokens"] = min(self.burst, st["tokens"] + (now - st["updated"]) * st["rate"] / 60.0)
+        st["updated"] = now
+
+    def _pick(self, exclude, now):
+        """回傳 (金鑰, 最短等待秒數)；有可用金鑰時等待為 0。"""
+        best, best_rank, soonest = None, None, None
+        for key in self.keys:
+            st = self._state.get(key)
+            if st is None or st["invalid"] or key in exclude: continue
+            if st["cooldown_until"] > now:
+                wait = st["cooldown_until"] - now
+            else:
+                self._refill(st, now)
+                if st["tokens"] >= 1 or not st["limited"]:
+                    rank = (st["last_throttled"], st["last_used"])  # 最久未被限流者優先，其次最久未使用
+                    if best_rank is None or rank < best_rank:
+                        best, best_rank = key, rank
+                    continue
+                wait = (1 - st["tokens"]) * 60.0 / st["rate"]
+            soonest = wait if soonest is None else min(soonest, wait)
+        return best, (0.0 if best else soonest)
+
+    def try_acquire(self, exclude=()):
+        """不等候：回傳 (金鑰, 0)，或 (None, 最快可用的秒數)；沒有任何可用金鑰時為 (None, None)。"""
+        with self._lock:
+            now = time.time()
+            key, wait = self._pick(exclude, now)
+            if key:
+                st = self._state[key]
+                st["tokens"] = max(0.0, st["tokens"] - 1)
+                st["last_used"] = now
+                st["requests"] += 1
+            return key, wait
+
+    def acquire(self, exclude=(), max_wait=0.0):
+        """取得一把可用金鑰並扣除一個令牌；全部冷卻中且等待超過 max_wait 時回傳 None。"""
+        deadline = time.time() + max_wait
+        while True:
+            key, wait = self.try_acquire(exclude)
+            if key: return key
+            if wait is None or time.time() + wait > deadline:
+                return None
+            time.sleep(wait)
+
+    def on_success(self, key):
+        with self._lock:
+            st = self._state.get(key)
+            if not st: return
+            st["success"] += 1
+            st["strikes"] = 0
+            st["rate"] += 1
+
+    def on_throttle(self, key, retry_after=None):
+        with self._lock:
+            st = self._state.get(key)
+            if not st: return
+            now = time.time()
+            st["throttled"] += 1
+            st["strikes"] += 1
+            st["limited"] = True
+            st["last_throttled"] = now
+            st["rate"] = max(MIN_RATE_PER_MIN, st["rate"] / 2)
+            st["tokens"] = 0.0
+            st["updated"] = now
+            cooldown = retry_after if retry_after else min(MAX_COOLDOWN, DEFAULT_COOLDOWN * 2 ** (st["strikes"] - 1))
+            st["cooldown_until"] = now + cooldown
+
+    def on_error(self, key):
+        with self._lock:
+            st = self._state.get(key)
+            if st: st["errors"] += 1
+
+    def invalidate(self, key):
+        """金鑰失效：標記並自共用清單移除 (僅移除一次)。回傳是否為本次移除。"""
+        with self._lock:
+            st = self._state.get(key)
+            if not st or st["invalid"]: return False
+            st["invalid"] = True
+            if key in self.keys: self.keys.remove(key)
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            out = []
+            for key, st in self._state.items():
+                if not st["invalid"] and st["cooldown_until"] <= now: self._refill(st, now)
+                out.append({
+                    "provider": self.provider,
+                    "key": key[:10] + "...",
+                    "status": "invalid" if st["invalid"] else ("cooldown" if st["cooldown_until"] > now else "ready"),
+                    "cooldown_remaining": round(max(0.0, st["cooldown_until"] - now), 1),
+                    "rate_per_min": round(st["rate"], 1),
+                    "tokens": round(st["tokens"], 2),
+                    "requests": st["requests"],
+                    "success": st["success"],
+                    "throttled": st["throttled"],
+                    "errors": st["errors"],
+                })
+            return out
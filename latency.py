@@ -0,0 +1,174 @@
+import bisect
+import queue
+import socket
+import threading
+
+# --- Latency Histograms ---
+
+# 對數間距的桶 (秒)：50ms ~ 120s
+BUCKET_BOUNDS = [0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 45, 60, 120]
+
+class LatencyHistogram:
+    """固定桶的延遲直方圖 (執行緒安全)，用於推估 p50/p95 等百分位數。"""
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # 最後一格為溢位桶
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, p):
+        """回傳第 p 百分位所在桶的上界 (秒)；尚無樣本時回傳 None。"""
+        with self._lock:
+            if not self.count: return None
+            target = self.count * p / 100.0
+            seen = 0
+            for i, c in enumerate(self.counts):
+                seen += c
+                if seen >= target:
+                    return self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+            return self.bounds[-1]
+
+    def snapshot(self):
+        with self._lock:
+            count, total, counts = self.count, self.total, list(self.counts)
+        return {
+            "count": count,
+            "avg": round(total / count, 3) if count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"], counts)),
+        }
+
+
+# --- Hedged Requests (對沖請求) ---
+# 落敗的一路在等待首段輸出時多半阻塞在 socket 讀取上，只設旗標要等到下一段輸出才會停止。
+# 因此每一路有自己的 CancelScope：工廠與 httpx 回應掛鉤 (track_response) 在其中登記關閉函式，
+# 該路落敗時立即呼叫 (shutdown socket 喚醒阻塞中的讀取、歸還准入名額)。
+
+_racer = threading.local()  # 對沖請求執行緒目前的 CancelScope
+
+class CancelScope:
+    """對沖請求單一路的取消狀態；cancel() 設定旗標並立即呼叫所有登記的關閉函式 (各只呼叫一次)。"""
+    def __init__(self):
+        self._event = threading.Event()
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def on_cancel(self, hook):
+        """登記關閉函式；已取消時立即呼叫。"""
+        with self._lock:
+            if not self._event.is_set():
+                self._hooks.append(hook)
+                return
+        run_hook(hook)
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set(): return
+            self._event.set()
+            hooks, self._hooks = self._hooks, []
+        for hook in hooks: run_hook(hook)
+
+def run_hook(hook):
+    try:
+        hook()
+    except Exception as e:
+        print(f">>> [對沖請求] 取消時關閉連線失敗: {e}")
+
+def current_scope():
+    """目前執行緒所屬對沖請求的 CancelScope (非對沖請求時為 None)。"""
+    return getattr(_racer, "scope", None)
+
+def abort_response(response):
+    """中斷 httpx 串流回應：先 shutdown socket 喚醒阻塞中的讀取 (單純 close 不會)，再關閉回應。"""
+    stream = response.extensions.get("network_stream")
+    sock = stream.get_extra_info("socket") if stream is not None else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+def track_response(response):
+    """httpx 的 response 事件掛鉤：在對沖請求的執行緒中收到回應標頭時，登記落敗時中斷此回應。"""
+    scope = current_scope()
+    if scope is not None: scope.on_cancel(lambda: abort_response(response))
+
+def hedge_delay(histogram, percentile=95, default=3.0, min_delay=0.5, max_delay=8.0, min_samples=20):
+    """依主要供應商的首段延遲百分位決定何時啟動備援；樣本不足時使用預設值。"""
+    if histogram is None or histogram.count < min_samples:
+        return default
+    return min(max_delay, max(min_delay, histogram.percentile(percentile)))
+
+def hedged_stream(racers, delay):
+    """
+    對沖串流：先啟動 racers[0]，若 delay 秒內沒有任何輸出 (或提前失敗)，再啟動下一位。
+    第一個送出內容者勝出並持續轉送，其餘立即取消。racers 為 [(名稱, 產生器工廠)]，
+    工廠以該路的 CancelScope 呼叫 (可登記取消時的關閉函式)，並在該路自己的執行緒中執行。
+    回傳 (以 yield from 取得) 勝出者名稱；全部無內容時回傳 None。
+    """
+    events = queue.Queue()
+    cancels = []
+
+    def run(idx, factory, cancel):
+        gen = None
+        _racer.scope = cancel
+        try:
+            gen = factory(cancel)
+            for chunk in gen:
+                if cancel.is_set(): break
+                events.put((idx, chunk))
+        except Exception as e:
+            print(f">>> [對沖請求] {racers[idx][0]} 發生錯誤: {e}")
+        finally:
+            if gen is not None and hasattr(gen, "close"): gen.close()
+            events.put((idx, None))
+
+    def launch():
+        idx = len(cancels)
+        cancel = CancelScope()
+        cancels.append(cancel)
+        threading.Thread(target=run, args=(idx, racers[idx][1], cancel), daemon=True).start()
+
+    winner = None
+    finished = set()
+    try:
+        launch()
+        while True:
+            timeout = delay if (winner is None and len(cancels) < len(racers)) else None
+            try:
+                idx, chunk = events.get(timeout=timeout)
+            except queue.Empty:
+                print(f">>> [對沖請求] {racers[len(cancels) - 1][0]} 超過 {delay:.1f}s 未回應，啟動 {racers[len(cancels)][0]}...")
+                launch()
+                continue
+            if chunk is None:
+                finished.add(idx)
+                if idx == winner: return racers[winner][0]
+                if winner is None:
+                    if len(cancels) < len(racers) and len(finished) == len(cancels):
+                        launch()  # 目前全數失敗，不必等滿 delay
+                    elif len(finished) == len(racers):
+                        return None
+                continue
+            if winner is None:
+                winner = idx
+                for i, cancel in enumerate(cancels):
+                    if i != winner: cancel.cancel()
+                if len(cancels) > 1:
+                    print(f">>> [對沖請求] 由 {racers[winner][0]} 勝出，取消其餘請求。")
+            if idx == winner:
+                yield chunk
+    finally:
+        for cancel in cancels: cancel.cancel()
@@ -0,0 +1,196 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+
+# --- MongoDB Write-Behind (批次背景寫入) ---
+# 請求執行緒只把文件放入緩衝即返回，由背景執行緒每 flush_interval 秒或累積 batch_size 筆時以 insert_many 寫入。
+# - 每份文件在入列時即指定 _id，重試時已寫入者會以重複鍵略過，不會重複插入。
+# - 寫入失敗以指數退避重試；中斷超過 spill_after 秒 (或緩衝超過 max_buffer 筆) 時，改寫入本地 spill 檔，
+#   恢復連線後再依序補寫並清空 spill 檔。
+# - 程式結束時 (atexit) 盡量寫完緩衝，寫不進去的部分落地到 spill 檔。
+
+DUPLICATE_KEY = 11000
+
+try:
+    from bson import ObjectId
+except ImportError:  # 未安裝 pymongo 時 (僅測試/本地) 使用字串 _id
+    ObjectId = None
+
+def new_id():
+    return ObjectId() if ObjectId else uuid.uuid4().hex
+
+def restore_id(value):
+    if ObjectId and isinstance(value, str) and len(value) == 24:
+        try:
+            return ObjectId(value)
+        except Exception:
+            pass
+    return value
+
+def spill_line(name, doc):
+    body = {k: v for k, v in doc.items() if k != "_id"}
+    return json.dumps({"c": name, "id": str(doc["_id"]), "doc": body}, ensure_ascii=False, default=str) + "\n"
+
+def only_duplicates(e):
+    """insert_many 的 BulkWriteError 是否全為重複鍵 (代表先前的重試其實已寫入)。"""
+    errors = (getattr(e, "details", None) or {}).get("writeErrors") or []
+    return bool(errors) and all(err.get("code") == DUPLICATE_KEY for err in errors)
+
+
+class MongoWriteBehind:
+    def __init__(self, collections, flush_interval=0.5, batch_size=100, max_buffer=5000,
+                 spill_file="mongo_spill.jsonl", spill_after=30, max_backoff=60):
+        self.collections = collections  # {名稱: pymongo Collection}
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.spill_file = spill_file
+        self.spill_after = spill_after
+        self.max_backoff = max_backoff
+        self.stats = {"queued": 0, "inserted": 0, "failed_batches": 0, "spilled": 0, "replayed": 0}
+        self._buffer = []  # [(名稱, 文件)]
+        self._cond = threading.Condition()
+        self._spill_lock = threading.RLock()  # spill 檔的附加、補寫與改寫互斥
+        self._failing_since = None
+        self._backoff = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name="mongo-write-behind")
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, name, doc):
+        """排入一份文件 (複製後加上 _id) 並立即返回。"""
+        doc = dict(doc)
+        doc.setdefault("_id", new_id())
+        with self._cond:
+            self._buffer.append((name, doc))
+            self.stats["queued"] += 1
+            overflow = self._buffer[:-self.max_buffer] if len(self._buffer) > self.max_buffer else []
+            if overflow:
+                del self._buffer[:len(overflow)]
+            if len(self._buffer) >= self.batch_size: self._cond.notify()
+        if overflow: self._spill(overflow)  # 記憶體上限：最舊的文件先落地
+
+    # --- 背景寫入 ---
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._backoff:  # 上次寫入失敗：不論緩衝多少都先等完退避時間 (僅關閉時提前結束)
+                    deadline = time.monotonic() + self._backoff
+                    while not self._closed:
+                        left = deadline - time.monotonic()
+                        if left <= 0: break
+                        self._cond.wait(left)
+                elif not self._closed and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._closed and not self._buffer: return
+                batch = self._buffer[:self.batch_size]
+            if not batch:
+                if os.path.exists(self.spill_file): self._replay()  # 閒置時探測並補寫 (間隔含退避)
+                continue
+            if self._write(batch):
+                done = {id(doc) for _, doc in batch}
+                with self._cond: self._buffer = [item for item in self._buffer if id(item[1]) not in done]
+                if os.path.exists(self.spill_file): self._replay()
+            elif self._failing_since and time.time() - self._failing_since > self.spill_after:
+                with self._cond:
+                    pending, self._buffer = self._buffer, []
+                self._spill(pending)
+            if self._closed and self._backoff: return  # 關閉時資料庫仍無法寫入：由 close() 落地
+
+    def _write(self, batch):
+        by_name = {}
+        for name, doc in batch:
+            by_name.setdefault(name, []).append(doc)
+        try:
+            for name, docs in by_name.items():
+                try:
+                    self.collections[name].insert_many([dict(d) for d in docs], ordered=False)
+                except Exception as e:
+                    if not only_duplicates(e): raise
+            self.stats["inserted"] += len(batch)
+            if self._failing_since:
+                print(f"✅ MongoDB 恢復寫入 (中斷 {time.time() - self._failing_since:.0f} 秒)。")
+            self._failing_since = None
+            self._backoff = 0
+            return True
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            if self._failing_since is None:
+                self._failing_since = time.time()
+                print(f"⚠️ MongoDB 批次寫入失敗 ({e})，將退避重試。")
+            self._backoff = min(self.max_backoff, max(1, self._backoff * 2))
+            return False
+
+    # --- 本地落地與補寫 ---
+    def _spill(self, items):
+        if not items: return
+        with self._spill_lock:
+            with open(self.spill_file, 'a', encoding='utf-8') as f:
+                f.writelines(spill_line(name, doc) for name, doc in items)
+            self.stats["spilled"] += len(items)
+        print(f"💾 MongoDB 無法寫入，已將 {len(items)} 筆暫存至 {self.spill_file}。")
+
+    def _replay(self):
+        with self._spill_lock:
+            self._replay_locked()
+
+    def _replay_locked(self):
+        try:
+            with open(self.spill_file, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        items = []
+        for line in lines:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # 當機留下的半行
+            items.append((row["c"], dict(row["doc"], _id=restore_id(row["id"]))))
+        for start in range(0, len(items), self.batch_size):
+            if not self._write(items[start:start + self.batch_size]):
+                self._rewrite_spill(items[start:])
+                return
+            self.stats["replayed"] += len(items[start:start + self.batch_size])
+        self._rewrite_spill([])
+        if items: print(f"✅ 已將 {len(items)} 筆暫存資料補寫至 MongoDB。")
+
+    def _rewrite_spill(self, items):
+        with self._spill_lock:
+            if not items:
+                os.remove(self.spill_file)
+                return
+            tmp = self.spill_file + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.writelines(spill_line(name, doc) for name, doc in items)
+            os.replace(tmp, self.spill_file)
+
+    def flush(self, timeout=10):
+        """等候緩衝寫完 (或逾時)；回傳是否已清空。"""
+        deadline = time.time() + timeout
+        with self._cond: self._cond.notify()
+        while time.time() < deadline:
+            with self._cond:
+                if not self._buffer: return True
+            time.sleep(0.05)
+        return False
+
+    def close(self, timeout=10):
+        if self._closed: return
+        self.flush(timeout if self._failing_since is None else 0)
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        with self._cond:
+            pending, self._buffer = self._buffer, []
+        self._spill(pending)
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, buffered=len(self._buffer), failing_since=self._failing_since,
+                        spill_pending=os.path.exists(self.spill_file))
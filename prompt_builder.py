@@ -0,0 +1,367 @@
+import time
+
+# --- Keyword Automaton (Aho–Corasick) ---
+
+class KeywordAutomaton:
+    """多關鍵字單次掃描比對器 (Aho–Corasick)，每個關鍵字可對應多個意圖標籤。"""
+
+    def __init__(self, keyword_map=None):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        self._built = False
+        if keyword_map:
+            for tag, keywords in keyword_map.items():
+                for kw in keywords:
+                    self.add(kw, tag)
+            self.build()
+
+    def add(self, keyword, tag):
+        if not keyword: return
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+            node = nxt
+        self._out[node].add(tag)
+        self._built = False
+
+    def build(self):
+        # BFS 建立失敗連結，並把後綴節點的輸出合併進來
+        queue = []
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+        head = 0
+        while head < len(queue):
+            node = queue[head]; head += 1
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+        self._built = True
+
+    def match(self, text):
+        """回傳文字中出現之所有意圖標籤 (set)。"""
+        if not self._built: self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for ch in text or "":
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+
+# --- Intent Keywords (原 chat() 內各自散落的關鍵字清單) ---
+
+INTENT_KEYWORDS = {
+    "full_report": ["詳評", "命譜詳評", "格局報告", "八字詳解", "命盤解析", "詳細解析", "八字論命"],
+    "stock": ["股票", "股", "代號", "代碼", "漲", "跌", "投資", "2330", "台積電", "鴻海", "聯發科"],
+    "career": ["職業", "工作", "事業", "轉職", "就業", "行業", "找事", "找頭路", "做什麼好", "適合什麼"],
+    "health": ["健康", "疾病", "生病", "身體", "注意什麼病", "養生", "看哪一科", "醫", "病"],
+    "finance": ["財", "理財", "投資", "賺錢", "偏財", "正財", "買什麼", "致富", "發財", "缺錢"],
+    "limit": ["大限", "十年", "未來十年", "這十年", "大運", "十年運程", "十年運勢"],
+    "yearly": ["流年", "年運", "今年", "2024", "2025", "明年", "流年運勢"],
+    "monthly": ["流月", "月運", "這個月", "本月", "流月運勢"],
+    "bazi": ["八字"],
+    "crisis": ["慘", "救", "死", "路", "絕", "走投無路", "怎麼辦", "救救我", "完了", "失敗"],
+    "aggressive": ["贏", "賺", "發", "勝", "搞定", "擊敗", "超越"],
+    "temple_love": ["情", "婚", "愛", "桃花", "姻緣", "對象"],
+    "temple_finance": ["錢", "財", "投資", "發財", "發達", "買房"],
+    "temple_career": ["工作", "事業", "官錄", "升職", "考", "學業", "官"],
+    "temple_health": ["病", "醫", "康", "災", "關", "平安"],
+}
+
+INTENT_MATCHER = KeywordAutomaton(INTENT_KEYWORDS)
+
+def detect_intents(text):
+    return INTENT_MATCHER.match(text)
+
+
+# --- Static Prompt Blocks (import 時即預先組好) ---
+
+PERSONA_SYNTHESIS = (
+    "【最高密令：靈識身份統合】\n"
+    "1. **命盤人格**：深度分析「命、身宮」主星。若有煞星則代表性格孤傲或波折，若有吉星則代表溫潤或貴氣。\n"
+    "2. **因果印證**：結合上述「宿世因果印記」所獲之資訊。若因果顯示其為科技業，而命盤官祿宮有機、月、同、梁，請點出這是『精算天機』的文職之命。請以『本座一眼看穿你凡間身分』的語氣進行論斷。\n"
+    "3. **即時狀態察覺**：根據「緣主狀態（設備）」與「氣候感應」，揣摩其目前的心理壓力或放鬆程度並融入語氣。\n"
+    "4. **生活的演繹 (生活化)**：**絕對禁止枯燥地背誦課本定義**。請將命理術語轉化為「現代生活場景」。例如：『命宮帶煞』不只說凶，要說『你這脾氣就像夏天的午後雷陣雨，來得快去得快，身邊的人得帶傘才行』。語氣要幽默、犀利且充滿故事感，讓緣主聽得進去、看得明白。\n"
+    "**絕對禁忌**：禁止提及「後台線索」、「搜尋資料」、「查閱資料」、「數據」、「API」等科技詞彙。請使用『神識感應』、『撥開迷霧』、『因果顯現』等宗師語氣。"
+)
+
+CAREER_MAPPING = (
+    "\n\n【天機指路：各星曜具體對應之行業參考表】\n"
+    "若緣主問及職業，必須嚴格依照其「官祿宮」或「命宮」之主星，直接點出以下列表中的 3~5 個具體實體職業，不得說空話：\n"
+    "- 紫微：企業負責人、高階主管、政治家、精品業、獨立創業者、高級公務員。\n"
+    "- 天機：軟體工程師、企劃專員、行銷人員、資料科學家、程式設計、宗教學者、命理幕僚。\n"
+    "- 太陽：外交官、公關人員、大眾傳播、教育工作者、能源產業、政治人物、跨國貿易。\n"
+    "- 武曲：金融業經理、銀行員、會計師、軍警人員、五金機械工程師、外科醫生、理財專員。\n"
+    "- 天同：幼教老師、餐飲業老闆、旅遊業導遊、社工、美容美髮師、娛樂休閒業、客服人員。\n"
+    "- 廉貞：科技業工程師、法律從業人員、警察、醫美醫師、護理師、藝術設計師、公職人員。\n"
+    "- 天府：金融管理、房地產仲介代銷、銀行主管、企業人資、財務長。\n"
+    "- 太陰：房地產投資、室內設計師、財務會計、教育機構行政、飯店管理、美妝保養銷售、作家。\n"
+    "- 貪狼：演藝娛樂人員、公關行銷、業務代表、設計師、醫學美容、餐飲休閒業、運動教練。\n"
+    "- 巨門：律師、業務推銷員、補習班講師、翻譯員、企管顧問、醫事人員、法務專員。\n"
+    "- 天相：秘書、特助、人力資源、公眾服務、服飾業、攝影師、機關行政主管。\n"
+    "- 天梁：西醫、中醫師、醫護衛教、社福人員、法官、宗教事業推廣、長照管理員。\n"
+    "- 七殺：軍警武職、外科醫生、新市場業務開發、土木建築工程師、職業運動員。\n"
+    "- 破軍：創新科技研發、創投經理、物流運輸業、軍警、拆除工程、破壞性創新行業。\n"
+    "- 文昌/文曲：學術研究員、作家、記者、教育學者、出版社編輯、藝術從業、會計。\n"
+    "- 左輔/右弼：特別助理、房仲中介、車行經理、人力派遣管理、客服中心督導。\n"
+    "【嚴格規定】：請從命盤挑出對應星曜，直接給出並解釋這幾個明確的現代職業選項！\n"
+)
+
+HEALTH_MAPPING = (
+    "\n\n【天機指路：各星曜具體對應之健康/疾病參考表】\n"
+    "若緣主問及健康，必須嚴格依照其「疾厄宮」或「命宮」之星曜（特別是化忌或煞星），點出具體的現代醫學病狀或器官，不得只說陰陽五行：\n"
+    "- 紫微：脾胃失調、消化不良、頭痛、腦神經衰弱、高血壓。\n"
+    "- 天機：肝膽功能、神經系統衰弱、失眠、四肢關節痠痛、甲狀腺異常。\n"
+    "- 太陽：心血管疾病、血壓異常、眼部疾病(白內障/青光眼)、偏頭痛。\n"
+    "- 武曲：呼吸道問題、肺部疾病、氣喘、骨骼牙齒問題、金屬創傷。\n"
+    "- 天同：泌尿系統、腎臟功能、膀胱炎、耳鳴、體重過重或水腫。\n"
+    "- 廉貞：血液循環問題、免疫系統異常、心臟病、傳染性疾病、腫瘤。\n"
+    "- 天府：胃病、消化性潰瘍、肌肉痠痛、脾臟問題、脹氣。\n"
+    "- 太陰：女性婦科疾病、內分泌失調、糖尿病、腎臟虛寒、皮膚過敏。\n"
+    "- 貪狼：肝臟疾病(脂肪肝、肝炎)、解毒功能低下、性器官異常、縱慾過度之併發症。\n"
+    "- 巨門：呼吸系統、腸胃病、口腔潰瘍、牙神經痛、呼吸道感染。\n"
+    "- 天相：泌尿系統疾病、腎結石、皮膚過敏、面部皮膚問題、水腫。\n"
+    "- 天梁：腸胃病、慢性病、風濕、免疫力低下。\n"
+    "- 七殺：呼吸系統炎、肺結核、外傷骨折、交通意外傷害、痔瘡。\n"
+    "- 破軍：生殖系統異常、骨骼牙齒損壞、外傷、消耗性疾病。\n"
+    "- 擎羊/陀羅：開刀手術、慢性扭傷、神經痛、慢性發炎。\n"
+    "- 火星/鈴星：急性發炎、高燒、突發性心臟病、燙傷。\n"
+    "【嚴格規定】：直接講出現代醫學器官與症狀名稱，並給予具體的就診科別建議或養生作為（如：建議做心血管檢查，少熬夜）。\n"
+)
+
+FINANCE_MAPPING = (
+    "\n\n【天機指路：各星曜具體對應之理財/投資工具參考表】\n"
+    "若緣主問及財運與投資，必須嚴格依照其「財帛宮」或「命宮」之星曜，給出具體的投資工具與求財方式：\n"
+    "- 紫微：適合大型績優股(如台積電)、藍籌股、高級實體房地產、名表/藝術品收藏投資。\n"
+    "- 天機：適合短期波段操作、ETF定期定額、科技類股、依靠專業技能或智慧財產權變現。\n"
+    "- 太陽：適合能源股、跨國國外基金、外匯投資、依靠知名度/流量/公眾影響力得財。\n"
+    "- 武曲：(正財星)適合金融股、黃金存摺、金屬原物料、穩健保單、技術勞作或實業致富。\n"
+    "- 天同：適合休閒娛樂產業投資、餐飲股、傳產配息股、依靠人際關係或合夥獲利，不宜高風險。\n"
+    "- 廉貞：適合高科技股、電商產業、偏財投機(需見吉星)、透過設計或精密技術專利賺錢。\n"
+    "- 天府：(庫星)適合土地投資、房地產租金收益、定存、保守型基金，重「守財」與長線。\n"
+    "- 太陰：(富星)適合購買房地產(房產收租)、民生消費股、美妝醫療股、女性市場相關投資。\n"
+    "- 貪狼：(偏財星)適合高風險高報酬投資、虛擬貨幣、生技股、娛樂產業、交際應酬帶來之暗財。\n"
+    "- 巨門：適合依靠口條/教學賺錢、專業證照引進之財、醫藥生技股、或透過特殊專門知識收費。\n"
+    "- 天相：適合投資代理商、連鎖加盟、民生必需品、或以協助他人理財抽取佣金。\n"
+    "- 天梁：(蔭星)適合長照綠能產業、醫療股、保險理賠金、長輩贈與繼承、或存股領息。\n"
+    "- 七殺/破軍：大起大落，適合高波動期貨、新興市場、創業型股票，但建議設立停損點，賺短線。\n"
+    "【嚴格規定】：請具體說出「股票種類、房地產、基金、虛擬貨幣」等現代名詞，並告知風險屬性是要短線還是長線定存。\n"
+)
+
+MONTHLY_MAPPING = (
+    "\n\n【天機指路：流月運勢推算準則】\n"
+    "緣主正在詢問「流月運勢」。請務必嚴格執行以下步驟：\n"
+    "1. 查閱上述命盤資訊中，【流月命宮】所落的宮位。\n"
+    "2. 結合該月的主星與流月四化分析本月的『氣場強弱』。\n"
+    "3. 給出本月的行動方針（如：適合簽約、不宜遠行、注意口舌是非）。\n"
+    "【嚴格規定】：只需點出本月（及未來一個月）的情況，語氣要短促有力。\n"
+)
+
+BAZI_INSTRUCTION = (
+    "\n\n【最高密令：八字正宗論斷】\n"
+    "1. **絕對優先權**：緣主目前正在進行「八字論命」，請務必捨棄繁雜的紫微斗數術語（除非兩者有極度明顯的印證），「全神貫注」於【八字四柱資訊】（年、月、日、時柱）。\n"
+    "2. **運用卷宗**：請嚴格引用《八字心法秘卷》中的內容。特別是「日主天干」的性情描述、以及「地支互動」（合、沖、刑、害）的解析。\n"
+    "3. **技術要點**：必須先判斷「日主強弱」與「月令得失」，再以此為基礎論斷財、官、印、食之吉凶。語氣要像是一位手持八字命譜的資深命理宗師。\n"
+    "4. **絕不空談**：直接引用干支（如：日主甲木見庚金為偏官）來進行論證。但請務必將這些術語「轉化為生活故事」，例如甲木見庚金，你可以說：『你就像一棵參天大樹，最近遇到了一把生鏽的好斧頭在修理你，雖然有點痛，但那是為了讓你成材啊！』，讓聽眾感到有趣且有共鳴。"
+)
+
+NO_REVEAL_INSTRUCTION = " \n【禁止直接揭露指令】：絕對禁止提及具體城市名或使用地圖導航語氣（如：在某路某號）。請說「本座觀此地東北方有瑞氣、某區中有一處香火極盛之處...」等宗師口吻，緩緩點出廟宇名稱。"
+
+_OUTPUT_SPEC_FULL = """
+【輸出模組規範】：請務必依序包含以下章節，並使用 Markdown 格式呈現：
+1. ### 🌌 【天機啟示：靈識同步】
+   - 描述環境磁場（隱晦點出位置，禁提城市名）與天時時辰。
+2. ### 🕯️ 【因果印證：凡塵真身】
+   - (若有姓名) 結合感應到之因果足跡與命盤，點出其職業或近期生活狀態。語氣需神祕：「本座觀你凡塵之氣...」。
+3. ### 📜 {pillar_term}
+   - {pillar_desc}
+4. ### 💡 【大師點撥：趨吉避凶】
+   - 給予具體建議與 1-2 處適合緣主當前氣場的廟宇點撥。
+"""
+
+OUTPUT_SPEC_FULL_ZIWEI = _OUTPUT_SPEC_FULL.format(pillar_term="【命譜詳批：星曜定論】", pillar_desc="深入解析格局與星曜。")
+OUTPUT_SPEC_FULL_BAZI = _OUTPUT_SPEC_FULL.format(pillar_term="【命譜詳批：五行定論】", pillar_desc="深入解析八字格局、日主強弱、喜用神與五行生剋。")
+
+OUTPUT_SPEC_CHAT = """
+【對話回應規範】：
+1. **直接破題，切中要害**：針對緣主的具體提問（例如：適合什麼職業、財運在哪裡、感情狀況等），必須**直接給出具體答案**，**絕對禁止打高空、含糊其辭或講一堆空泛的玄學套話**。
+2. **引述命盤，具體佐證**：你的論點必須直接引用命盤證據。若是紫微斗數，請明確指出哪個「宮位」的哪顆「星曜」或「四化」；若是八字論命，請明確指出是哪一「柱」的「干支」或「五行生剋」導致這個結果。
+3. **給予具體選項**：如果問職業，直接給出 3~5 種現代具體行業。如果問財運，直接說可以投資哪一類標的。
+4. **捨棄繁瑣格式**：直接以「本座觀你盤中...」開頭，直搗黃龍解析問題。
+"""
+
+PRIORITY_TAG = "\n【最高優先權指令：請嚴格執行上述格式與內容要求，務必極度具體、精準、直接】\n"
+
+HEADER_FULL = "你是【紫微天機道長】，命理宗師。\n"
+HEADER_CHAT = "你是【紫微天機道長】，語氣精煉犀利，一針見血。\n"
+
+STATIC_BLOCKS = {
+    "header_full": HEADER_FULL,
+    "header_chat": HEADER_CHAT,
+    "persona": PERSONA_SYNTHESIS,
+    "career": CAREER_MAPPING,
+    "health": HEALTH_MAPPING,
+    "finance": FINANCE_MAPPING,
+    "monthly": MONTHLY_MAPPING,
+    "bazi": BAZI_INSTRUCTION,
+    "no_reveal": NO_REVEAL_INSTRUCTION,
+    "spec_full_ziwei": OUTPUT_SPEC_FULL_ZIWEI,
+    "spec_full_bazi": OUTPUT_SPEC_FULL_BAZI,
+    "spec_chat": OUTPUT_SPEC_CHAT,
+    "priority": PRIORITY_TAG,
+}
+
+# --- Templates (含少量動態欄位，以 str.format 套用) ---
+
+TEMPLATES = {
+    "limit": (
+        "\n\n【天機指路：十年大限推算準則】\n"
+        "緣主正在詢問「十年大限/大運」。請務必嚴格執行以下步驟：\n"
+        "1. 查閱上述命盤資訊中，每個宮位後面標示的「大限:(例如 34-43)」。\n"
+        "2. 將緣主的當前歲數（目前的年齡約 {age} 歲）套入這些區間，找出他「目前」或「未來即將進入」的大限是落在哪個宮位（例如：找出大限區間包含 {age} 的宮位）。\n"
+        "3. 找到該宮位後，將其視為「大限命宮」。\n"
+        "4. 根據這個宮位內的主星與四化，具體指出這十年的『重心是什麼』（如：如果大限落在財帛宮，這十年重心必然在求財；若在夫妻宮，重心在感情與人際）。\n"
+        "5. 給出這十年中會遇到最大的 2 個挑戰與 2 個機遇（例如：這十年武曲化忌，有財務危機；但有天鉞，會有長輩貴人相助）。\n"
+        "【嚴格規定】：不可籠統講述一生的命運，必須精準點出這十年（包含具體歲數區間）的吉凶與應該採取的具體策略（如：守成不宜擴張，或該積極創業）。\n"
+    ),
+    "yearly": (
+        "\n\n【天機指路：流年運勢推算準則】\n"
+        "緣主正在詢問「流年運勢」。請務必嚴格執行以下步驟：\n"
+        "1. 查閱上述命盤資訊中，【流年命宮】所落的宮位（例如：流年命宮在辰宮，對應本命的子女宮）。\n"
+        "2. 找到該宮位在原盤中的主星，並結合該年的「流年四化」（如 2024 甲辰年是廉破武陽）。\n"
+        "3. 具體指出今年的『整體基調』（如：變動劇烈、適合守成、利於求名、或是有桃花劫）。\n"
+        "4. 列出今年最旺的宮位與最弱（需防範）的宮位。\n"
+        "【嚴格規定】：必須針對該年度（例如 {year_label}）的吉凶進行預測，禁止泛泛而談。\n"
+    ),
+    "love": "\n\n【紅塵情慾密令】：\n{love_vibe}\n- 目前緣主正值 {age} 歲之春秋。請針對此年輪的肉體與靈魂需求，給予極度『曖昧且具侵略性』的桃花攻略。",
+    "lottery": "\n\n【今日天機財數】：{lottery_msg}。若緣主問及財運或幸運號碼，請以「天機乍現」的語氣，神祕地透露這組號碼，並提醒切勿沉迷，僅供結緣參考。",
+}
+
+
+# --- Token Estimation & Budget ---
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓文字 (含全形標點) 約 1 字 1 token，英數與空白約 4 字元 1 token。"""
+    if not text: return 0
+    # UTF-8 下中文佔 3 bytes、英數佔 1 byte，由長度差即可推得中文字數，免逐字迴圈
+    n = len(text)
+    cjk = (len(text.encode('utf-8')) - n) // 2
+    return cjk + (n - cjk + 3) // 4
+
+# 必備區塊：角色、緣主情境、輸出規範與前端指令，無論預算多少都保留
+REQUIRED_BLOCKS = {
+    "header_full", "header_chat", "persona", "context", "sep", "hidden", "priority", "client_sys",
+    "spec_full_ziwei", "spec_full_bazi", "spec_chat",
+}
+
+# 非必備區塊的基礎權重；命中對應意圖時再加分
+BLOCK_WEIGHTS = {
+    "no_reveal": 60, "stock": 50, "bazi_notes": 45, "temple": 40, "lottery": 40,
+    "internet": 30, "market": 20, "master_book": 10, "bazi_book": 5,
+}
+INTENT_BLOCK_WEIGHT = 70
+# 除意圖標籤外，也比對模式標籤 (chat / full / bazi_full)
+BLOCK_INTENTS = {
+    "master_book": {"full"},
+    "bazi_book": {"bazi", "bazi_full"},
+    "bazi_notes": {"bazi"},
+    "lottery": {"finance"},
+    "market": {"finance", "stock"},
+    "temple": {"temple_love", "temple_finance", "temple_career", "temple_health"},
+}
+# 可截斷的長篇區塊 (秘卷)，預算不足時依行截斷而非整段捨棄
+TRUNCATABLE_BLOCKS = {"master_book", "bazi_book"}
+MIN_TRUNCATE_TOKENS = 150
+
+def block_relevance(block_id, intents):
+    if block_id in TEMPLATES or block_id in STATIC_BLOCKS:
+        base = BLOCK_WEIGHTS.get(block_id, INTENT_BLOCK_WEIGHT)
+    else:
+        base = BLOCK_WEIGHTS.get(block_id, 30)
+    return base + 50 * len(BLOCK_INTENTS.get(block_id, set()) & intents)
+
+def truncate_to_tokens(text, max_tokens):
+    lines = text.split("\n")
+    kept = []
+    used = 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens: break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept)
+
+def fit_blocks(blocks, budget, intents=frozenset()):
+    """依意圖相關度排序，將區塊塞入 token 預算內；回傳 (保留區塊, 捨棄的區塊 id)。"""
+    intents = set(intents)
+    costs = [estimate_tokens(text) for _, text in blocks]
+    remaining = budget - sum(c for (bid, _), c in zip(blocks, costs) if bid in REQUIRED_BLOCKS)
+    chosen = {i: blocks[i] for i, (bid, _) in enumerate(blocks) if bid in REQUIRED_BLOCKS}
+    optional = [i for i, (bid, _) in enumerate(blocks) if bid not in REQUIRED_BLOCKS]
+    optional.sort(key=lambda i: -block_relevance(blocks[i][0], intents))
+    dropped = []
+    for i in optional:
+        bid, text = blocks[i]
+        if costs[i] <= remaining:
+            chosen[i] = blocks[i]
+            remaining -= costs[i]
+        elif bid in TRUNCATABLE_BLOCKS and remaining >= MIN_TRUNCATE_TOKENS:
+            chosen[i] = (bid, truncate_to_tokens(text, remaining))
+            remaining -= estimate_tokens(chosen[i][1])
+        else:
+            dropped.append(bid)
+    return [chosen[i] for i in sorted(chosen)], dropped
+
+
+# --- Prompt Builder ---
+
+class PromptBuilder:
+    """依區塊 id 收集提示詞片段，最後一次性 join；並記錄組裝耗時 (ms)。"""
+
+    def __init__(self):
+        self.blocks = [] # [(block_id, text)]
+        self.elapsed_ms = 0.0
+        self.tokens = 0
+        self.dropped = []
+        self._t0 = time.perf_counter()
+
+    def add(self, block_id, **fields):
+        if block_id in STATIC_BLOCKS:
+            text = STATIC_BLOCKS[block_id]
+        else:
+            text = TEMPLATES[block_id].format(**fields)
+        self.blocks.append((block_id, text))
+        return self
+
+    def add_text(self, block_id, text):
+        if text:
+            self.blocks.append((block_id, text))
+        return self
+
+    @property
+    def block_ids(self):
+        return [b[0] for b in self.blocks]
+
+    def build(self, budget=None, intents=frozenset()):
+        if budget:
+            self.blocks, self.dropped = fit_blocks(self.blocks, budget, intents)
+        result = "".join(text for _, text in self.blocks)
+        self.tokens = sum(estimate_tokens(text) for _, text in self.blocks)
+        self.elapsed_ms = (time.perf_counter() - self._t0) * 1000
+        return result
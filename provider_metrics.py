@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import Counter
+
+from latency import LatencyHistogram
+
+# --- Provider Metrics (AI 供應商延遲與吞吐量統計) ---
+
+# 生成速度的桶 (字/秒)
+RATE_BOUNDS = [5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000]
+ERROR_CLASSES = ("429", "401", "timeout", "5xx", "connection", "other")
+
+def classify_error(e):
+    """將供應商錯誤歸類為 429 / 401 / timeout / 5xx / connection / other。"""
+    err_str = str(e)
+    name = type(e).__name__
+    if "429" in err_str or "RESOURCE_EXHAUSTED" in err_str or "RateLimit" in name:
+        return "429"
+    if "401" in err_str or "Invalid API Key" in err_str or "API_KEY_INVALID" in err_str or "Authentication" in name:
+        return "401"
+    if "Timeout" in name or "timed out" in err_str.lower():
+        return "timeout"
+    if any(f" {code}" in f" {err_str}" for code in ("500", "502", "503", "504")) or "InternalServer" in name:
+        return "5xx"
+    if "Connection" in name or "Connect" in name:
+        return "connection"
+    return "other"
+
+
+class ProviderStats:
+    def __init__(self):
+        self.ttfb = LatencyHistogram()             # 首段輸出等待 (秒)
+        self.total = LatencyHistogram()            # 完整生成時間 (秒)
+        self.chars_per_sec = LatencyHistogram(RATE_BOUNDS)
+        self.calls = 0
+        self.empty = 0                             # 無任何輸出即結束 (金鑰耗盡、斷路、連線失敗)
+        self.chunks = 0
+        self.chars = 0
+        self.gen_seconds = 0.0
+        self.errors = Counter()
+
+
+class ProviderMetrics:
+    """
+    各供應商的 TTFB、總生成時間、字元/段落吞吐量與錯誤類型統計，
+    另記錄備援深度 (第幾個供應商才成功) 與排隊等候時間。全部保存在記憶體中。
+    """
+    def __init__(self, providers=("ollama", "groq", "gemini")):
+        self.providers = {name: ProviderStats() for name in providers}
+        self.fallback_depth = Counter()  # "0" 表示主力即成功；"exhausted" 表示全數失敗
+        self.queue_wait = LatencyHistogram()
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def stats(self, name):
+        with self._lock:
+            return self.providers.setdefault(name, ProviderStats())
+
+    def record_ttfb(self, name, seconds):
+        self.stats(name).ttfb.observe(seconds)
+
+    def record_stream(self, name, total, chunks, chars):
+        st = self.stats(name)
+        with self._lock:
+            st.calls += 1
+            if not chunks:
+                st.empty += 1
+                return
+            st.chunks += chunks
+            st.chars += chars
+            st.gen_seconds += total
+        st.total.observe(total)
+        if total > 0: st.chars_per_sec.observe(chars / total)
+
+    def record_error(self, name, e):
+        st = self.stats(name)
+        with self._lock:
+            st.errors[classify_error(e)] += 1
+
+    def record_fallback(self, depth):
+        with self._lock:
+            self.fallback_depth[str(depth)] += 1
+
+    def record_queue_wait(self, seconds):
+        self.queue_wait.observe(seconds)
+
+    def snapshot(self):
+        out = {}
+        for name, st in list(self.providers.items()):
+            with self._lock:
+                calls, empty, chunks, chars, secs = st.calls, st.empty, st.chunks, st.chars, st.gen_seconds
+                errors = {cls: st.errors.get(cls, 0) for cls in ERROR_CLASSES}
+            out[name] = {
+                "calls": calls,
+                "empty": empty,
+                "chunks": chunks,
+                "chars": chars,
+                "chunks_per_sec": round(chunks / secs, 2) if secs else None,
+                "chars_per_sec": round(chars / secs, 2) if secs else None,
+                "errors": errors,
+                "ttfb": st.ttfb.snapshot(),
+                "total": st.total.snapshot(),
+                "chars_per_sec_hist": st.chars_per_sec.snapshot(),
+            }
+        with self._lock:
+            fallback = dict(self.fallback_depth)
+        return {"uptime": round(time.time() - self.started, 1), "providers": out,
+                "fallback_depth": fallback, "queue_wait": self.queue_wait.snapshot()}
+
+    def prometheus(self, prefix="fate_ai"):
+        """Prometheus text exposition format (0.0.4)。"""
+        lines = []
+        def histogram(metric, help_text, series):
+            # series: [(標籤字串, 直方圖)]；同一指標的 HELP/TYPE 只能出現一次
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} histogram")
+            for label, hist in series:
+                snap = hist.snapshot()
+                for upper, cum in cumulative(snap):
+                    lines.append(f'{prefix}_{metric}_bucket{{{label + "," if label else ""}le="{upper}"}} {cum}')
+                selector = f"{{{label}}}" if label else ""
+                lines.append(f"{prefix}_{metric}_sum{selector} {round(hist.total, 6)}")
+                lines.append(f"{prefix}_{metric}_count{selector} {snap['count']}")
+
+        providers = list(self.providers.items())
+        histogram("ttfb_seconds", "Time to first chunk.", [(f'provider="{n}"', st.ttfb) for n, st in providers])
+        histogram("generation_seconds", "Total generation time.", [(f'provider="{n}"', st.total) for n, st in providers])
+        histogram("chars_per_second", "Generation throughput.", [(f'provider="{n}"', st.chars_per_sec) for n, st in providers])
+        lines.append(f"# TYPE {prefix}_calls_total counter")
+        lines.append(f"# TYPE {prefix}_chars_total counter")
+        lines.append(f"# TYPE {prefix}_errors_total counter")
+        with self._lock:
+            for name, st in self.providers.items():
+                lines.append(f'{prefix}_calls_total{{provider="{name}"}} {st.calls}')
+                lines.append(f'{prefix}_chars_total{{provider="{name}"}} {st.chars}')
+                for cls in ERROR_CLASSES:
+                    lines.append(f'{prefix}_errors_total{{provider="{name}",class="{cls}"}} {st.errors.get(cls, 0)}')
+            lines.append(f"# TYPE {prefix}_fallback_depth_total counter")
+            for depth, count in sorted(self.fallback_depth.items()):
+                lines.append(f'{prefix}_fallback_depth_total{{depth="{depth}"}} {count}')
+        histogram("queue_wait_seconds", "Admission queue wait.", [("", self.queue_wait)])
+        return "\n".join(lines) + "\n"
+
+
+def cumulative(snap):
+    """直方圖快照 -> [(上界, 累計數)] (Prometheus 桶為累計)。"""
+    seen = 0
+    out = []
+    for upper, count in snap["buckets"].items():
+        seen += count
+        out.append((upper, seen))
+    return out
+
+
+def measured_stream(gen, metrics, name):
+    """轉送串流並記錄 TTFB、總時間與吞吐量；中途被關閉 (對沖落敗、用戶離線) 的串流只記 TTFB。"""
+    start = time.time()
+    chunks = chars = 0
+    for chunk in gen:
+        if not chunks: metrics.record_ttfb(name, time.time() - start)
+        chunks += 1
+        chars += len(chunk)
+        yield chunk
+    metrics.record_stream(name, time.time() - start, chunks, chars)
+
+async def ameasured_stream(agen, metrics, name):
+    start = time.time()
+    chunks = chars = 0
+    async for chunk in agen:
+        if not chunks: metrics.record_ttfb(name, time.time() - start)
+        chunks += 1
+        chars += len(chunk)
+        yield chunk
+    metrics.record_stream(name, time.time() - start, chunks, chars)
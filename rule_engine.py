@@ -435,6 +435,7 @@ def evaluate_rules(chart, rules):
                 res_obj = rule["result"].copy()
                 res_obj["category"] = rule.get("category", "")
                 res_obj["description"] = rule.get("description", "")
+                res_obj["rule_id"] = rule.get("id", "")
                 
                 # --- 新增：識別規則類別類型 ---
                 def detect_group(cond):
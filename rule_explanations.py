@@ -0,0 +1,89 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime
+
+# --- Precomputed Rule Explanations (規則解讀快取) ---
+# 由 build_rule_explanations.py 離線生成，格式：{"model": ..., "updated": ..., "items": {規則id: 解讀}}
+
+RULE_EXPLANATIONS_FILE = 'ziwei_rule_explanations.json'
+
+# --- 編號批次協定 (離線預生成與 server_headless 即時批註共用) ---
+# 一次送出數條以 <<編號>> 標示的格局，AI 依相同編號逐一作答，再拆回各條規則。
+NUMBERED = re.compile(r"<<(\d+)>>")
+NUMBERED_PARTIAL = re.compile(r"<(<\d*>?)?$")  # 串流時可能被切斷的標記尾巴 (例如 "<<1")
+BATCH_HEADER = "請逐一解釋以下紫微斗數格局："
+BATCH_SYSTEM_PROMPT = """你是一位精通紫微斗數的命理大師。
+你會收到數個以 <<編號>> 標示的「命理格局」。請針對每一個格局進行【白話解釋】：代表什麼意思？對人生有什麼具體影響（吉凶、性格、運勢）？
+【輸出格式】：依序以相同的 <<編號>> 開頭回答每一則，例如「<<1>> 解釋內容」，每則 50-80 字，使用台灣繁體中文，不要重複題目，不要輸出其他內容。"""
+
+def rule_prompt_line(rule):
+    """單條規則的提示詞描述 (ziwei_rules.json 原始格式或規則引擎的命中結果皆可)。"""
+    text = rule["result"].get("text", "") if isinstance(rule.get("result"), dict) else rule.get("text", "")
+    return f"格局：「{rule.get('description', '')}」。內容：「{text}」"
+
+def build_batch_prompt(rules):
+    return BATCH_HEADER + "\n" + "\n".join(f"<<{i}>> {rule_prompt_line(r)}" for i, r in enumerate(rules, 1))
+
+def split_numbered(text, count):
+    """將以 <<編號>> 分段的批次回答拆回 {編號: 內容}，只保留 1..count 且非空的段落。"""
+    out = {}
+    parts = NUMBERED.split(text or "")
+    for i in range(1, len(parts) - 1, 2):
+        n = int(parts[i])
+        body = parts[i + 1].strip()
+        if 1 <= n <= count and body and n not in out:
+            out[n] = body
+    return out
+
+def load_explanations(path=RULE_EXPLANATIONS_FILE):
+    if not os.path.exists(path): return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("items", {})
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return {}
+
+def save_explanations(items, model="", path=RULE_EXPLANATIONS_FILE):
+    """原子寫入 (先寫暫存檔再取代)，中途中斷也不會留下損毀的檔案。"""
+    data = {"model": model, "updated": datetime.now().isoformat(), "items": items}
+    tmp = path + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+class RuleExplanations:
+    """規則解讀的唯讀存取；檔案被離線工作更新後，下次查詢時自動重新載入。"""
+    def __init__(self, path=RULE_EXPLANATIONS_FILE):
+        self.path = path
+        self.items = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self.items = load_explanations(self.path)
+                    self._mtime = mtime
+
+    def get(self, rule_id):
+        if not rule_id: return None
+        self._refresh()
+        return self.items.get(rule_id)
+
+    def split(self, results):
+        """將規則引擎命中結果分為 (已有解讀 [(結果, 解讀)], 需即時生成 [結果])。"""
+        cached, live = [], []
+        for res in results:
+            exp = self.get(res.get('rule_id'))
+            if exp: cached.append((res, exp))
+            else: live.append(res)
+        return cached, live
@@ -6,6 +6,7 @@ import threading
 import logging
 import subprocess
 import time
+import re
 from datetime import datetime
 from flask import Flask, request, jsonify, make_response, send_file, Response, stream_with_context, send_from_directory
 from flask_cors import CORS
@@ -13,6 +14,7 @@ import lunar_python
 from lunar_python import Lunar, Solar
 from master_book import MASTER_BOOK
 from rule_engine import create_chart_from_dict, evaluate_rules, PALACE_NAMES
+from rule_explanations import RuleExplanations, NUMBERED, NUMBERED_PARTIAL, BATCH_SYSTEM_PROMPT, build_batch_prompt
 
 # --- Configuration & Constants Loading ---
 
@@ -165,6 +167,133 @@ def call_gemini_api(prompt, system_prompt="", stream=True):
             return None
     return None
 
+# --- Streaming & Rate Limiting ---
+
+GEMINI_SESSION = requests.Session()
+
+class RateLimiter:
+    """簡易最小間隔限流器 (執行緒安全)，取代每次呼叫前固定 sleep。"""
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.min_interval
+        if delay > 0: time.sleep(delay)
+
+GEMINI_LIMITER = RateLimiter(CONFIG['gemini'].get('min_request_interval', 1.0))
+
+def stream_gemini_api(prompt, system_prompt=""):
+    """以 streamGenerateContent (SSE) 串流呼叫 Gemini，逐段回傳供應商實際輸出的文字。"""
+    if not GEMINI_API_KEY:
+        return
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+    payload = {
+        "contents": [{"parts": [{"text": f"{system_prompt}\n\n{prompt}"}]}],
+        "generationConfig": {
+            "temperature": CONFIG['gemini'].get('temperature', 0.7),
+            "maxOutputTokens": CONFIG['gemini'].get('max_output_tokens', 1024),
+        },
+        "safetySettings": [
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+        ]
+    }
+    max_retries = 8
+    for attempt in range(max_retries):
+        GEMINI_LIMITER.wait()
+        try:
+            with GEMINI_SESSION.post(url, json=payload, stream=True, timeout=120) as response:
+                if response.status_code == 429:
+                    wait_time = (attempt + 1) * 5
+                    print(f"Gemini API 429 (Attempt {attempt+1}/{max_retries}). Sleeping {wait_time}s...")
+                    time.sleep(wait_time)
+                    continue
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"): continue
+                    try:
+                        data = json.loads(line[5:].strip())
+                        for part in data['candidates'][0]['content']['parts']:
+                            if part.get('text'): yield part['text']
+                    except (KeyError, IndexError, ValueError):
+                        continue
+                return
+        except Exception as e:
+            print(f"Gemini Stream Error: {e}")
+            return
+
+# --- Batched Rule Explanations ---
+
+RULE_EXPLANATIONS = RuleExplanations() # 離線預生成的逐條規則解讀 (build_rule_explanations.py)
+
+BATCH_EXPLAIN_SIZE = CONFIG['gemini'].get('batch_explain_size', 15)
+
+def format_rule_line(res):
+    return f"● 【{res.get('detected_palace_names', '全盤')}】{res.get('description', '')}：{res.get('text', '')}\n"
+
+def stream_batched_explanations(rules, chunks):
+    """
+    將一次批次回應 (依 <<編號>> 分段) 解析回各條規則，邊收邊輸出：
+    遇到新編號時先補上被跳過的規則，再輸出該規則標題與解讀。
+    """
+    emitted = 0        # 已輸出標題的規則數
+    current = None     # 目前正在輸出解讀的規則編號
+    at_start = False   # 新規則剛開頭，略過前導空白
+    buf = ""
+
+    def open_rule(n):
+        nonlocal emitted, current, at_start
+        out = ["\n\n"] if current is not None else []
+        while emitted < n - 1:
+            out.append(format_rule_line(rules[emitted]) + "  (大師沈默...)\n\n")
+            emitted += 1
+        out.append(format_rule_line(rules[n - 1]) + "  ↳ 💡大師解讀：")
+        emitted, current, at_start = n, n, True
+        return "".join(out)
+
+    def body(text):
+        nonlocal at_start
+        if at_start:
+            text = text.lstrip()
+            if text: at_start = False
+        return text
+
+    for chunk in chunks:
+        buf += chunk
+        m = NUMBERED.search(buf)
+        while m:
+            before, buf = buf[:m.start()], buf[m.end():]
+            if current is not None:
+                text = body(before.rstrip())
+                if text: yield text
+            n = int(m.group(1))
+            if emitted < n <= len(rules):
+                yield open_rule(n)
+            m = NUMBERED.search(buf)
+        # 保留可能被切斷的標記尾巴 (例如 "<<1") 與結尾空白，其餘即時送出
+        p = NUMBERED_PARTIAL.search(buf)
+        cut = p.start() if p else len(buf)
+        safe = buf[:cut].rstrip()
+        buf = buf[len(safe):]
+        if current is not None:
+            text = body(safe)
+            if text: yield text
+
+    if current is not None:
+        text = body(buf.rstrip())
+        if text: yield text
+        yield "\n\n"
+    while emitted < len(rules):
+        yield format_rule_line(rules[emitted]) + "  (大師沈默...)\n\n"
+        emitted += 1
+
 def get_current_year_ganzhi():
     """Calculates the Heavenly Stem and Earthly Branch for the current year."""
     now = datetime.now()
@@ -372,12 +501,12 @@ def chat():
 
         def call_ai_engine(target_prompt, target_system_prompt):
             if GEMINI_API_KEY:
-                res = call_gemini_api(target_prompt, target_system_prompt)
-                if res:
-                    chunk_size = 3
-                    for i in range(0, len(res), chunk_size):
-                        yield res[i:i+chunk_size]
-                        time.sleep(0.01)
+                # 直接轉送供應商的串流片段 (不再把完整回應切成假串流)
+                has_content = False
+                for chunk in stream_gemini_api(target_prompt, target_system_prompt):
+                    has_content = True
+                    yield chunk
+                if has_content:
                     return True
             
             yield "【系統訊息】無法連接 AI 服務 (Gemini Key 未設定或連線失敗)。\n"
@@ -453,17 +582,31 @@ def chat():
             def process_group(group, title):
                 if not group: return
                 yield f"\n{title}\n------------------------------------------\n"
+                # 已預先生成解讀的規則立即輸出，只有未收錄的規則才呼叫 AI
+                known, group = RULE_EXPLANATIONS.split(group)
+                for res, exp in known:
+                    yield format_rule_line(res) + f"  ↳ 💡大師解讀：{exp}\n\n"
+                if not group: return
+                if GEMINI_API_KEY and CONFIG['gemini'].get('batch_explain', True):
+                    # 批次模式：整組規則以一個結構化提示詞送出 (每批至多 BATCH_EXPLAIN_SIZE 條)，再依編號拆回各條
+                    for start in range(0, len(group), BATCH_EXPLAIN_SIZE):
+                        batch = group[start:start + BATCH_EXPLAIN_SIZE]
+                        try:
+                            yield from stream_batched_explanations(batch, stream_gemini_api(build_batch_prompt(batch), BATCH_SYSTEM_PROMPT))
+                        except Exception as e:
+                            yield f"  (連線異常: {str(e)})\n\n"
+                    return
+
                 for res in group:
-                    palace = res.get('detected_palace_names', '全盤')
                     desc = res.get('description', '')
                     text = res.get('text', '')
-                    yield f"● 【{palace}】{desc}：{text}\n"
+                    yield format_rule_line(res)
                     
                     if GEMINI_API_KEY:
                         mini_prompt = f"請解釋紫微斗數格局：「{desc}」。\n格局內容：「{text}」。\n這代表什麼意思？"
                         try:
-                            time.sleep(1)
-                            explanation = call_gemini_api(mini_prompt, explanation_system_prompt)
+                            # 逐條模式：由 GEMINI_LIMITER 控制請求間隔
+                            explanation = "".join(stream_gemini_api(mini_prompt, explanation_system_prompt))
                             if explanation:
                                 yield f"  ↳ 💡大師解讀：{explanation}\n\n"
                             else:
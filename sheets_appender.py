@@ -0,0 +1,161 @@
+import json
+import os
+import re
+import threading
+import time
+
+from key_scheduler import KeyScheduler, extract_retry_after
+
+# --- Google Sheets Appender (試算表批次附加) ---
+# 取代「每筆對話 / 紀錄各開一條執行緒、各發一次 values().append」：
+# - 每個工作表 ("Chats"、"Users") 各有一條背景執行緒，每 interval 秒把累積的列合併成一次 append 呼叫。
+# - 所有工作表共用一個令牌桶 (沿用 KeyScheduler)，遇 429 依 retry-after 冷卻並降速；其他錯誤以指數退避重試。
+# - 尚未送出的列同步附加到 pending_dir/<工作表>.jsonl，送出成功後改寫為剩餘的列；重啟時自動載回補送。
+# - 429 / 408 以外的 4xx (工作表不存在、範圍錯誤、儲存格過長等) 重試也不會成功：該批移至
+#   pending_dir/<工作表>.failed.jsonl 後繼續送後面的列，不讓一批壞資料卡住整個佇列。
+# - 待送列超過 max_pending 時 (長時間中斷)，最舊的一成同樣移至 .failed.jsonl，記憶體與待送檔不會無限成長。
+
+SHEETS_QUOTA_KEY = "spreadsheet"
+_STATUS_RE = re.compile(r"\s*(?:<HttpError\s+)?(\d{3})\b")
+
+def http_status(error):
+    """從例外取出 HTTP 狀態碼 (googleapiclient HttpError 的 resp.status 或訊息開頭)，取不到回傳 None。"""
+    for holder in (error, getattr(error, "resp", None), getattr(error, "response", None)):
+        for attr in ("status_code", "status"):
+            val = getattr(holder, attr, None)
+            if isinstance(val, int): return val
+            if isinstance(val, str) and val.isdigit(): return int(val)
+    m = _STATUS_RE.match(str(error))
+    return int(m.group(1)) if m else None
+
+def is_permanent(error):
+    """4xx (429 / 408 除外) 視為無法以重試解決。"""
+    status = http_status(error)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+class SheetsAppender:
+    def __init__(self, append_rows, sheets=("Chats", "Users"), interval=2.0, batch_size=500,
+                 rate_per_min=50, burst=5, pending_dir="sheets_pending", max_backoff=300, max_pending=20000):
+        self.append_rows = append_rows  # append_rows(工作表名稱, [列, ...])，失敗時拋出例外
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending_dir = pending_dir
+        self.max_backoff = max_backoff
+        self.limiter = KeyScheduler("sheets", [SHEETS_QUOTA_KEY], rate_per_min=rate_per_min, burst=burst)
+        self._sheets = {}
+        os.makedirs(pending_dir, exist_ok=True)
+        for name in sheets:
+            self._sheets[name] = state = {
+                "rows": self._load_pending(name), "cond": threading.Condition(),
+                "sent": 0, "calls": 0, "failures": 0, "failed_rows": 0, "backoff": 0, "last_error": None,
+            }
+            self._trim(name, state)
+            if state["rows"]: print(f"📤 試算表 {name} 有 {len(state['rows'])} 列待補送。")
+            threading.Thread(target=self._run, args=(name,), daemon=True, name=f"sheets-{name}").start()
+
+    def _pending_path(self, name):
+        return os.path.join(self.pending_dir, f"{name}.jsonl")
+
+    def _load_pending(self, name):
+        rows = []
+        try:
+            with open(self._pending_path(name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        continue  # 當機留下的半行
+        except OSError:
+            pass
+        return rows
+
+    def _rewrite_pending(self, name, rows):
+        path = self._pending_path(name)
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in rows)
+        os.replace(tmp, path)
+
+    def _dead_letter(self, name, rows, reason):
+        """無法送出的列移至 <工作表>.failed.jsonl (保留原因，可人工修正後補送)。"""
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(os.path.join(self.pending_dir, f"{name}.failed.jsonl"), 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps({"time": stamp, "error": reason, "row": r}, ensure_ascii=False, default=str) + "\n" for r in rows)
+        self._sheets[name]["failed_rows"] += len(rows)
+        print(f"🚫 試算表 {name}：{len(rows)} 列無法送出 ({reason})，已移至 {name}.failed.jsonl。")
+
+    def _trim(self, name, st):
+        """待送列超過 max_pending 時，將最舊的一成 (至少超出部分) 移出佇列。呼叫端須持有 st["cond"]。"""
+        if len(st["rows"]) <= self.max_pending: return
+        drop = max(len(st["rows"]) - self.max_pending, self.max_pending // 10)
+        self._dead_letter(name, st["rows"][:drop], f"待送列超過上限 {self.max_pending}")
+        del st["rows"][:drop]
+        self._rewrite_pending(name, st["rows"])
+
+    def put(self, name, row):
+        """排入一列 (同時記入待送檔) 並立即返回。"""
+        st = self._sheets[name]
+        with st["cond"]:
+            st["rows"].append(row)
+            with open(self._pending_path(name), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+            self._trim(name, st)
+            if len(st["rows"]) >= self.batch_size: st["cond"].notify()
+
+    def _run(self, name):
+        st = self._sheets[name]
+        while True:
+            with st["cond"]:
+                st["cond"].wait(self.interval + st["backoff"])
+                batch = list(st["rows"][:self.batch_size])
+            if not batch: continue
+            key = self.limiter.acquire(max_wait=self.interval)
+            if key is None: continue  # 配額用盡：留待下一輪
+            try:
+                self.append_rows(name, batch)
+            except Exception as e:
+                st["failures"] += 1
+                st["last_error"] = str(e)
+                retry_after = extract_retry_after(e)
+                if retry_after is not None or "429" in str(e):
+                    self.limiter.on_throttle(key, retry_after)
+                elif is_permanent(e):
+                    self.limiter.on_error(key)
+                    with st["cond"]:
+                        self._dead_letter(name, batch, str(e)[:500])
+                        self._remove_sent(name, st, batch)
+                else:
+                    self.limiter.on_error(key)
+                    st["backoff"] = min(self.max_backoff, max(self.interval, st["backoff"] * 2))
+                continue
+            self.limiter.on_success(key)
+            with st["cond"]:
+                self._remove_sent(name, st, batch)
+                st["sent"] += len(batch)
+                st["calls"] += 1
+
+    def _remove_sent(self, name, st, batch):
+        """自佇列移除已處理的批次 (依物件識別，送出期間 _trim 可能已先移掉最舊的列)。呼叫端須持有 st["cond"]。"""
+        done = {id(r) for r in batch}
+        st["rows"] = [r for r in st["rows"] if id(r) not in done]
+        self._rewrite_pending(name, st["rows"])
+        st["backoff"] = 0
+
+    def flush(self, timeout=10):
+        """等候所有工作表的列送出 (或逾時)；回傳是否已清空。"""
+        deadline = time.time() + timeout
+        for st in self._sheets.values():
+            with st["cond"]: st["cond"].notify()
+        while time.time() < deadline:
+            if all(not st["rows"] for st in self._sheets.values()): return True
+            time.sleep(0.05)
+        return False
+
+    def snapshot(self):
+        out = {}
+        for name, st in self._sheets.items():
+            with st["cond"]:
+                out[name] = {"pending": len(st["rows"]), "sent": st["sent"], "calls": st["calls"],
+                             "failures": st["failures"], "failed_rows": st["failed_rows"], "backoff": st["backoff"], "last_error": st["last_error"]}
+        return out
@@ -0,0 +1,185 @@
+"""
+紫微天機：本地 SQLite 儲存 (SQLite Store)
+=======================================
+未連線 MongoDB 時的本地資料庫，取代每次都整檔讀寫的 user_records.json / 對話紀錄：
+- WAL 模式 (讀寫互不阻塞)，每個執行緒各自持有連線，所有查詢皆為參數化語句 (由 sqlite3 快取編譯結果)。
+- 常用欄位獨立成欄並建立索引 (timestamp / name / birth_date)，完整內容另存於 data 欄 (JSON)。
+- 首次啟用時由 JSON 檔匯入既有資料 (只執行一次，記錄於 meta 表)。
+
+手動匯入：
+    python sqlite_store.py --db fate_purple.db --records user_records.json --chats chat_history.json
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT, name TEXT, gender TEXT, birth_date TEXT, birth_hour TEXT, lunar_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT, model TEXT, user_name TEXT, birth_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX IF NOT EXISTS idx_records_timestamp ON records(timestamp);
+CREATE INDEX IF NOT EXISTS idx_records_name ON records(name);
+CREATE INDEX IF NOT EXISTS idx_records_birth_date ON records(birth_date);
+CREATE INDEX IF NOT EXISTS idx_chats_timestamp ON chats(timestamp);
+CREATE INDEX IF NOT EXISTS idx_chats_user_name ON chats(user_name);
+CREATE INDEX IF NOT EXISTS idx_chats_birth_date ON chats(birth_date);
+"""
+
+# 各表獨立成欄的欄位 (其餘內容只存在 data 欄)
+COLUMNS = {
+    "records": ("timestamp", "name", "gender", "birth_date", "birth_hour", "lunar_date"),
+    "chats": ("timestamp", "model", "user_name", "birth_date"),
+}
+
+# 管理介面依姓名篩選時使用的欄位
+NAME_COLUMN = {"records": "name", "chats": "user_name"}
+
+def column_value(value):
+    return None if value is None else str(value)
+
+def like_pattern(text):
+    """子字串比對用的 LIKE 樣式 (跳脫 % 與 _)。"""
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- 寫入 ---
+    def insert(self, table, entry):
+        self.insert_many(table, [entry])
+
+    def _insert_rows(self, conn, table, entries):
+        cols = COLUMNS[table]
+        sql = f"INSERT INTO {table} ({', '.join(cols)}, data) VALUES ({', '.join('?' * (len(cols) + 1))})"
+        rows = [tuple(column_value(e.get(c)) for c in cols) + (json.dumps(e, ensure_ascii=False),) for e in entries]
+        conn.executemany(sql, rows)
+
+    def insert_many(self, table, entries):
+        conn = self._conn()
+        with conn:
+            self._insert_rows(conn, table, entries)
+
+    def replace(self, table, entries):
+        """以整份清單取代資料表內容 (相容舊 save_json_file 介面)，於同一交易內完成。"""
+        conn = self._conn()
+        with conn:
+            conn.execute(f"DELETE FROM {table}")
+            self._insert_rows(conn, table, entries)
+
+    def delete_ids(self, table, ids):
+        conn = self._conn()
+        with conn:
+            conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(i,) for i in ids])
+
+    # --- 查詢 ---
+    def count(self, table):
+        return self._conn().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def recent(self, table, limit=50, offset=0):
+        """依時間由新到舊分頁查詢。"""
+        rows = self._conn().execute(
+            f"SELECT data FROM {table} ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def page(self, table, before=None, date_from=None, date_to=None, name=None, model=None, text=None, limit=50):
+        """
+        依時間由新到舊的游標分頁 (keyset，走 timestamp 索引，不受頁數影響)。
+        before 為上一頁最後一筆的 (timestamp, id)；text 比對完整內容 (提問與回覆)。回傳 [(id, 紀錄)]。
+        """
+        where, params = [], []
+        if before:
+            where.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params += [before[0], before[0], before[1]]
+        if date_from:
+            where.append("timestamp >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("timestamp <= ?")
+            params.append(date_to)
+        if name:
+            where.append(f"{NAME_COLUMN[table]} LIKE ? ESCAPE '\\'")
+            params.append(like_pattern(name))
+        if model and table == "chats":
+            where.append("model LIKE ? ESCAPE '\\'")
+            params.append(like_pattern(model))
+        if text:
+            where.append("data LIKE ? ESCAPE '\\'")
+            params.append(like_pattern(text))
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        rows = self._conn().execute(
+            f"SELECT id, data FROM {table}{clause} ORDER BY timestamp DESC, id DESC LIMIT ?", params + [limit]).fetchall()
+        return [(r[0], json.loads(r[1])) for r in rows]
+
+    def older_than(self, table, cutoff, limit=1000):
+        """timestamp 早於 cutoff 的最舊 limit 筆 (供封存)；回傳 [(id, 紀錄)]。"""
+        rows = self._conn().execute(
+            f"SELECT id, data FROM {table} WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?", (cutoff, limit)).fetchall()
+        return [(r[0], json.loads(r[1])) for r in rows]
+
+    def all(self, table):
+        """全部資料 (由舊到新)，供仍需完整清單的舊介面使用。"""
+        rows = self._conn().execute(f"SELECT data FROM {table} ORDER BY timestamp, id").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    # --- 一次性匯入 ---
+    def imported(self, table):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (f"imported:{table}",)).fetchone()
+        return row is not None
+
+    def import_entries(self, table, entries, source=""):
+        """資料表尚未匯入過時寫入既有資料；回傳匯入筆數 (已匯入過回傳 0)。"""
+        if self.imported(table): return 0
+        entries = [e for e in entries if isinstance(e, dict)]
+        conn = self._conn()
+        with conn:
+            self._insert_rows(conn, table, entries)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"imported:{table}", source))
+        return len(entries)
+
+
+def read_json_list(path):
+    if not path or not os.path.exists(path): return []
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data if isinstance(data, list) else []
+
+def main():
+    parser = argparse.ArgumentParser(description="將 JSON 紀錄匯入本地 SQLite 資料庫")
+    parser.add_argument("--db", default="fate_purple.db")
+    parser.add_argument("--records", default="user_records.json")
+    parser.add_argument("--chats", default="chat_history.json")
+    args = parser.parse_args()
+    store = SQLiteStore(args.db)
+    for table, path in (("records", args.records), ("chats", args.chats)):
+        if store.imported(table):
+            print(f"{table}: 先前已匯入，略過。")
+            continue
+        n = store.import_entries(table, read_json_list(path), path)
+        print(f"{table}: 匯入 {n} 筆 (共 {store.count(table)} 筆)")
+
+if __name__ == "__main__":
+    main()
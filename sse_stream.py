@@ -0,0 +1,182 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+# --- Server-Sent Events (可續傳的生成緩衝) ---
+# 每次生成的輸出先寫入伺服器端緩衝，生產端與用戶端連線分離：
+# 行動裝置中途斷線時生成照常完成，重連時帶 Last-Event-ID 即可從斷點續讀，不必重跑規則引擎與 AI 呼叫。
+# 事件 id 格式為 "<generation_id>:<序號>"，序號為該段輸出在緩衝中的位置。
+
+def parse_event_id(value):
+    """'<generation_id>:<序號>' -> (generation_id, 下一個要送出的序號)；格式不符回傳 (None, 0)。"""
+    gen_id, sep, idx = str(value or "").strip().rpartition(":")
+    if not sep or not gen_id or not idx.isdigit(): return None, 0
+    return gen_id, int(idx) + 1
+
+def format_event(data, event_id=None, event=None):
+    """組成一則 SSE 事件；多行內容拆成多個 data: 行 (用戶端會以換行接回)。"""
+    lines = []
+    if event: lines.append(f"event: {event}")
+    if event_id is not None: lines.append(f"id: {event_id}")
+    lines += [f"data: {line}" for line in str(data).split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+
+class GenerationBuffer:
+    """單次生成的輸出緩衝 (執行緒安全)；同步讀取者以 Condition 等候，asyncio 讀取者以 Event 等候。"""
+    def __init__(self, gen_id):
+        self.id = gen_id
+        self.chunks = []
+        self.done = False
+        self.created = time.time()
+        self.finished_at = None
+        self.task = None  # asyncio 生產端 task (保留參照，避免被回收)
+        self._cond = threading.Condition()
+        self._waiters = set()  # {(loop, asyncio.Event)}
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, event in list(self._waiters):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                self._waiters.discard((loop, event))  # 事件迴圈已關閉
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._notify()
+
+    def read(self, start, timeout):
+        """回傳 (序號 start 之後的輸出, 是否已結束)；暫無新輸出時最多等候 timeout 秒。"""
+        with self._cond:
+            if len(self.chunks) <= start and not self.done:
+                self._cond.wait(timeout)
+            return self.chunks[start:], self.done
+
+    async def aread(self, start, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._cond:
+            if len(self.chunks) > start or self.done:
+                return self.chunks[start:], self.done
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond: self._waiters.discard(waiter)
+        with self._cond:
+            return self.chunks[start:], self.done
+
+
+class GenerationStore:
+    """
+    保存近期的生成緩衝：生成結束後保留 ttl 秒供重連續讀；
+    超過 max_buffers 時先淘汰最早結束的緩衝 (進行中的生成不淘汰)。
+    """
+    def __init__(self, ttl=300, max_buffers=200):
+        self.ttl = ttl
+        self.max_buffers = max_buffers
+        self.resumed = 0
+        self.expired = 0
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        finished = sorted((b.finished_at, gid) for gid, b in self._buffers.items() if b.done)
+        for finished_at, gid in finished:
+            if now - finished_at > self.ttl or len(self._buffers) > self.max_buffers:
+                del self._buffers[gid]
+
+    def create(self):
+        buf = GenerationBuffer(uuid.uuid4().hex)
+        with self._lock:
+            self._evict(time.time())
+            self._buffers[buf.id] = buf
+        return buf
+
+    def get(self, gen_id):
+        with self._lock:
+            buf = self._buffers.get(gen_id)
+            if buf and buf.done and time.time() - buf.finished_at > self.ttl:
+                del self._buffers[gen_id]
+                buf = None
+            if buf: self.resumed += 1
+            else: self.expired += 1
+            return buf
+
+    def start(self, gen_factory):
+        """於背景執行緒執行產生器並寫入新緩衝 (用戶端斷線不影響生成)。"""
+        buf = self.create()
+        def run():
+            try:
+                for chunk in gen_factory():
+                    if chunk: buf.append(chunk)
+            except Exception as e:
+                print(f"⚠️ [SSE] 生成 {buf.id[:8]} 錯誤: {e}")
+            finally:
+                buf.finish()
+        threading.Thread(target=run, daemon=True).start()
+        return buf
+
+    def astart(self, agen_factory):
+        """於目前事件迴圈以 task 執行 async 產生器並寫入新緩衝。"""
+        buf = self.create()
+        async def run():
+            try:
+                async for chunk in agen_factory():
+                    if chunk: buf.append(chunk)
+            except Exception as e:
+                print(f"⚠️ [SSE] 生成 {buf.id[:8]} 錯誤: {e}")
+            finally:
+                buf.finish()
+        buf.task = asyncio.ensure_future(run())
+        return buf
+
+    def snapshot(self):
+        with self._lock:
+            active = sum(1 for b in self._buffers.values() if not b.done)
+            return {"buffers": len(self._buffers), "active": active, "resumed": self.resumed, "expired": self.expired}
+
+
+def meta_event(buf, resume_path):
+    return format_event(json.dumps({"generation_id": buf.id, "resume_url": f"{resume_path}/{buf.id}"}), event="meta")
+
+def event_for(buf, idx, chunk, status_type=None):
+    event = "status" if status_type is not None and isinstance(chunk, status_type) else None
+    return format_event(chunk, f"{buf.id}:{idx}", event)
+
+def sse_events(buf, start=0, heartbeat=15, status_type=None):
+    """將緩衝內容自序號 start 起轉為 SSE 文字；等候期間每 heartbeat 秒送出註解行保持連線。"""
+    idx = start
+    while True:
+        chunks, done = buf.read(idx, heartbeat)
+        for chunk in chunks:
+            yield event_for(buf, idx, chunk, status_type)
+            idx += 1
+        if done and not chunks:
+            yield format_event("", event="done")
+            return
+        if not chunks: yield ": keep-alive\n\n"
+
+async def asse_events(buf, start=0, heartbeat=15, status_type=None):
+    idx = start
+    while True:
+        chunks, done = await buf.aread(idx, heartbeat)
+        for chunk in chunks:
+            yield event_for(buf, idx, chunk, status_type)
+            idx += 1
+        if done and not chunks:
+            yield format_event("", event="done")
+            return
+        if not chunks: yield ": keep-alive\n\n"
@@ -0,0 +1,59 @@
+import base64
+import gzip
+
+# --- Stream Capture (串流回應側錄) ---
+# 串流輸出時同步側錄完整內容供對話紀錄使用：以 list 收集片段、結束時只 join 一次 (避免 += 的平方成本)，
+# 超過 max_chars 後不再保留 (標記為已截斷)；狀態訊息 (排隊名次等) 不列入紀錄。
+
+TRUNCATED_NOTE = "\n…(內容過長，紀錄已截斷)"
+
+class StreamCapture:
+    def __init__(self, max_chars=200000, skip=()):
+        self.max_chars = max_chars
+        self.skip = tuple(skip)  # 不列入紀錄的片段型別 (如 StatusText)
+        self.parts = []
+        self.chars = 0
+        self.truncated = False
+
+    def add(self, chunk):
+        if not chunk or (self.skip and isinstance(chunk, self.skip)): return
+        room = self.max_chars - self.chars
+        if room <= 0:
+            self.truncated = True
+            return
+        if len(chunk) > room:
+            chunk = chunk[:room]
+            self.truncated = True
+        self.parts.append(str(chunk))
+        self.chars += len(chunk)
+
+    def tee(self, gen):
+        """轉送串流並側錄。"""
+        for chunk in gen:
+            self.add(chunk)
+            yield chunk
+
+    async def atee(self, agen):
+        async for chunk in agen:
+            self.add(chunk)
+            yield chunk
+
+    def text(self):
+        return "".join(self.parts) + (TRUNCATED_NOTE if self.truncated else "")
+
+
+def compress_text(text):
+    """gzip + base64 (供紀錄中過長的回覆壓縮保存)。"""
+    return base64.b64encode(gzip.compress(text.encode('utf-8'))).decode('ascii')
+
+def decompress_text(data):
+    return gzip.decompress(base64.b64decode(data)).decode('utf-8')
+
+def full_response(entry):
+    """對話紀錄的完整回覆 (若回覆經壓縮保存則解壓)。"""
+    if entry.get("response_gz"):
+        try:
+            return decompress_text(entry["response_gz"])
+        except Exception:
+            pass
+    return entry.get("response")
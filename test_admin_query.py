@@ -0,0 +1,84 @@
+import pytest
+from admin_query import parse_query, page_log, page_search, page_sqlite, mongo_filter, decode_cursor, encode_cursor
+from chat_log_store import ChatLogStore
+from chat_search import ChatSearchIndex
+from sqlite_store import SQLiteStore
+
+def chat(i):
+    return {"timestamp": f"2026-01-{1 + i // 10:02d}T10:00:00", "user_name": "王小明" if i % 2 else "陳小華",
+            "model": "Groq-Report" if i % 3 == 0 else "Gemini-chat", "prompt": f"問題{i} 財帛宮",
+            "response": ("化祿 " if i % 5 == 0 else "平順 ") + "x" * (3000 if i == 7 else 10)}
+
+CHATS = [chat(i) for i in range(25)]  # 同一天的紀錄 timestamp 相同，須靠鍵值分頁
+
+def all_pages(fetch, args):
+    seen, cursor = [], None
+    while True:
+        page = fetch(parse_query(dict(args, cursor=cursor or "")))
+        seen += page["items"]
+        cursor = page["next_cursor"]
+        if not cursor: return seen
+
+@pytest.fixture
+def log(tmp_path):
+    store = ChatLogStore(str(tmp_path / "logs"), max_entries=None, segment_size=7, fsync=False)
+    for c in CHATS: store.append(c)
+    store.flush()
+    return store
+
+def test_log_pages_cover_everything_once(log):
+    items = all_pages(lambda q: page_log(log, "chats", q), {"limit": "4"})
+    assert [c["prompt"] for c in items] == [c["prompt"] for c in reversed(CHATS)]
+    assert items[-8]["_truncated"] and len(items[-8]["response"]) == 2000
+
+def test_log_cursor_is_stable_while_appending(tmp_path):
+    store = ChatLogStore(str(tmp_path / "logs"), max_entries=6, segment_size=2, fsync=False)
+    for c in CHATS[:7]: store.append(c)
+    store.flush()
+    first = page_log(store, "chats", parse_query({"limit": "2"}))
+    store.append(CHATS[7])  # 翻頁之間有新對話 (並淘汰最舊的分段)
+    store.flush()
+    second = page_log(store, "chats", parse_query({"limit": "2", "cursor": first["next_cursor"]}))
+    assert [c["prompt"].split()[0] for c in first["items"] + second["items"]] == ["問題6", "問題5", "問題4", "問題3"]
+
+def test_filters_and_limit_cap(log):
+    q = parse_query({"limit": "999", "name": "王", "model": "Report", "q": "化祿"})
+    assert q["limit"] == 100
+    hits = page_log(log, "chats", q)["items"]
+    assert [h["prompt"].split()[0] for h in hits] == ["問題15"]
+    q = parse_query({"from": "2026-01-02", "to": "2026-01-02"})
+    assert len(page_log(log, "chats", q)["items"]) == 10
+    assert decode_cursor("not-a-cursor") is None
+    assert decode_cursor(encode_cursor("2026", 5)) == ("2026", 5)
+
+def test_sqlite_matches_log_backend(tmp_path, log):
+    store = SQLiteStore(str(tmp_path / "t.db"))
+    store.insert_many("chats", CHATS)
+    for args in ({"limit": "3"}, {"limit": "2", "name": "小華", "q": "化祿"}, {"limit": "5", "from": "2026-01-03"},
+                 {"q": "100%_"}):
+        expect = all_pages(lambda q: page_log(log, "chats", q), args)
+        assert all_pages(lambda q: page_sqlite(store, "chats", q), args) == expect
+
+def test_keyword_pages_come_from_search_index(tmp_path, log):
+    index = ChatSearchIndex(str(tmp_path / "idx"))
+    for c in CHATS: index.add(dict(c, gender="M"))
+    index.flush()
+    for args in ({"limit": "2", "q": "化祿"}, {"limit": "3", "q": "帛宮", "name": "小華"}, {"limit": "10", "q": "問題"},
+                 {"limit": "1", "q": "財帛", "from": "2026-01-02", "to": "2026-01-02"}):
+        expect = all_pages(lambda q: page_log(log, "chats", q), args)
+        got = all_pages(lambda q: page_search(index, q), args)
+        assert [c["prompt"] for c in got] == [c["prompt"] for c in expect] and got[0]["gender"] == "M"
+    assert page_search(index, parse_query({"q": "100%_"})) is None  # 無中文詞：改由後端逐筆篩選
+    assert page_search(index, parse_query({"q": "沒有的詞"}))["items"] == []
+
+def test_mongo_filter_uses_keyset_and_escapes():
+    q = parse_query({"cursor": encode_cursor("2026-01-02T10:00:00", "abc"), "q": "a.b", "to": "2026-01-31"})
+    f = mongo_filter("chats", q)
+    keyset, span, text = f["$and"]
+    assert keyset["$or"][1] == {"timestamp": "2026-01-02T10:00:00", "_id": {"$lt": "abc"}}
+    assert span == {"timestamp": {"$lte": "2026-01-31T99"}}
+    assert text["$or"][0] == {"prompt": {"$regex": r"a\.b"}}
+    assert mongo_filter("records", parse_query({})) == {}
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
@@ -0,0 +1,99 @@
+import threading
+import time
+from admission import AdmissionController, PRIORITY_CHAT, PRIORITY_REPORT
+
+def drain(gen):
+    positions = []
+    try:
+        while True: positions.append(next(gen))
+    except StopIteration as stop:
+        return stop.value, positions
+
+def test_limits_follow_provider_preference():
+    ctl = AdmissionController(lambda: {"groq": 1, "gemini": 1})
+    a = ctl.submit(["groq", "gemini"])
+    b = ctl.submit(["groq", "gemini"])
+    c = ctl.submit(["groq", "gemini"])
+    assert (a.provider, b.provider, c.provider) == ("groq", "gemini", None)
+    assert ctl.position(c) == 1
+    ctl.release(a)
+    assert c.provider == "groq"
+    ctl.release(a)  # 重複釋放不影響計數
+    assert ctl.snapshot()["active"] == {"groq": 1, "gemini": 1}
+
+def test_chat_jumps_ahead_of_queued_reports():
+    ctl = AdmissionController(lambda: {"gemini": 1})
+    busy = ctl.submit(["gemini"], PRIORITY_REPORT)
+    report = ctl.submit(["gemini"], PRIORITY_REPORT)
+    chat = ctl.submit(["gemini"], PRIORITY_CHAT)
+    assert (ctl.position(chat), ctl.position(report)) == (1, 2)
+    ctl.release(busy)
+    assert chat.provider == "gemini" and report.provider is None
+
+def test_wait_reports_position_and_times_out():
+    ctl = AdmissionController(lambda: {"gemini": 1})
+    ctl.submit(["gemini"])
+    waiting = ctl.submit(["gemini"])
+    granted, positions = drain(ctl.wait(waiting, 0.1, interval=0.02))
+    assert granted is False and positions[0] == 1
+    assert ctl.snapshot()["queued"] == 0 and ctl.snapshot()["timed_out"] == 1
+
+def test_wait_granted_on_release_and_queue_bound():
+    ctl = AdmissionController(lambda: {"gemini": 1}, max_queue=1)
+    first = ctl.submit(["gemini"])
+    second = ctl.submit(["gemini"])
+    assert ctl.submit(["gemini"]) is None
+    threading.Timer(0.05, ctl.release, args=(first,)).start()
+    start = time.time()
+    granted, _ = drain(ctl.wait(second, 5, interval=1))
+    assert granted and time.time() - start < 1
+
+def test_expire_only_withdraws_waiting_tickets():
+    ctl = AdmissionController(lambda: {"gemini": 1})
+    granted = ctl.submit(["gemini"])
+    waiting = ctl.submit(["gemini"])
+    assert ctl.expire(granted) is False
+    assert ctl.expire(waiting) is True
+    assert ctl.snapshot()["queued"] == 0 and ctl.snapshot()["timed_out"] == 1
+    ctl.release(waiting)  # 已逾時的憑證再釋放不影響計數
+    ctl.release(granted)
+    assert ctl.snapshot()["active"] == {"gemini": 0}
+
+def test_try_acquire_never_exceeds_limit():
+    ctl = AdmissionController(lambda: {"groq": 1, "gemini": 1})
+    primary = ctl.submit(["groq"])
+    assert ctl.try_acquire("groq") is None  # 已滿：不排隊也不超額
+    hedge = ctl.try_acquire("gemini")
+    assert hedge.provider == "gemini" and ctl.snapshot()["active"] == {"groq": 1, "gemini": 1}
+    waiting = ctl.submit(["gemini"])
+    ctl.release(hedge)
+    assert waiting.provider == "gemini"
+    ctl.release(primary)
+    ctl.release(waiting)
+    assert ctl.snapshot()["active"] == {"groq": 0, "gemini": 0}
+
+def test_cancelled_wait_leaves_queue_immediately():
+    ctl = AdmissionController(lambda: {"gemini": 1})
+    busy = ctl.submit(["gemini"], PRIORITY_REPORT)
+    waiting = ctl.submit(["gemini"], PRIORITY_REPORT)
+    cancel = threading.Event()
+    def stop():
+        cancel.set()
+        ctl.wake()
+    threading.Timer(0.05, stop).start()
+    start = time.time()
+    granted, _ = drain(ctl.wait(waiting, 5, interval=5, cancel=cancel))
+    assert granted is False and time.time() - start < 1
+    assert ctl.snapshot()["queued"] == 0 and ctl.snapshot()["cancelled"] == 1
+    ctl.release(busy)
+    assert waiting.provider is None and ctl.snapshot()["active"] == {"gemini": 0}  # 已取消者不會再取得名額
+
+if __name__ == "__main__":
+    test_limits_follow_provider_preference()
+    test_chat_jumps_ahead_of_queued_reports()
+    test_wait_reports_position_and_times_out()
+    test_wait_granted_on_release_and_queue_bound()
+    test_expire_only_withdraws_waiting_tickets()
+    test_try_acquire_never_exceeds_limit()
+    test_cancelled_wait_leaves_queue_immediately()
+    print("OK")
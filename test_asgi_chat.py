@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+import httpx
+import app as core
+import asgi_chat
+from admission import AdmissionController
+
+CTX = {"data": {"model": "Test"}, "user_prompt": "問事業", "user_info": {}, "matched": [],
+       "is_full": False, "is_bazi_mode": False, "prompt_mode": "chat", "final_system_prompt": "sys"}
+
+def patch(monkeypatch, limits, chunks, delay=0.0):
+    logged = []
+    async def fake_groq(prompt, system_prompt=""):
+        for c in chunks:
+            await asyncio.sleep(delay)
+            yield c
+    admission = AdmissionController(lambda: limits)
+    asgi_chat.watch_admission(admission)
+    monkeypatch.setattr(core, "AI_ADMISSION", admission)
+    monkeypatch.setattr(core, "ai_provider_order", lambda: ("groq", ["groq"]))
+    monkeypatch.setattr(core, "prepare_chat_context", lambda data, ip, ua="": dict(CTX, data=data))
+    monkeypatch.setattr(core, "log_chat", lambda *args: logged.append(args))
+    monkeypatch.setitem(asgi_chat.ASYNC_CALLERS, "groq", fake_groq)
+    return logged
+
+async def post_chat(payload, headers=None):
+    transport = httpx.ASGITransport(app=asgi_chat.application)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        res = await client.post("/api/chat", json=payload, headers=headers)
+        return res.status_code, res.headers, res.text
+
+def test_chat_streams_and_logs(monkeypatch):
+    logged = patch(monkeypatch, {"groq": 1}, ["天機", "已現"])
+    status, headers, text = asyncio.run(post_chat({"name": "甲"}))
+    assert status == 200 and headers["content-type"].startswith("text/plain")
+    assert text == "【大師解析中，請稍候...】\n\n天機已現"
+    assert logged[0][1:3] == ("問事業", "天機已現")
+    assert core.AI_ADMISSION.snapshot()["active"] == {"groq": 0}
+
+def test_full_report_logs_generated_content(monkeypatch):
+    logged = patch(monkeypatch, {"groq": 1}, ["八字", "詳評"])
+    monkeypatch.setattr(core, "prepare_chat_context", lambda data, ip, ua="": dict(CTX, data=data, is_full=True, is_bazi_mode=True))
+    asyncio.run(post_chat({}))
+    assert logged[0][0] == "Bazi-Full-Report"
+    assert logged[0][2] == "【天機分析成功...】宗師正在為您以「正統八字」詳批格局...\n\n八字詳評"
+
+def test_concurrent_streams_queue_with_feedback(monkeypatch):
+    patch(monkeypatch, {"groq": 1}, ["甲", "乙"], delay=0.05)
+    async def run():
+        return await asyncio.gather(post_chat({}), post_chat({}))
+    texts = [r[2] for r in asyncio.run(run())]
+    assert all(t.endswith("甲乙") for t in texts)
+    assert sum("排在第 1 位" in t for t in texts) == 1
+    assert core.AI_ADMISSION.snapshot()["admitted"] == 2
+
+def test_queue_timeout_expires_ticket(monkeypatch):
+    patch(monkeypatch, {"groq": 0}, ["甲"])
+    monkeypatch.setattr(core, "admission_max_wait", lambda priority: 0.05)
+    async def run():
+        return [c async for c in asgi_chat.astream_ai("p", "s", feedback=False)]
+    assert asyncio.run(run()) == [core.MSG_BUSY]
+    assert core.AI_ADMISSION.snapshot()["timed_out"] == 1
+
+def test_release_from_another_thread_wakes_waiting_stream(monkeypatch):
+    patch(monkeypatch, {"groq": 1}, ["甲"])
+    monkeypatch.setattr(core, "admission_max_wait", lambda priority: 10)
+    busy = core.AI_ADMISSION.submit(["groq"])
+    threading.Timer(0.05, core.AI_ADMISSION.release, args=(busy,)).start()  # 同步路徑 (Flask 執行緒) 歸還名額
+    async def run():
+        start = time.time()
+        chunks = [c async for c in asgi_chat.astream_ai("p", "s", feedback=False)]
+        return chunks, time.time() - start
+    chunks, elapsed = asyncio.run(run())
+    assert chunks == ["甲"] and elapsed < 1
+
+def test_cached_stream_stores_only_successful_output(monkeypatch):
+    patch(monkeypatch, {"groq": 1}, ["快取", "內容"])
+    monkeypatch.setattr(core, "RESPONSE_CACHE", core.ResponseCache(similarity=0))
+    async def run():
+        factory = lambda outcome: asgi_chat.astream_ai("規則", "sys", feedback=False, outcome=outcome)
+        return "".join([c async for c in asgi_chat.acached_stream(("chapter_sys",), "規則", factory)])
+    assert asyncio.run(run()) == "快取內容"
+    assert core.RESPONSE_CACHE.get(("chapter_sys",), "規則", core.CONFIG['gemini'].get('model', '')) == "快取內容"
+
+def test_sse_mode_resumes_from_last_event_id(monkeypatch):
+    patch(monkeypatch, {"groq": 1}, ["天機", "已現"])
+    async def run():
+        _, headers, text = await post_chat({}, {"Accept": "text/event-stream"})
+        ids = [line[4:] for line in text.split("\n") if line.startswith("id: ")]
+        _, _, resumed = await post_chat({}, {"Last-Event-ID": ids[1]})
+        status, _, _ = await post_chat({}, {"Last-Event-ID": "expired:0"})
+        return headers, text, ids, resumed, status
+    headers, text, ids, resumed, status = asyncio.run(run())
+    assert headers["content-type"].startswith("text/event-stream") and text.startswith("event: meta")
+    assert len(ids) == 3 and text.endswith("event: done\ndata: \n\n")
+    assert resumed == f"id: {ids[2]}\ndata: 已現\n\nevent: done\ndata: \n\n"
+    assert status == 410
+
+if __name__ == "__main__":
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,26 @@
+from server_headless import stream_batched_explanations
+
+RULES = [{"description": f"格局{i}", "text": f"內容{i}", "detected_palace_names": "命宮"} for i in range(1, 5)]
+RESPONSE = "好的，以下為解讀：\n<<1>> 第一則解釋。\n<<3>> 第三則 解釋\n<<4>>第四則"
+
+def render(chunks):
+    return "".join(stream_batched_explanations(RULES, iter(chunks)))
+
+def test_markers_split_across_chunks():
+    whole = render([RESPONSE])
+    for size in (1, 2, 3, 7):
+        chunks = [RESPONSE[i:i + size] for i in range(0, len(RESPONSE), size)]
+        assert render(chunks) == whole
+
+def test_skipped_and_missing_rules_marked_silent():
+    out = render([RESPONSE])
+    assert "格局2：內容2\n  (大師沈默...)" in out
+    assert "↳ 💡大師解讀：第三則 解釋\n\n" in out
+    assert out.count("● 【命宮】") == 4
+    out = render(["<<1>> 只有一則"])
+    assert out.count("(大師沈默...)") == 3
+
+if __name__ == "__main__":
+    test_markers_split_across_chunks()
+    test_skipped_and_missing_rules_marked_silent()
+    print("OK")
@@ -0,0 +1,31 @@
+from book_index import BookIndex, cjk_bigrams, split_sections
+
+BOOK = """
+【命宮心法】
+● 命有地空為半空折翅。
+● 命有紫微→抗壓性都不錯。
+
+【夫妻宮心法】
+● 夫妻宮有火星→閃電結婚也會閃電離婚。
+● 夫妻宮有紫殺→配偶較強勢。
+"""
+
+def test_tokenizer():
+    assert cjk_bigrams("紫微斗數") == ["紫微", "微斗", "斗數"]
+    assert cjk_bigrams("天 OK a") == ["天", "ok"]
+
+def test_split_sections():
+    passages = split_sections(BOOK)
+    assert [t for t, _ in passages] == ["【命宮心法】", "【夫妻宮心法】"]
+
+def test_retrieve_relevant_section():
+    idx = BookIndex(BOOK)
+    out = idx.retrieve("我的夫妻宮有火星", k=1)
+    assert out.startswith("【夫妻宮心法】") and "閃電結婚" in out
+    assert idx.retrieve("完全無關的問題xyz", k=3) == ""
+
+if __name__ == "__main__":
+    test_tokenizer()
+    test_split_sections()
+    test_retrieve_relevant_section()
+    print("book_index OK")
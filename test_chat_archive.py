@@ -0,0 +1,76 @@
+import gzip
+import json
+import os
+import pytest
+from chat_archive import ChatArchive
+from chat_log_store import ChatLogStore
+from sqlite_store import SQLiteStore
+from stream_capture import compress_text
+
+def kept(store):
+    return sum(s["count"] for s in store.segments)
+
+def chat(day, i, name="王小明"):
+    return {"timestamp": f"2026-01-{day:02d}T10:00:{i:02d}", "user_name": name, "prompt": f"問題{i}", "response": f"回覆{i}"}
+
+def test_archive_groups_by_day_and_indexes(tmp_path):
+    arc = ChatArchive(str(tmp_path / "arc"))
+    assert arc.archive([chat(1, 0), chat(1, 1, "李四"), chat(2, 2)]) == 3
+    segs = arc.segments()
+    assert [s["day"] for s in segs] == ["2026-01-02", "2026-01-01"]  # 新到舊
+    assert segs[1]["count"] == 2 and segs[1]["users"] == ["李四", "王小明"]
+    assert [s["day"] for s in arc.segments(name="李四")] == ["2026-01-01"]
+    assert [s["day"] for s in arc.segments(date_from="2026-01-02")] == ["2026-01-02"]
+    with gzip.open(tmp_path / "arc" / "chats-2026-01-01.jsonl.gz", "rt", encoding="utf-8") as f:
+        assert [json.loads(line)["prompt"] for line in f] == ["問題0", "問題1"]
+    assert arc.snapshot()["chats"] == 3
+
+def test_append_members_and_read_filters(tmp_path):
+    arc = ChatArchive(str(tmp_path / "arc"))
+    arc.archive([chat(1, i) for i in range(5)])
+    arc.archive([dict(chat(1, 9, "李四"), response="短", response_gz=compress_text("完整的化忌分析"))])
+    total, page = arc.read("2026-01-01", limit=2)
+    assert total == 6 and [e["prompt"] for e in page] == ["問題9", "問題4"]
+    assert arc.read("2026-01-01", q="化忌")[0] == 1  # 搜尋壓縮保存的完整回覆
+    assert arc.read("2026-01-01", name="王小明", offset=3)[1][-1]["prompt"] == "問題0"
+    reopened = ChatArchive(str(tmp_path / "arc"))
+    assert reopened.segments()[0]["count"] == 6 and reopened.read("2026-01-31") == (0, [])
+
+def test_crash_tail_is_truncated_and_missing_index_rebuilt(tmp_path):
+    arc = ChatArchive(str(tmp_path / "arc"))
+    arc.archive([chat(1, 0)])
+    path = tmp_path / "arc" / "chats-2026-01-01.jsonl.gz"
+    with open(path, "ab") as f: f.write(gzip.compress(b'{"prompt": "\xe6')[:10])  # 寫到一半當機
+    arc.archive([chat(1, 1)])
+    assert [e["prompt"] for e in arc.read("2026-01-01")[1]] == ["問題1", "問題0"]
+    os.remove(tmp_path / "arc" / "index.json")
+    rebuilt = ChatArchive(str(tmp_path / "arc"))
+    assert rebuilt.segments()[0]["count"] == 2
+
+def test_chat_log_store_archives_before_evicting(tmp_path):
+    arc = ChatArchive(str(tmp_path / "arc"))
+    store = ChatLogStore(str(tmp_path / "logs"), max_entries=4, segment_size=2, on_evict=arc.archive)
+    for i in range(10): store.append(chat(1 + i // 4, i))
+    store.flush()
+    assert kept(store) + arc.snapshot()["chats"] == 10  # 淘汰的紀錄全數進入封存
+    moved = store.expire_before("2026-01-03")
+    assert moved > 0 and kept(store) + arc.snapshot()["chats"] == 10
+    assert all(e["timestamp"] >= "2026-01-03" for e in store.load())
+
+def test_failed_archive_keeps_segment(tmp_path):
+    def broken(entries): raise OSError("disk full")
+    store = ChatLogStore(str(tmp_path / "logs"), max_entries=2, segment_size=2, on_evict=broken)
+    for i in range(6): store.append(chat(1, i))
+    store.flush()
+    assert kept(store) == 6  # 封存失敗時不刪除分段
+
+def test_sqlite_older_than_and_delete(tmp_path):
+    db = SQLiteStore(str(tmp_path / "t.db"))
+    db.insert_many("chats", [chat(d, d) for d in range(1, 6)])
+    rows = db.older_than("chats", "2026-01-03", limit=10)
+    assert [e["prompt"] for _, e in rows] == ["問題1", "問題2"]
+    db.delete_ids("chats", [i for i, _ in rows])
+    assert db.count("chats") == 3 and db.older_than("chats", "2026-01-03") == []
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
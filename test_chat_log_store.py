@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+from chat_log_store import ChatLogStore
+
+def entry(i):
+    return {"timestamp": f"2026-01-01T00:00:{i:02d}", "prompt": f"問題{i}", "response": "回覆\n第二行"}
+
+def test_append_rotates_and_keeps_recent(tmp_path):
+    store = ChatLogStore(str(tmp_path / "logs"), max_entries=10, segment_size=4)
+    for i in range(23): store.append(entry(i))
+    store.flush()
+    assert [e["prompt"] for e in store.load()] == [f"問題{i}" for i in range(13, 23)]
+    assert store.tail(2)[-1] == entry(22) and store.count() == 10
+    names = sorted(os.listdir(tmp_path / "logs"))
+    assert len([n for n in names if n.endswith(".jsonl")]) <= 4  # 過舊分段已刪除
+    reopened = ChatLogStore(str(tmp_path / "logs"), max_entries=10, segment_size=4)
+    assert reopened.load() == store.load()
+
+def test_concurrent_appends_are_not_lost(tmp_path):
+    store = ChatLogStore(str(tmp_path / "logs"), max_entries=1000, segment_size=50, fsync=False)
+    threads = [threading.Thread(target=lambda t=t: [store.append({"t": t, "i": i}) for i in range(50)]) for t in range(8)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    store.flush()
+    assert len(store.load()) == 400
+
+def test_partial_line_after_crash_is_dropped(tmp_path):
+    store = ChatLogStore(str(tmp_path / "logs"), segment_size=100)
+    for i in range(3): store.append(entry(i))
+    store.flush()
+    seg = tmp_path / "logs" / store.segments[-1]["name"]
+    with open(seg, "ab") as f:
+        f.write(json.dumps(entry(3), ensure_ascii=False).encode() + b"\n")  # 已寫入但索引未更新
+        f.write(b'{"timestamp": "2026-01-')                               # 寫到一半當機
+    reopened = ChatLogStore(str(tmp_path / "logs"), segment_size=100)
+    assert [e["prompt"] for e in reopened.load()] == ["問題0", "問題1", "問題2", "問題3"]
+    reopened.append(entry(4))
+    reopened.flush()
+    assert reopened.load()[-1] == entry(4)
+
+def test_legacy_import_and_replace(tmp_path):
+    legacy = tmp_path / "chat_history.json"
+    legacy.write_text(json.dumps([entry(i) for i in range(5)], ensure_ascii=False), encoding="utf-8")
+    store = ChatLogStore(str(tmp_path / "logs"), legacy_file=str(legacy), max_entries=3)
+    assert [e["prompt"] for e in store.load()] == ["問題2", "問題3", "問題4"]
+    store.replace([entry(9)])
+    assert store.load() == [entry(9)]
+
+def test_unbounded_store_keeps_everything(tmp_path):
+    legacy = tmp_path / "user_records.json"
+    legacy.write_text(json.dumps([entry(i) for i in range(5)], ensure_ascii=False), encoding="utf-8")
+    store = ChatLogStore(str(tmp_path / "records"), legacy_file=str(legacy), max_entries=None, segment_size=4)
+    threads = [threading.Thread(target=lambda k=k: [store.append(entry(k * 50 + i)) for i in range(50)]) for k in range(1, 5)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    store.flush()
+    assert store.count() == 205 and len(store.load()) == 205  # 同時儲存不遺失、不淘汰
+    assert store.load()[:5] == [entry(i) for i in range(5)]
+
+if __name__ == "__main__":
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
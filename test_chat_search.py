@@ -0,0 +1,79 @@
+import os
+import pytest
+from chat_search import ChatSearchIndex, snippet
+
+def chat(i, prompt, response="平順"):
+    return {"timestamp": f"2026-01-01T00:00:{i:02d}", "user_name": f"用戶{i}", "model": "Groq",
+            "prompt": prompt, "response": response}
+
+CHATS = [
+    chat(0, "我的財帛宮有化忌嗎？", "財帛宮化忌，宜保守理財。"),
+    chat(1, "夫妻宮有火星怎麼辦", "火星入夫妻宮，閃電結婚也會閃電離婚。"),
+    chat(2, "今年事業運", "官祿宮見化祿，財帛宮亦佳，財帛宮財帛宮。"),
+    chat(3, "Career outlook", "Stable CAREER growth"),
+]
+
+def build(tmp_path, **kw):
+    idx = ChatSearchIndex(str(tmp_path / "idx"), **kw)
+    for c in CHATS: idx.add(c)
+    idx.flush()
+    return idx
+
+def test_ranked_hits_with_snippets(tmp_path):
+    idx = build(tmp_path)
+    total, hits = idx.search("財帛宮")
+    assert total == 2
+    assert [h["user_name"] for h in hits] == ["用戶2", "用戶0"]  # 詞頻較高者在前
+    assert "財帛宮" in hits[1]["snippet"]
+    assert idx.search("閃電離婚")[1][0]["prompt"] == "夫妻宮有火星怎麼辦"
+    assert idx.search("career")[0] == 1
+    assert idx.search("財帛宮火星") == (0, [])  # 所有 bigram 都須出現
+    assert idx.search("") == (0, [])
+
+def test_persists_and_replays_after_restart(tmp_path):
+    idx = build(tmp_path, checkpoint_every=2)
+    idx.add(chat(4, "遷移宮", "出外有貴人"))
+    idx.flush()  # 最後一筆尚未寫入快照，重啟時由 docs.jsonl 補讀
+    with open(os.path.join(idx.directory, "docs.jsonl"), "ab") as f:
+        f.write('{"t": "半行'.encode("utf-8"))
+    reopened = ChatSearchIndex(idx.directory)
+    assert reopened.search("貴人")[0] == 1
+    assert reopened.snapshot()["docs"] == 5
+    reopened.add(chat(5, "遷移宮再問", "貴人多"))
+    reopened.flush()
+    assert reopened.search("貴人")[0] == 2
+
+def test_incremental_checkpoints_merge_into_base(tmp_path):
+    idx = ChatSearchIndex(str(tmp_path / "idx"), checkpoint_every=2)
+    for i in range(11):
+        idx.add(chat(i, f"第{i}問 命宮", "回覆"))
+        idx.flush()
+    deltas = sorted(n for n in os.listdir(idx.directory) if n.startswith("delta-"))
+    assert deltas == ["delta-0000000008.pkl"]  # 差異累積到與基底同量時已合併進 index.pkl
+    assert idx.snapshot()["delta_docs"] == 2 and idx.snapshot()["unsaved"] == 1
+    idx.close()
+    reopened = ChatSearchIndex(idx.directory)
+    assert reopened.search("命宮")[0] == 11
+    assert reopened.snapshot()["unsaved"] == 0  # 全部由基底與差異檔載入，不必補讀 docs.jsonl
+
+def test_bootstrap_from_legacy_loader(tmp_path):
+    idx = ChatSearchIndex(str(tmp_path / "idx"), legacy_loader=lambda: CHATS)
+    assert idx.search("火星")[0] in (0, 1)  # 匯入於背景進行
+    idx.flush()
+    assert idx.search("火星")[0] == 1 and idx.snapshot()["docs"] == 4
+
+def test_bootstrap_does_not_index_first_entry_twice(tmp_path):
+    idx = ChatSearchIndex(str(tmp_path / "idx"), legacy_loader=lambda: CHATS)
+    idx.add(CHATS[-1])  # 觸發匯入的這筆已寫入熱儲存，會被 legacy_loader 一併載入
+    idx.add(chat(3, "同一秒的另一筆", "不同提問"))
+    idx.add(chat(5, "Career again", "新的 career"))
+    idx.flush()
+    assert idx.snapshot()["docs"] == 6 and idx.search("career")[0] == 2
+
+def test_snippet_window():
+    text = "前" * 100 + "命宮主星" + "後" * 100
+    out = snippet(text, "命宮主星", ["命宮"], width=40)
+    assert out.startswith("…") and out.endswith("…") and "命宮主星" in out
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
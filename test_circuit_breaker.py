@@ -0,0 +1,42 @@
+import time
+from circuit_breaker import CircuitBreaker
+
+def wait_for(cond, timeout=2):
+    end = time.time() + timeout
+    while time.time() < end:
+        if cond(): return True
+        time.sleep(0.01)
+    return False
+
+def test_opens_after_threshold_and_recovers_via_probe():
+    up = {"ok": False}
+    breaker = CircuitBreaker("local", lambda: up["ok"], failure_threshold=2, probe_interval=0.02)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.1)
+    assert not breaker.allow()
+    up["ok"] = True
+    assert wait_for(breaker.allow)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert wait_for(breaker.allow)
+
+def test_start_open_probes_immediately():
+    breaker = CircuitBreaker("local", lambda: True, probe_interval=60, start_open=True)
+    assert wait_for(breaker.allow)
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker("local", lambda: False, failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+if __name__ == "__main__":
+    test_opens_after_threshold_and_recovers_via_probe()
+    test_start_open_probes_immediately()
+    test_success_resets_failure_count()
+    print("OK")
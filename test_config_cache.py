@@ -0,0 +1,41 @@
+import json
+import os
+import threading
+import pytest
+from config_cache import JsonConfigCache
+
+def test_defaults_when_file_missing(tmp_path):
+    cfg = JsonConfigCache(str(tmp_path / "c.json"), defaults={"chat": ""})
+    assert cfg.get() == {"chat": ""} and cfg.version == 1
+
+def test_get_does_no_io_until_mtime_changes(tmp_path, monkeypatch):
+    path = tmp_path / "c.json"
+    path.write_text(json.dumps({"chat": "甲"}), encoding="utf-8")
+    cfg = JsonConfigCache(str(path), check_interval=60)
+    opened = []
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda *a, **k: opened.append(a[0]) or real_open(*a, **k))
+    for _ in range(100): assert cfg.get()["chat"] == "甲"
+    assert opened == []
+    path.write_text(json.dumps({"chat": "乙"}), encoding="utf-8")
+    os.utime(path, ns=(1, 1))
+    cfg._checked = 0.0  # 模擬 check_interval 已過
+    assert cfg.get()["chat"] == "乙" and cfg.version == 2
+
+def test_update_is_atomic_and_versioned(tmp_path):
+    path = tmp_path / "c.json"
+    cfg = JsonConfigCache(str(path), defaults={"chat": "", "love": ""})
+    before = cfg.get()
+    threads = [threading.Thread(target=cfg.update, args=({f"k{i}": i},)) for i in range(10)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert before == {"chat": "", "love": ""}  # 舊快照不受影響
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert saved == cfg.get() and len(saved) == 12 and cfg.version == 11
+    assert [p for p in os.listdir(tmp_path) if p.endswith(".tmp")] == []
+    cfg._checked = 0.0
+    cfg.get()
+    assert cfg.version == 11  # 自己寫入的檔案不會觸發重新載入
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
@@ -0,0 +1,49 @@
+import time
+import pytest
+from openpyxl import load_workbook
+from excel_mirror import ExcelMirror, write_workbook
+
+RECORDS = [
+    {"timestamp": "2026-01-01T10:00:00", "name": "王小明", "gender": "M", "birth_date": "1990-01-01",
+     "birth_hour": "子", "lunar_date": {"y": 1989}, "note": "vip"},
+    {"timestamp": "2026-01-02T10:00:00", "name": "陳小華", "gender": "F", "birth_date": "1992-05-05", "birth_hour": "午"},
+]
+
+def test_write_workbook_headers_and_extra_columns(tmp_path):
+    path = str(tmp_path / "out.xlsx")
+    write_workbook(RECORDS, path)
+    rows = list(load_workbook(path).active.iter_rows(values_only=True))
+    assert rows[0] == ("紀錄時間", "姓名", "性別", "國曆生日", "時辰(支)", "農曆日期", "note")
+    assert rows[1][1] == "王小明" and rows[1][5] == "{'y': 1989}" and rows[1][6] == "vip"
+    assert rows[2][6] is None and len(rows) == 3
+
+def test_bursts_are_coalesced(tmp_path):
+    loads = []
+    def loader():
+        loads.append(1)
+        return RECORDS
+    mirror = ExcelMirror(str(tmp_path / "m.xlsx"), loader, debounce=0.2)
+    for _ in range(20): mirror.mark_dirty()
+    time.sleep(0.6)
+    assert len(loads) == 1 and mirror.snapshot()["written"] == 1
+    assert not mirror.snapshot()["pending"]
+    assert len(list(load_workbook(mirror.path).active.iter_rows())) == 3
+
+def test_max_delay_bounds_a_continuous_burst(tmp_path):
+    mirror = ExcelMirror(str(tmp_path / "m.xlsx"), lambda: RECORDS, debounce=0.2, max_delay=0.5)
+    start = time.time()
+    while time.time() - start < 1.2:  # 標記間隔短於 debounce，只靠 debounce 永遠不會寫入
+        mirror.mark_dirty()
+        time.sleep(0.05)
+    assert mirror.snapshot()["written"] >= 2
+
+def test_flush_writes_pending_changes_and_render(tmp_path):
+    mirror = ExcelMirror(str(tmp_path / "m.xlsx"), lambda: RECORDS, debounce=60)
+    mirror.mark_dirty()
+    mirror.flush()
+    assert mirror.snapshot()["written"] == 1
+    rows = list(load_workbook(mirror.render()).active.iter_rows(values_only=True))
+    assert rows[2][1] == "陳小華"
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
@@ -0,0 +1,61 @@
+import threading
+from key_scheduler import KeyScheduler, extract_retry_after
+
+KEYS = ["key-aaaaaaaaaaaa", "key-bbbbbbbbbbbb", "key-cccccccccccc"]
+
+def test_throttled_key_is_skipped_until_cooldown_ends():
+    sched = KeyScheduler("groq", list(KEYS), rate_per_min=60, burst=5)
+    first = sched.acquire()
+    sched.on_throttle(first, retry_after=30)
+    picks = [sched.acquire() for _ in range(8)]
+    assert first not in picks
+    assert sched.snapshot()[KEYS.index(first)]["status"] == "cooldown"
+
+def test_bucket_exhaustion_returns_none_without_waiting():
+    sched = KeyScheduler("gemini", [KEYS[0]], rate_per_min=2, burst=2)
+    sched.on_throttle(KEYS[0], retry_after=0.001)  # 被限流後才受令牌桶限制
+    sched._state[KEYS[0]]["tokens"] = 2
+    sched._state[KEYS[0]]["cooldown_until"] = 0
+    assert sched.acquire() and sched.acquire()
+    assert sched.acquire(max_wait=0) is None
+
+def test_configured_rpm_is_not_a_cap_before_throttling():
+    sched = KeyScheduler("gemini", [KEYS[0]], rate_per_min=15, burst=5)
+    assert all(sched.acquire(max_wait=0) for _ in range(8))  # 兩份報告同時送出：不因初始推估而失敗
+    for _ in range(10): sched.on_success(KEYS[0])
+    assert sched.snapshot()[0]["rate_per_min"] == 25
+    sched.on_throttle(KEYS[0])
+    assert sched.snapshot()[0]["rate_per_min"] == 12.5
+
+def test_least_recently_throttled_preferred():
+    sched = KeyScheduler("groq", list(KEYS), rate_per_min=60, burst=5)
+    sched.on_throttle(KEYS[0], retry_after=0.001)
+    sched.on_throttle(KEYS[1], retry_after=0.001)
+    sched._state[KEYS[0]]["tokens"] = sched._state[KEYS[1]]["tokens"] = 5
+    sched._state[KEYS[0]]["cooldown_until"] = sched._state[KEYS[1]]["cooldown_until"] = 0
+    assert sched.acquire() == KEYS[2]
+    assert sched.acquire(exclude={KEYS[2]}) == KEYS[0]
+
+def test_invalidate_is_thread_safe_and_removes_once():
+    keys = list(KEYS)
+    sched = KeyScheduler("groq", keys)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(sched.invalidate(KEYS[1]))) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert results.count(True) == 1
+    assert keys == [KEYS[0], KEYS[2]]
+
+def test_extract_retry_after():
+    assert extract_retry_after(Exception("429 ... 'retryDelay': '37s'")) == 37.0
+    assert extract_retry_after(Exception("Rate limit reached. Please try again in 7.5s.")) == 7.5
+    assert extract_retry_after(Exception("500 internal")) is None
+
+if __name__ == "__main__":
+    test_throttled_key_is_skipped_until_cooldown_ends()
+    test_bucket_exhaustion_returns_none_without_waiting()
+    test_configured_rpm_is_not_a_cap_before_throttling()
+    test_least_recently_throttled_preferred()
+    test_invalidate_is_thread_safe_and_removes_once()
+    test_extract_retry_after()
+    print("OK")
@@ -0,0 +1,66 @@
+import threading
+import time
+from latency import LatencyHistogram, hedge_delay, hedged_stream
+
+def slow(delay, chunks, log=None):
+    def factory(scope):
+        time.sleep(delay)
+        for c in chunks:
+            if log is not None: log.append(c)
+            yield c
+            time.sleep(0.01)
+    return factory
+
+def run(racers, delay):
+    out = []
+    gen = hedged_stream(racers, delay)
+    try:
+        while True: out.append(next(gen))
+    except StopIteration as stop:
+        return stop.value, "".join(out)
+
+def test_fast_primary_never_launches_secondary():
+    log = []
+    winner, text = run([("a", slow(0, ["A1", "A2"])), ("b", slow(0, ["B1"], log))], 0.3)
+    assert (winner, text) == ("a", "A1A2")
+    assert log == []
+
+def test_slow_primary_loses_to_hedge():
+    winner, text = run([("a", slow(0.5, ["A1"])), ("b", slow(0, ["B1", "B2"]))], 0.1)
+    assert (winner, text) == ("b", "B1B2")
+
+def test_failed_primary_falls_through_immediately():
+    start = time.time()
+    winner, text = run([("a", slow(0, [])), ("b", slow(0, ["B1"]))], 5)
+    assert (winner, text) == ("b", "B1")
+    assert time.time() - start < 1
+    assert run([("a", slow(0, [])), ("b", slow(0, []))], 0.1) == (None, "")
+
+def test_losing_leg_is_aborted_without_waiting_for_output():
+    blocked, aborted = threading.Event(), []
+    def stuck(scope):
+        scope.on_cancel(lambda: (aborted.append(time.time()), blocked.set()))  # 如關閉串流回應
+        blocked.wait(10)  # 阻塞於讀取，直到連線被關閉
+        yield from ()
+    start = time.time()
+    winner, text = run([("a", stuck), ("b", slow(0, ["B1"]))], 0.1)
+    assert (winner, text) == ("b", "B1")
+    assert aborted and aborted[0] - start < 1
+
+def test_histogram_percentile_and_hedge_delay():
+    hist = LatencyHistogram()
+    assert hedge_delay(hist, default=3.0) == 3.0
+    for _ in range(95): hist.observe(0.4)
+    for _ in range(5): hist.observe(12)
+    assert hist.percentile(50) == 0.5
+    assert hist.percentile(95) == 0.5
+    assert hist.percentile(99) == 15
+    assert hedge_delay(hist, min_samples=20) == 0.5
+
+if __name__ == "__main__":
+    test_fast_primary_never_launches_secondary()
+    test_slow_primary_loses_to_hedge()
+    test_failed_primary_falls_through_immediately()
+    test_losing_leg_is_aborted_without_waiting_for_output()
+    test_histogram_percentile_and_hedge_delay()
+    print("OK")
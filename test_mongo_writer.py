@@ -0,0 +1,90 @@
+import os
+import threading
+import pytest
+from mongo_writer import MongoWriteBehind, DUPLICATE_KEY
+
+class FakeBulkError(Exception):
+    def __init__(self, codes):
+        super().__init__("batch op errors occurred")
+        self.details = {"writeErrors": [{"code": c} for c in codes]}
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = {}
+        self.calls = []
+        self.down = False
+        self.lock = threading.Lock()
+
+    def insert_many(self, docs, ordered=True):
+        if self.down: raise ConnectionError("connection refused")
+        with self.lock:
+            self.calls.append(len(docs))
+            dup = [DUPLICATE_KEY for d in docs if d["_id"] in self.docs]
+            for d in docs: self.docs.setdefault(d["_id"], d)
+        if dup: raise FakeBulkError(dup)
+
+def make(tmp_path, coll, **kw):
+    opts = dict(flush_interval=0.05, batch_size=10, spill_file=str(tmp_path / "spill.jsonl"), spill_after=0.1, max_backoff=0.1)
+    opts.update(kw)
+    return MongoWriteBehind({"chat_history": coll}, **opts)
+
+def test_puts_are_batched(tmp_path):
+    coll = FakeCollection()
+    w = make(tmp_path, coll, flush_interval=5)
+    for i in range(30): w.put("chat_history", {"i": i})
+    assert w.flush(2)
+    assert len(coll.docs) == 30 and max(coll.calls) == 10 and len(coll.calls) == 3
+    w.close()
+
+def test_outage_spills_then_replays(tmp_path):
+    coll = FakeCollection()
+    coll.down = True
+    w = make(tmp_path, coll)
+    for i in range(5): w.put("chat_history", {"i": i})
+    assert w.flush(3)  # 中斷超過 spill_after：緩衝已落地
+    assert os.path.exists(w.spill_file) and not coll.docs
+    coll.down = False
+    w.put("chat_history", {"i": 5})
+    assert w.flush(3)
+    for _ in range(60):
+        if not os.path.exists(w.spill_file): break
+        threading.Event().wait(0.05)
+    assert sorted(d["i"] for d in coll.docs.values()) == list(range(6))
+    assert w.snapshot()["replayed"] == 5
+    w.close()
+
+def test_retry_after_partial_write_does_not_duplicate(tmp_path):
+    coll = FakeCollection()
+    w = make(tmp_path, coll, flush_interval=5)
+    w.put("chat_history", {"i": 0})
+    assert w.flush(2)
+    doc = next(iter(coll.docs.values()))
+    assert w._write([("chat_history", dict(doc))])  # 重送已寫入的 _id 視為成功
+    assert len(coll.docs) == 1
+    w.close()
+
+def test_failed_writes_back_off_even_with_full_buffer(tmp_path):
+    attempts = []
+    class Failing:
+        def insert_many(self, docs, ordered=True):
+            attempts.append(len(docs))
+            raise PermissionError("not authorized")
+    w = make(tmp_path, Failing(), spill_after=60, max_backoff=0.1)
+    for i in range(20): w.put("chat_history", {"i": i})  # 緩衝超過 batch_size
+    threading.Event().wait(0.5)
+    assert 1 <= len(attempts) <= 10  # 每次失敗後都等候退避，不會空轉重試
+    w.close(timeout=1)
+
+def test_buffer_is_bounded_and_close_spills(tmp_path):
+    coll = FakeCollection()
+    coll.down = True
+    w = make(tmp_path, coll, max_buffer=3, spill_after=60)
+    for i in range(8): w.put("chat_history", {"i": i})
+    assert w.snapshot()["buffered"] <= 3
+    w.close(timeout=1)
+    with open(w.spill_file, encoding="utf-8") as f:
+        assert len(f.readlines()) == 8  # 溢出與關閉時未寫入的文件全部落地
+    assert not coll.docs
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
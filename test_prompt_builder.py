@@ -0,0 +1,41 @@
+from prompt_builder import KeywordAutomaton, PromptBuilder, detect_intents, estimate_tokens, fit_blocks
+
+def test_automaton_overlapping_keywords():
+    ac = KeywordAutomaton({"a": ["十年", "未來十年"], "b": ["年運"], "c": ["來十"]})
+    assert ac.match("請問未來十年運勢") == {"a", "b", "c"}
+    assert ac.match("這十年") == {"a"}
+    assert ac.match("流年運") == {"b"}
+    assert ac.match("") == set()
+
+def test_detect_intents():
+    intents = detect_intents("我想問工作和身體，順便看 2330")
+    assert {"career", "health", "stock"} <= intents
+    assert "full_report" in detect_intents("請給我命譜詳評")
+
+def test_builder_joins_blocks_in_order():
+    pb = PromptBuilder()
+    pb.add("header_chat").add_text("ctx", "X").add("limit", age=35)
+    out = pb.build()
+    assert out.startswith("你是【紫微天機道長】") and "約 35 歲" in out
+    assert pb.block_ids == ["header_chat", "ctx", "limit"]
+
+def test_estimate_tokens():
+    assert estimate_tokens("紫微天機") == 4
+    assert estimate_tokens("abcdefgh") == 2
+
+def test_fit_blocks_keeps_required_and_relevant():
+    book = "\n".join(["● 秘卷心法一行內容"] * 100)
+    blocks = [("header_chat", "你是道長"), ("career", "職" * 50), ("internet", "因" * 50), ("bazi_book", book)]
+    kept, dropped = fit_blocks(blocks, 200, {"career", "chat"})
+    ids = [b[0] for b in kept]
+    assert ids[:2] == ["header_chat", "career"]
+    assert sum(estimate_tokens(t) for _, t in kept) <= 200
+    assert "bazi_book" not in ids or len(dict(kept)["bazi_book"]) < len(book)
+
+if __name__ == "__main__":
+    test_estimate_tokens()
+    test_fit_blocks_keeps_required_and_relevant()
+    test_automaton_overlapping_keywords()
+    test_detect_intents()
+    test_builder_joins_blocks_in_order()
+    print("prompt_builder OK")
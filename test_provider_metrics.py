@@ -0,0 +1,61 @@
+import asyncio
+import time
+from provider_metrics import ProviderMetrics, classify_error, measured_stream, ameasured_stream
+
+class RateLimitError(Exception): pass
+class ReadTimeout(Exception): pass
+
+def slow(chunks, delay=0.02):
+    for c in chunks:
+        time.sleep(delay)
+        yield c
+
+def test_classify_error():
+    assert classify_error(RateLimitError("Error code: 429")) == "429"
+    assert classify_error(Exception("401 Invalid API Key")) == "401"
+    assert classify_error(ReadTimeout("read")) == "timeout"
+    assert classify_error(Exception("503 Service Unavailable")) == "5xx"
+    assert classify_error(ValueError("boom")) == "other"
+
+def test_measured_stream_records_ttfb_throughput_and_empty_calls():
+    m = ProviderMetrics(("groq",))
+    assert "".join(measured_stream(slow(["天機", "已現"]), m, "groq")) == "天機已現"
+    list(measured_stream(iter([]), m, "groq"))
+    snap = m.snapshot()["providers"]["groq"]
+    assert (snap["calls"], snap["empty"], snap["chunks"], snap["chars"]) == (2, 1, 2, 4)
+    assert snap["ttfb"]["count"] == 1 and snap["total"]["count"] == 1
+    assert 0 < snap["chars_per_sec"] < 200
+
+def test_closed_stream_only_counts_ttfb():
+    m = ProviderMetrics(("gemini",))
+    gen = measured_stream(slow(["a", "b", "c"]), m, "gemini")
+    next(gen)
+    gen.close()
+    snap = m.snapshot()["providers"]["gemini"]
+    assert snap["ttfb"]["count"] == 1 and snap["calls"] == 0
+
+def test_async_stream_and_prometheus_text():
+    m = ProviderMetrics(("ollama",))
+    async def agen():
+        for c in ["甲", "乙"]:
+            await asyncio.sleep(0.01)
+            yield c
+    async def run():
+        return [c async for c in ameasured_stream(agen(), m, "ollama")]
+    assert asyncio.run(run()) == ["甲", "乙"]
+    m.record_error("ollama", ReadTimeout("x"))
+    m.record_fallback(1)
+    m.record_queue_wait(0.3)
+    text = m.prometheus()
+    assert 'fate_ai_ttfb_seconds_bucket{provider="ollama",le="+Inf"} 1' in text
+    assert 'fate_ai_errors_total{provider="ollama",class="timeout"} 1' in text
+    assert 'fate_ai_fallback_depth_total{depth="1"} 1' in text
+    assert "fate_ai_queue_wait_seconds_count 1" in text
+    assert m.snapshot()["fallback_depth"] == {"1": 1}
+
+if __name__ == "__main__":
+    test_classify_error()
+    test_measured_stream_records_ttfb_throughput_and_empty_calls()
+    test_closed_stream_only_counts_ttfb()
+    test_async_stream_and_prometheus_text()
+    print("OK")
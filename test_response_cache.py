@@ -0,0 +1,48 @@
+from app import ResponseCache, StatusText, cached_stream, RESPONSE_CACHE
+
+PROMPT = "章節：【第一章】\n包含規則：\n● 【命宮】紫微星坐命：領導力強。\n● 【財帛宮】武曲化祿：財源廣進。\n"
+
+def test_exact_hit_ignores_whitespace_and_respects_namespace():
+    cache = ResponseCache(similarity=0)
+    cache.put(("chapter_sys",), PROMPT, "gemini-2.0-flash", "批註")
+    assert cache.get(("chapter_sys",), "  " + PROMPT.replace("\n", " \n "), "gemini-2.0-flash") == "批註"
+    assert cache.get(("chapter_sys",), PROMPT, "llama-3.3-70b-versatile") is None
+    assert cache.get(("summary_sys",), PROMPT, "gemini-2.0-flash") is None
+
+def test_default_is_exact_match_only():
+    cache = ResponseCache()
+    cache.put(("chapter_sys",), PROMPT, "m", "批註")
+    assert cache.get(("chapter_sys",), PROMPT.replace("領導力強。", "領導力強!"), "m") is None  # 規則稍有不同即不共用
+
+def test_near_duplicate_match_and_bounds():
+    cache = ResponseCache(max_entries=2, similarity=0.85)
+    cache.put(("chapter_sys",), PROMPT, "m", "批註")
+    assert cache.get(("chapter_sys",), PROMPT.replace("領導力強。", "領導力強!"), "m") == "批註"
+    assert cache.get(("chapter_sys",), "完全不同的提問內容，與命盤無關。", "m") is None
+    cache.put(("chapter_sys",), "b", "m", "B")
+    cache.put(("chapter_sys",), "c", "m", "C")
+    assert cache.get(("chapter_sys",), PROMPT, "m") is None
+    expired = ResponseCache(ttl=-1)
+    expired.put(("chapter_sys",), PROMPT, "m", "批註")
+    assert expired.get(("chapter_sys",), PROMPT, "m") is None
+
+def test_cached_stream_stores_only_successful_output():
+    def ok():
+        yield StatusText("排隊中\n")
+        yield "天機"
+        yield "已現"
+        return True
+    def failed():
+        yield "【天機中斷】"
+    prompt = PROMPT + "test_cached_stream"
+    assert "".join(cached_stream(("chapter_sys",), prompt + "x", failed)) == "【天機中斷】"
+    assert RESPONSE_CACHE.get(("chapter_sys",), prompt + "x", "") is None
+    assert "".join(cached_stream(("chapter_sys",), prompt, ok)) == "排隊中\n天機已現"
+    assert "".join(cached_stream(("chapter_sys",), prompt, failed)) == "天機已現"
+
+if __name__ == "__main__":
+    test_exact_hit_ignores_whitespace_and_respects_namespace()
+    test_default_is_exact_match_only()
+    test_near_duplicate_match_and_bounds()
+    test_cached_stream_stores_only_successful_output()
+    print("OK")
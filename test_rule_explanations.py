@@ -0,0 +1,38 @@
+import os
+import tempfile
+import time
+from rule_explanations import RuleExplanations, save_explanations, split_numbered, build_batch_prompt, BATCH_HEADER
+
+def test_split_numbered_keeps_first_valid_answer():
+    text = "好的：\n<<1>> 第一則。\n<<3>>  第三則 \n<<1>> 重複\n<<9>> 超出範圍\n<<2>>"
+    assert split_numbered(text, 3) == {1: "第一則。", 3: "第三則"}
+    assert split_numbered(None, 3) == {}
+
+def test_batch_prompt_same_for_raw_rules_and_engine_results():
+    raw = {"id": "L-01", "description": "紫微坐命", "result": {"text": "領導力強"}}
+    matched = {"rule_id": "L-01", "description": "紫微坐命", "text": "領導力強", "detected_palace_names": "命宮"}
+    prompt = build_batch_prompt([raw, matched])
+    assert prompt == build_batch_prompt([matched, raw])  # 離線與即時路徑送出相同的提示詞
+    assert prompt.startswith(BATCH_HEADER + "\n<<1>> 格局：「紫微坐命」。內容：「領導力強」")
+    assert "<<2>>" in prompt
+
+def test_lookup_reloads_after_file_update_and_splits_results():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "explanations.json")
+        store = RuleExplanations(path)
+        assert store.get("L-01") is None
+        save_explanations({"L-01": "解讀一"}, "m", path)
+        assert store.get("L-01") == "解讀一"
+        time.sleep(0.01)
+        save_explanations({"L-01": "解讀一", "L-02": "解讀二"}, "m", path)
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        results = [{"rule_id": "L-02"}, {"rule_id": "X-99"}, {"description": "無 id"}]
+        known, live = store.split(results)
+        assert known == [({"rule_id": "L-02"}, "解讀二")]
+        assert live == results[1:]
+
+if __name__ == "__main__":
+    test_split_numbered_keeps_first_valid_answer()
+    test_batch_prompt_same_for_raw_rules_and_engine_results()
+    test_lookup_reloads_after_file_update_and_splits_results()
+    print("OK")
@@ -0,0 +1,100 @@
+import json
+import time
+import pytest
+from sheets_appender import SheetsAppender, http_status, is_permanent
+
+class FakeSheets:
+    def __init__(self, fail=0, error="503 Service Unavailable"):
+        self.calls = []
+        self.fail = fail
+        self.error = error
+
+    def __call__(self, sheet, rows):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError(self.error)
+        self.calls.append((sheet, list(rows)))
+
+def make(tmp_path, api, **kw):
+    opts = dict(interval=0.05, batch_size=50, rate_per_min=600, burst=10, pending_dir=str(tmp_path / "pending"), max_backoff=0.1)
+    opts.update(kw)
+    return SheetsAppender(api, **opts)
+
+def sent_rows(api, sheet):
+    return [row for name, rows in api.calls if name == sheet for row in rows]
+
+def test_rows_are_batched_per_sheet(tmp_path):
+    api = FakeSheets()
+    app = make(tmp_path, api, interval=0.3)
+    for i in range(20): app.put("Chats", [i, "問題"])
+    app.put("Users", ["王小明"])
+    assert app.flush(3)
+    assert sent_rows(api, "Chats") == [[i, "問題"] for i in range(20)]
+    assert len([c for c in api.calls if c[0] == "Chats"]) == 1
+    assert app.snapshot()["Users"]["sent"] == 1
+
+def test_failures_retry_with_backoff(tmp_path):
+    api = FakeSheets(fail=2)
+    app = make(tmp_path, api)
+    app.put("Chats", ["a"])
+    assert app.flush(5)
+    assert sent_rows(api, "Chats") == [["a"]]
+    assert app.snapshot()["Chats"]["failures"] == 2
+
+def test_unsent_rows_survive_restart(tmp_path):
+    api = FakeSheets(fail=10 ** 6)
+    app = make(tmp_path, api, interval=0.05)
+    for i in range(3): app.put("Users", [i])
+    time.sleep(0.2)
+    assert app.snapshot()["Users"]["pending"] == 3
+    api2 = FakeSheets()
+    app2 = make(tmp_path, api2)  # 模擬重啟：由待送檔載回
+    assert app2.flush(3)
+    assert sent_rows(api2, "Users") == [[0], [1], [2]]
+    with open(tmp_path / "pending" / "Users.jsonl", encoding="utf-8") as f:
+        assert f.read() == ""
+
+def test_throttle_cools_down_shared_bucket(tmp_path):
+    api = FakeSheets(fail=1, error="429 Too Many Requests. Please try again in 0.2s")
+    app = make(tmp_path, api)
+    app.put("Chats", ["x"])
+    assert app.flush(5)
+    assert app.limiter.snapshot()[0]["throttled"] == 1
+
+def read_failed(tmp_path, sheet):
+    with open(tmp_path / "pending" / f"{sheet}.failed.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_permanent_error_dead_letters_batch_and_continues(tmp_path):
+    api = FakeSheets(fail=1, error="<HttpError 400 when requesting ... returned \"Unable to parse range: Chats!A1\">")
+    app = make(tmp_path, api, interval=0.3)
+    app.put("Chats", ["壞列"])
+    time.sleep(0.5)
+    app.put("Chats", ["好列"])
+    assert app.flush(3)
+    assert sent_rows(api, "Chats") == [["好列"]]  # 壞批次不再重試，不會卡住後面的列
+    failed = read_failed(tmp_path, "Chats")
+    assert [f["row"] for f in failed] == [["壞列"]] and "400" in failed[0]["error"]
+    assert app.snapshot()["Chats"]["failed_rows"] == 1
+
+def test_pending_rows_are_capped(tmp_path):
+    api = FakeSheets(fail=10 ** 6)
+    app = make(tmp_path, api, interval=5, max_pending=10)
+    for i in range(25): app.put("Users", [i])
+    assert app.snapshot()["Users"]["pending"] <= 10
+    assert [f["row"] for f in read_failed(tmp_path, "Users")] == [[i] for i in range(15)]  # 最舊的列先移出
+    with open(tmp_path / "pending" / "Users.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == [[i] for i in range(15, 25)]
+
+def test_status_classification():
+    class Resp(dict):
+        status = 404
+    class HttpError(Exception):
+        resp = Resp()
+    assert http_status(HttpError("Requested entity was not found")) == 404 and is_permanent(HttpError())
+    assert not is_permanent(RuntimeError("429 Too Many Requests"))
+    assert not is_permanent(RuntimeError("503 Service Unavailable"))
+    assert not is_permanent(ConnectionError("connection reset"))
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
@@ -0,0 +1,41 @@
+import json
+import threading
+from sqlite_store import SQLiteStore, read_json_list
+
+def record(i, name="王小明"):
+    return {"timestamp": f"2026-01-01T00:00:{i:02d}", "name": name, "gender": "M",
+            "birth_date": "1990-05-01", "birth_hour": 3, "lunar_date": {"month": 4}}
+
+def test_insert_count_and_recent_pages(tmp_path):
+    store = SQLiteStore(str(tmp_path / "t.db"))
+    for i in range(7): store.insert("records", record(i))
+    assert store.count("records") == 7
+    assert [r["timestamp"][-2:] for r in store.recent("records", 3)] == ["06", "05", "04"]
+    assert [r["timestamp"][-2:] for r in store.recent("records", 3, offset=6)] == ["00"]
+    assert store.all("records")[0] == record(0)  # 非字串欄位保留於 data
+    mode = store._conn().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+def test_indexes_are_used(tmp_path):
+    store = SQLiteStore(str(tmp_path / "t.db"))
+    plan = store._conn().execute("EXPLAIN QUERY PLAN SELECT data FROM records WHERE name = ?", ("甲",)).fetchall()
+    assert "idx_records_name" in str(plan)
+    plan = store._conn().execute("EXPLAIN QUERY PLAN SELECT data FROM chats ORDER BY timestamp DESC LIMIT 50").fetchall()
+    assert "idx_chats_timestamp" in str(plan)
+
+def test_import_runs_once_and_threads_share_file(tmp_path):
+    src = tmp_path / "user_records.json"
+    src.write_text(json.dumps([record(1), record(2), "bad"], ensure_ascii=False), encoding="utf-8")
+    store = SQLiteStore(str(tmp_path / "t.db"))
+    assert store.import_entries("records", read_json_list(str(src)), "json") == 2
+    assert store.import_entries("records", read_json_list(str(src)), "json") == 0
+    threads = [threading.Thread(target=store.insert, args=("chats", {"timestamp": str(i), "prompt": "p"})) for i in range(10)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert store.count("chats") == 10 and store.count("records") == 2
+    store.replace("records", [record(9)])
+    assert store.all("records") == [record(9)]
+
+if __name__ == "__main__":
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
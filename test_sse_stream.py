@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+import app as core
+from sse_stream import GenerationStore, GenerationBuffer, parse_event_id, format_event, sse_events
+
+def parse_sse(text):
+    """將 SSE 文字拆回 [(event, id, data)]。"""
+    events = []
+    for block in text.strip("\n").split("\n\n"):
+        event, eid, data = None, None, []
+        for line in block.split("\n"):
+            if line.startswith("event: "): event = line[7:]
+            elif line.startswith("id: "): eid = line[4:]
+            elif line.startswith("data: "): data.append(line[6:])
+        if not line.startswith(":"): events.append((event, eid, "\n".join(data)))
+    return events
+
+def test_event_id_and_multiline_format():
+    assert parse_event_id("abc:4") == ("abc", 5)
+    assert parse_event_id("garbage") == (None, 0) and parse_event_id(None) == (None, 0)
+    assert format_event("甲\n乙\n", "abc:0") == "id: abc:0\ndata: 甲\ndata: 乙\ndata: \n\n"
+    assert parse_sse(format_event("甲\n乙\n", "abc:0")) == [(None, "abc:0", "甲\n乙\n")]
+
+def test_generation_survives_disconnect_and_resumes():
+    store = GenerationStore()
+    release = threading.Event()
+    def gen():
+        yield "第一段"
+        yield "第二段"
+        release.wait(2)
+        yield "第三段"
+    buf = store.start(gen)
+    reader = sse_events(buf, heartbeat=0.05)
+    first = parse_sse(next(reader))
+    reader.close()  # 用戶端斷線
+    assert first == [(None, f"{buf.id}:0", "第一段")]
+    release.set()
+    gen_id, start = parse_event_id(first[0][1])
+    resumed = parse_sse("".join(sse_events(store.get(gen_id), start, heartbeat=0.05)))
+    assert [e[2] for e in resumed if e[0] != "done"] == ["第二段", "第三段"]
+    assert resumed[-1][0] == "done" and store.snapshot()["resumed"] == 1
+
+def test_store_expires_finished_buffers():
+    store = GenerationStore(ttl=0.05, max_buffers=2)
+    old = store.start(lambda: iter(["a"]))
+    old.read(1, 1)
+    time.sleep(0.1)
+    assert store.get(old.id) is None and store.snapshot()["expired"] == 1
+    bufs = [store.start(lambda: iter(["x"])) for _ in range(4)]
+    for b in bufs: b.read(1, 1)
+    assert store.snapshot()["buffers"] <= 3
+
+def test_async_reader_wakes_on_thread_append():
+    buf = GenerationBuffer("g")
+    async def run():
+        threading.Timer(0.05, buf.append, args=("天機",)).start()
+        start = time.time()
+        chunks, done = await buf.aread(0, 2)
+        return chunks, done, time.time() - start
+    chunks, done, elapsed = asyncio.run(run())
+    assert chunks == ["天機"] and not done and elapsed < 1
+
+def test_flask_sse_mode_and_last_event_id_resume(monkeypatch):
+    monkeypatch.setattr(core, "prepare_chat_context", lambda data, ip, ua="": {})
+    monkeypatch.setattr(core, "stream_chat_response", lambda ctx: iter([core.StatusText("排隊中\n"), "天機", "已現"]))
+    client = core.app.test_client()
+    res = client.post("/api/chat", json={"name": "甲"}, headers={"Accept": "text/event-stream"})
+    assert res.content_type.startswith("text/event-stream")
+    events = parse_sse(res.get_data(as_text=True))
+    assert events[0][0] == "meta" and events[-1][0] == "done"
+    assert events[2] == ("status", events[2][1], "排隊中\n")
+    assert "".join(e[2] for e in events[1:-1]) == "【大師解析中，請稍候...】\n\n排隊中\n天機已現"
+    resumed = parse_sse(client.post("/api/chat", headers={"Last-Event-ID": events[2][1]}).get_data(as_text=True))
+    assert [e[2] for e in resumed[:-1]] == ["天機", "已現"]
+    gen_id = events[1][1].split(":")[0]
+    again = parse_sse(client.get(f"/api/chat/events/{gen_id}?from=3").get_data(as_text=True))
+    assert [e[2] for e in again[:-1]] == ["已現"]
+    assert client.get("/api/chat/events/unknown").status_code == 410
+
+if __name__ == "__main__":
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,33 @@
+import asyncio
+from stream_capture import StreamCapture, TRUNCATED_NOTE, compress_text, decompress_text, full_response
+
+class Status(str):
+    pass
+
+def test_tee_skips_status_and_caps_size():
+    cap = StreamCapture(max_chars=5, skip=(Status,))
+    out = list(cap.tee(iter(["天機", Status("排隊中"), "", "已現端倪"])))
+    assert out == ["天機", Status("排隊中"), "", "已現端倪"]  # 串流內容不受影響
+    assert cap.text() == "天機已現端" + TRUNCATED_NOTE and cap.chars == 5
+
+def test_async_tee():
+    async def agen():
+        for c in ("紫微", "斗數"):
+            yield c
+    cap = StreamCapture()
+    async def run():
+        return [c async for c in cap.atee(agen())]
+    assert asyncio.run(run()) == ["紫微", "斗數"]
+    assert cap.text() == "紫微斗數" and not cap.truncated
+
+def test_compressed_response_round_trip():
+    text = "命宮紫微" * 1000
+    packed = compress_text(text)
+    assert len(packed) < len(text) and decompress_text(packed) == text
+    assert full_response({"response": text[:10], "response_gz": packed}) == text
+    assert full_response({"response": "短回覆"}) == "短回覆"
+
+if __name__ == "__main__":
+    test_tee_skips_status_and_caps_size()
+    test_async_tee()
+    test_compressed_response_round_trip()